@@ -109,6 +109,21 @@ local width = nil
 local height = nil
 local map = nil
 local incr = nil
+local incr_rects = nil
+
+-- version 2: the map is split into regions (see _mapfile.py), which are decompressed when needed
+local MAX_CACHED_REGIONS = 256
+local map_file = nil
+local region_size = nil
+local pad_x = nil
+local pad_z = nil
+local regions_x = nil
+local regions_z = nil
+local region_index = nil
+local regions_start = nil
+local region_cache = {}
+local cached_regions = 0
+local cache_clock = 0
 
 
 local function bytes2int(str, signed) -- little endian
@@ -128,14 +143,59 @@ end
 
 local modpath = minetest.get_modpath(minetest.get_current_modname())
 
+local function get_region(rx, rz)
+    -- returns the decompressed region, or nil if it is all zero. The least recently used region is dropped when the cache is full.
+    local key = rz*regions_x + rx
+    cache_clock = cache_clock + 1
+    local entry = region_cache[key]
+    if entry then
+        entry.used = cache_clock
+        return entry.data
+    end
+    local start = bytes2int(region_index:sub(key*4+1, key*4+4))
+    local stop = bytes2int(region_index:sub(key*4+5, key*4+8))
+    local data = nil
+    if stop > start then
+        map_file:seek("set", regions_start + start)
+        data = minetest.decompress(map_file:read(stop - start))
+    end
+    if cached_regions >= MAX_CACHED_REGIONS then
+        local oldest_key = nil
+        local oldest_used = nil
+        for k, e in pairs(region_cache) do
+            if oldest_used == nil or e.used < oldest_used then
+                oldest_key = k
+                oldest_used = e.used
+            end
+        end
+        region_cache[oldest_key] = nil
+        cached_regions = cached_regions - 1
+    end
+    region_cache[key] = {data=data, used=cache_clock}
+    cached_regions = cached_regions + 1
+    return data
+end
+
 local function get_layers(x, z)
     x = x + offset_x
     z = z + offset_z
     if x < 0 or z < 0 or x >= width or z >= height then
         return 0, 0, 0
     end
-    local i = z*width*layer_count + x*layer_count + 1
-    return bytes2int(map:sub(i, i)), bytes2int(map:sub(i+1, i+1)), bytes2int(map:sub(i+2, i+2)), bytes2int(map:sub(i+3, i+3))
+    if map ~= nil then
+        local i = z*width*layer_count + x*layer_count + 1
+        return bytes2int(map:sub(i, i)), bytes2int(map:sub(i+1, i+1)), bytes2int(map:sub(i+2, i+2)), bytes2int(map:sub(i+3, i+3))
+    end
+    x = x + pad_x
+    z = z + pad_z
+    local rx = math.floor(x / region_size)
+    local rz = math.floor(z / region_size)
+    local data = get_region(rx, rz)
+    if data == nil then
+        return 0, 0, 0, 0
+    end
+    local i = ((z - rz*region_size)*region_size + x - rx*region_size)*layer_count + 1
+    return data:byte(i, i+3)
 end
 
 local function load_map_file()
@@ -143,8 +203,17 @@ local function load_map_file()
     local path = minetest.get_worldpath() .. "/world2minetest/map.dat"
     minetest.log("[w2mt] Loading map.dat from " .. path)
     local file = io.open(path, "rb")
+    if map_file ~= nil then
+        map_file:close()
+        map_file = nil
+    end
+    map = nil
+    incr = nil
+    incr_rects = nil
+    region_cache = {}
+    cached_regions = 0
 
-    local CURRENT_VERSION = 1
+    local CURRENT_VERSION = 3
 
     local version = bytes2int(file:read(1))
     local min_compat_version = bytes2int(file:read(1))
@@ -152,7 +221,7 @@ local function load_map_file()
          error("world2minetest can't load map.dat")
 --        error("world2minetest can't load map.dat (version " .. version .. ", needs version " .. min_compat_version .. " or higher (mod version: " .. CURRENT_VERSION .. ")")
     end
-    if version ~= CURRENT_VERSION then
+    if version > CURRENT_VERSION then
         minetest.log("[w2mt] WARNING: map.dat has newer version ") -- .. version .. " (mod version: " .. CURRENT_VERSION .. ")")
     end
     layer_count = bytes2int(file:read(1))
@@ -161,9 +230,25 @@ local function load_map_file()
     offset_z = bytes2int(file:read(2))
     width = bytes2int(file:read(2))
     height = bytes2int(file:read(2))
-    local map_size = bytes2int(file:read(4))
-    map = minetest.decompress(file:read(map_size))
-    local incr_size = bytes2int(file:read(4))
+    local incr_size
+    local rects_size = 0
+    if version == 1 then
+        local map_size = bytes2int(file:read(4))
+        map = minetest.decompress(file:read(map_size))
+        incr_size = bytes2int(file:read(4))
+    else
+        -- only the header is read, the regions follow the incremental data
+        region_size = bytes2int(file:read(2))
+        pad_x = bytes2int(file:read(2))
+        pad_z = bytes2int(file:read(2))
+        regions_x = bytes2int(file:read(2))
+        regions_z = bytes2int(file:read(2))
+        incr_size = bytes2int(file:read(4))
+        if version >= 3 then
+            rects_size = bytes2int(file:read(4))
+        end
+        region_index = file:read(4*(regions_x*regions_z + 1))
+    end
     local incr_info
     if incr_size ~= 0 then
         incr = minetest.decompress(file:read(incr_size))
@@ -171,6 +256,15 @@ local function load_map_file()
     else
         incr_info = " no incr data"
     end
+    if rects_size ~= 0 then
+        incr_rects = minetest.decompress(file:read(rects_size))
+    end
+    if version == 1 then
+        file:close()
+    else
+        regions_start = file:seek()
+        map_file = file
+    end
     -- minetest.log("[w2mt] map.dat loaded! offset_x:" .. offset_x .. " offset_z:" .. offset_z .. " width:" .. width .. " height:" .. height .. " len:" .. map:len() .. incr_info)
 end
 
@@ -284,27 +378,69 @@ minetest.register_on_generated(function(minp, maxp, blockseed)
 end)
 
 
+-- areas of mapblocks {x0, z0, x1, z1} which /w2mt:incr deletes, a few of them every globalstep
+local INCR_STEP_BUDGET_US = 20000
+-- larger rectangles are deleted in parts of this many mapblocks squared
+local INCR_MAX_RECT_SIZE = 8
+local incr_queue = {}
+local incr_next = 1
+
+local function queue_rect(queue, x0, z0, x1, z1)
+    for x = x0, x1, INCR_MAX_RECT_SIZE do
+        for z = z0, z1, INCR_MAX_RECT_SIZE do
+            table.insert(queue, {x, z, math.min(x+INCR_MAX_RECT_SIZE-1, x1), math.min(z+INCR_MAX_RECT_SIZE-1, z1)})
+        end
+    end
+end
+
+minetest.register_globalstep(function(dtime)
+    if incr_next > #incr_queue then
+        return
+    end
+    local start = minetest.get_us_time()
+    repeat
+        local r = incr_queue[incr_next]
+        minetest.delete_area({x=r[1]*16, y=floor_height, z=r[2]*16}, {x=r[3]*16+15, y=floor_height+255, z=r[4]*16+15})
+        incr_next = incr_next + 1
+    until incr_next > #incr_queue or minetest.get_us_time() - start >= INCR_STEP_BUDGET_US
+    if incr_next > #incr_queue then
+        minetest.log("[w2mt] Deleted " .. #incr_queue .. " changed areas")
+        incr_queue = {}
+        incr_next = 1
+    end
+end)
+
+
 minetest.register_chatcommand("w2mt:incr", {
     privs = {
         server = true
     },
     func = function(name, param)
+        load_map_file()
         if incr == nil then
             minetest.log("[w2mt] No incremental data available")
+            return false, "No incremental data available"
         end
-        load_map_file()
-        local len = string.len(incr)/4
-        for i = 0, len-1 do
-            local start_i = i*4
-            local block_x = bytes2int(incr:sub(start_i+1, start_i+2), true)
-            local block_z = bytes2int(incr:sub(start_i+3, start_i+4), true)
-            local node_x_min = block_x * 16
-            local node_x_max = node_x_min + 15
-            local node_z_min = block_z * 16
-            local node_z_max = node_z_min + 15
-            -- minetest.log("[w2mt] Deleting mapblock " .. i+1 .. "/" .. len .. ": (" .. block_x .. "," .. block_z .. ") from (" .. node_x_min .. "," .. node_z_min .. ") to (" .. node_x_max .. "," .. node_z_max .. ")")
-            minetest.delete_area({x=node_x_min, y=floor_height, z=node_z_min}, {x=node_x_max, y=floor_height+255, z=node_z_max})
+        -- the rectangles of map.dat version 3 cover the changed mapblocks with fewer deletions
+        local queue = {}
+        if incr_rects ~= nil then
+            for i = 0, incr_rects:len()/8-1 do
+                local start_i = i*8
+                queue_rect(queue,
+                    bytes2int(incr_rects:sub(start_i+1, start_i+2), true), bytes2int(incr_rects:sub(start_i+3, start_i+4), true),
+                    bytes2int(incr_rects:sub(start_i+5, start_i+6), true), bytes2int(incr_rects:sub(start_i+7, start_i+8), true))
+            end
+        else
+            for i = 0, incr:len()/4-1 do
+                local start_i = i*4
+                local block_x = bytes2int(incr:sub(start_i+1, start_i+2), true)
+                local block_z = bytes2int(incr:sub(start_i+3, start_i+4), true)
+                table.insert(queue, {block_x, block_z, block_x, block_z})
+            end
         end
+        incr_queue = queue
+        incr_next = 1
+        return true, "Deleting " .. #queue .. " changed areas (" .. incr:len()/4 .. " mapblocks)"
     end
 })
 
@@ -0,0 +1,53 @@
+"""
+parse_features_osm.py has to build the same features from Overpass JSON, OSM XML and OSM PBF files of the same
+data, and fail with an error message for broken files. The fixtures are written from osm_small.json with osmium.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+
+W2MT = os.path.join(os.path.dirname(__file__), "..", "w2mt")
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures")
+
+
+def parse(path, output, *args):
+    return subprocess.run([sys.executable, "parse_features_osm.py", path, "-o", str(output), *args], cwd=W2MT,
+                          capture_output=True, text=True)
+
+
+def parse_features(path, tmp_path, *args):
+    output = tmp_path / "features.json"
+    result = parse(path, output, *args)
+    assert result.returncode == 0, result.stdout + result.stderr
+    with open(output) as f:
+        return json.load(f)
+
+
+@pytest.fixture(scope="module")
+def json_features(tmp_path_factory):
+    return parse_features(os.path.join(FIXTURES, "osm_small.json"), tmp_path_factory.mktemp("json"))
+
+
+@pytest.mark.parametrize("name, args", [
+    ("osm_small.json", ("--stream",)),
+    ("osm_small.osm", ()),
+    ("osm_small.osm.pbf", ()),
+    ("osm_small.osm.pbf", ("--workers", "2")),
+])
+def test_same_features_as_json(json_features, tmp_path, name, args):
+    assert parse_features(os.path.join(FIXTURES, name), tmp_path, *args) == json_features
+
+
+@pytest.mark.parametrize("name, size", [("osm_small.osm.pbf", 500), ("osm_small.osm", 2000)])
+def test_truncated_file(tmp_path, name, size):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        data = f.read(size)
+    path = tmp_path / name
+    path.write_bytes(data)
+    result = parse(str(path), tmp_path / "features.json")
+    assert result.returncode == 2
+    assert f"Fehler beim Laden der Datei {path}" in result.stdout
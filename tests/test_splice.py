@@ -0,0 +1,78 @@
+"""
+generate_map.py --splice has to give the part it replaces the same map as generating the whole map, also for a
+lowered road, a flat area and building outlines crossing its border, whose heights are means over all their pixels.
+"""
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+
+W2MT = os.path.join(os.path.dirname(__file__), "..", "w2mt")
+sys.path.insert(0, W2MT)
+from _mapfile import read_changed_blocks, read_header, read_rows  # noqa: E402
+
+# the part replaced by --splice
+WINDOW = {"--minx": 40, "--maxx": 70, "--miny": 30, "--maxy": 60}
+
+
+def features(inner_height=10):
+    """Returns features of a map of 100x100 blocks, only the building inside of WINDOW gets inner_height."""
+    buildings = [
+        {"x": [x, x + 12, x + 12, x], "y": [y, y, y + 9, y + 9], "height": inner_height if (x, y) == (45, 38) else 10}
+        for x, y in ((10, 25), (33, 36), (45, 38), (64, 48), (66, 70), (85, 60))
+    ]
+    return {
+        "min_x": 0, "max_x": 99, "min_y": 0, "max_y": 99,
+        "areas": {"outer": [], "inner": [], "low": [], "medium": [], "high": [
+            {"x": [30, 58, 58, 30], "y": [55, 55, 80, 80], "surface": "water", "osm_id": 1},
+        ]},
+        "highways": [
+            {"x": [5, 30, 60, 95], "y": [20, 40, 45, 75], "surface": "asphalt", "type": "residential", "layer": -1, "osm_id": 2},
+            {"x": [50, 52, 90], "y": [5, 50, 52], "surface": "footway", "type": "footway", "layer": -2, "osm_id": 3},
+        ],
+        "railways": [],
+        "waterways": [],
+        "buildings": buildings,
+        "decorations": {},
+    }
+
+
+def generate(tmp_path, data, *args):
+    path = tmp_path / "features.json"
+    path.write_text(json.dumps(data))
+    result = subprocess.run([sys.executable, "generate_map.py", "--features", str(path), "-o", str(tmp_path / "map.dat"),
+                             "--compression-threads", "1", *args], cwd=W2MT, capture_output=True, text=True)
+    assert result.returncode == 0, result.stdout + result.stderr
+    return (tmp_path / "map.dat").read_bytes()
+
+
+def read_map(tmp_path):
+    """Returns the map array and the changed mapblocks of the map.dat in tmp_path."""
+    with open(tmp_path / "map.dat", "rb") as f:
+        header = read_header(f)
+        return np.concatenate([rows for _, rows in read_rows(f, header)]), read_changed_blocks(f, header)
+
+
+def splice_args():
+    return ["--splice"] + [str(value) for item in WINDOW.items() for value in item]
+
+
+@pytest.mark.parametrize("args", [(), ("--tile-size", "16")])
+def test_unchanged_splice(tmp_path, args):
+    full = generate(tmp_path, features())
+    assert generate(tmp_path, features(), *splice_args(), *args) == full
+    assert len(read_map(tmp_path)[1]) == 0
+
+
+def test_changed_splice(tmp_path):
+    generate(tmp_path, features(20))
+    whole_map, _ = read_map(tmp_path)
+    generate(tmp_path, features())
+    generate(tmp_path, features(20), *splice_args())
+    spliced_map, changed = read_map(tmp_path)
+    assert np.array_equal(spliced_map, whole_map)
+    assert len(changed) > 0
@@ -0,0 +1,340 @@
+"""
+Compact binary, columnar alternative to the features_*.json files written by parse_features_osm.py and
+parse_features_dxf.py. Files whose name ends with FEATURES_BINARY_SUFFIX are written in this format.
+
+Layout:
+    MAGIC (8 bytes), header length (4 bytes, little endian), header (JSON), arrays (each aligned to 8 bytes)
+
+Every list of features (e.g. "highways" or "areas" -> "low") is stored as one feature class:
+    x, y:     int32 arrays with the coordinates of all features concatenated
+    offsets:  int64 array, the coordinates of feature i are x[offsets[i]:offsets[i+1]]
+    columns:  one array per other key of the features. Integer values are stored in the smallest fitting
+              integer type, booleans as uint8, everything else (strings, mixed ids like "123.outer#0")
+              as index into a table of values kept in the header.
+Point features (decorations with a single x and y instead of lists) have one coordinate and are marked
+in the "_scalar" column. All other values (min_x, ...) are kept in the header.
+"""
+import json
+
+import numpy as np
+
+
+MAGIC = b"W2MTFEAT"
+VERSION = 1
+FEATURES_BINARY_SUFFIX = ".bin"
+
+_ALIGN = 8
+
+
+class _Absent:
+    def __repr__(self):
+        return "<absent>"
+
+_ABSENT = _Absent()
+
+
+def _int_dtype(values):
+    lo, hi = min(values, default=0), max(values, default=0)
+    for dtype in (np.int8, np.int16, np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return dtype
+
+
+def _index_dtype(count):
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if count <= np.iinfo(dtype).max:
+            return dtype
+    return np.uint64
+
+
+class _Writer:
+    def __init__(self):
+        self.arrays = []
+        self.size = 0
+
+    def add(self, array):
+        array = np.ascontiguousarray(array)
+        spec = {"offset": self.size, "dtype": array.dtype.str, "length": len(array)}
+        self.arrays.append(array)
+        self.size += -(-array.nbytes // _ALIGN) * _ALIGN
+        return spec
+
+    def feature_class(self, features):
+        scalar = [type(f["x"]) is not list for f in features]
+        lengths = [1 if s else len(f["x"]) for f, s in zip(features, scalar)]
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        xs = np.empty(offsets[-1], dtype=np.int32)
+        ys = np.empty(offsets[-1], dtype=np.int32)
+        for f, s, start, end in zip(features, scalar, offsets[:-1], offsets[1:]):
+            xs[start:end] = f["x"]
+            ys[start:end] = f["y"]
+        res = {"count": len(features), "x": self.add(xs), "y": self.add(ys), "offsets": self.add(offsets), "columns": {}}
+        if any(scalar):
+            res["columns"]["_scalar"] = {"kind": "bool", "array": self.add(np.array(scalar, dtype=np.uint8))}
+
+        keys = {}
+        for f in features:
+            for key in f:
+                if key not in ("x", "y"):
+                    keys[key] = None
+        for key in keys:
+            values = [f.get(key, _ABSENT) for f in features]
+            column = {}
+            if _ABSENT in values:
+                column["optional"] = True
+            if all(type(v) is bool for v in values):
+                column["kind"] = "bool"
+                column["array"] = self.add(np.array(values, dtype=np.uint8))
+            elif all(type(v) is int for v in values):
+                column["kind"] = "int"
+                column["array"] = self.add(np.array(values, dtype=_int_dtype(values)))
+            else:
+                table = {}
+                indices = []
+                for v in values:
+                    if v is _ABSENT:
+                        indices.append(0)
+                        continue
+                    k = (type(v), v)
+                    if k not in table:
+                        table[k] = len(table) + 1
+                    indices.append(table[k])
+                column["kind"] = "enum"
+                column["values"] = [v for _, v in table]
+                column["array"] = self.add(np.array(indices, dtype=_index_dtype(len(table))))
+            res["columns"][key] = column
+        return res
+
+    def walk(self, data):
+        res = {}
+        for key, value in data.items():
+            if isinstance(value, list):
+                res[key] = {"features": self.feature_class(value)}
+            elif isinstance(value, dict):
+                res[key] = {"group": self.walk(value)}
+            else:
+                res[key] = {"value": value}
+        return res
+
+
+def write_features_binary(data, file):
+    """Writes the features dict (as it would be dumped to JSON) to a binary file object."""
+    writer = _Writer()
+    header = json.dumps({"version": VERSION, "data": writer.walk(data)}).encode("utf-8")
+    start = -(-(len(MAGIC) + 4 + len(header)) // _ALIGN) * _ALIGN
+    header += b" " * (start - len(MAGIC) - 4 - len(header))
+    file.write(MAGIC)
+    file.write(len(header).to_bytes(4, "little"))
+    file.write(header)
+    for array in writer.arrays:
+        file.write(array.tobytes())
+        file.write(b"\0" * (-array.nbytes % _ALIGN))
+
+
+def write_features(data, path):
+    """Writes the features dict to path, in binary format if path ends with FEATURES_BINARY_SUFFIX, else as JSON."""
+    if path.endswith(FEATURES_BINARY_SUFFIX):
+        with open(path, "wb") as f:
+            write_features_binary(data, f)
+    else:
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2)
+
+
+def _array(mm, start, spec):
+    return np.ndarray(spec["length"], np.dtype(spec["dtype"]), buffer=mm, offset=start + spec["offset"])
+
+
+def _in_window(bounds, window):
+    min_x, min_y, max_x, max_y = window
+    return (bounds[:, 0] <= max_x) & (bounds[:, 2] >= min_x) & (bounds[:, 1] <= max_y) & (bounds[:, 3] >= min_y)
+
+
+class FeatureStore:
+    """
+    Columnar form of a list of features, which is what generate_map.py works with: the coordinates of all features
+    concatenated in x and y (int32), those of feature i are x[offsets[i]:offsets[i+1]]. scalar marks point features
+    (a single x and y instead of lists). Every other key is a column of values (see column()).
+    """
+    def __init__(self, x, y, offsets, scalar=None, columns=None):
+        self.x = np.asarray(x, dtype=np.int32)
+        self.y = np.asarray(y, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.scalar = np.zeros(len(self), dtype=bool) if scalar is None else np.asarray(scalar, dtype=bool)
+        # key -> (values, which features have the key or None if all have it)
+        self.columns = columns if columns is not None else {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def coords(self, i):
+        """Returns views of the x and y coordinates of feature i."""
+        start, end = self.offsets[i], self.offsets[i+1]
+        return self.x[start:end], self.y[start:end]
+
+    def column(self, key, default=None):
+        """Returns the values of key for all features, default for features without it."""
+        if key not in self.columns:
+            return np.full(len(self), default, dtype=object if default is None else None)
+        values, present = self.columns[key]
+        if present is None:
+            return values
+        return np.where(present, values, np.array(default, dtype=object if default is None else None))
+
+    def bounds(self):
+        """Returns the bounding boxes (x_min, y_min, x_max, y_max) of all features, (0, 0, -1, -1) for features without coordinates."""
+        bounds = np.tile(np.array([0, 0, -1, -1], dtype=np.int64), (len(self), 1))
+        filled = np.flatnonzero(self.lengths)
+        if len(filled):
+            starts = self.offsets[:-1][filled]
+            bounds[filled] = np.stack([ufunc.reduceat(coords, starts) for ufunc, coords in (
+                (np.minimum, self.x), (np.minimum, self.y), (np.maximum, self.x), (np.maximum, self.y))], axis=1)
+        return bounds
+
+    def shift(self, dx, dy):
+        """Returns a store with all coordinates shifted by (dx, dy), in one operation over all coordinates."""
+        return FeatureStore(self.x + np.int32(dx), self.y + np.int32(dy), self.offsets, self.scalar, self.columns)
+
+    def select(self, indices):
+        """Returns a store of the features at the given positions, in that order."""
+        indices = np.asarray(indices, dtype=np.int64)
+        lengths = self.lengths[indices]
+        positions = np.repeat(self.offsets[:-1][indices] - (np.cumsum(lengths) - lengths), lengths) + np.arange(lengths.sum())
+        columns = {key: (values[indices], present[indices] if present is not None else None) for key, (values, present) in self.columns.items()}
+        return FeatureStore(self.x[positions], self.y[positions], np.concatenate(([0], np.cumsum(lengths))), self.scalar[indices], columns)
+
+    def in_window(self, window):
+        """Returns a store of the features whose bounding box intersects window (min_x, min_y, max_x, max_y)."""
+        return self.select(np.flatnonzero(_in_window(self.bounds(), window) & (self.lengths > 0)))
+
+    @staticmethod
+    def concat(stores):
+        """Returns a store of the features of all stores, one after the other."""
+        stores = list(stores)
+        columns = {}
+        for key in dict.fromkeys(key for store in stores for key in store.columns):
+            values = [store.columns[key][0] if key in store.columns else np.full(len(store), None, dtype=object) for store in stores]
+            if len({v.dtype for v in values}) > 1:
+                values = [v.astype(object) for v in values]
+            present = np.concatenate([np.ones(len(store), dtype=bool) if key in store.columns and store.columns[key][1] is None
+                                      else store.columns[key][1] if key in store.columns else np.zeros(len(store), dtype=bool) for store in stores])
+            columns[key] = (np.concatenate(values), None if present.all() else present)
+        lengths = np.concatenate([store.lengths for store in stores] + [np.zeros(0, dtype=np.int64)])
+        return FeatureStore(np.concatenate([store.x for store in stores] + [np.zeros(0, dtype=np.int32)]),
+                            np.concatenate([store.y for store in stores] + [np.zeros(0, dtype=np.int32)]),
+                            np.concatenate(([0], np.cumsum(lengths))),
+                            np.concatenate([store.scalar for store in stores] + [np.zeros(0, dtype=bool)]), columns)
+
+    @staticmethod
+    def from_features(features):
+        """Builds the store of a list of feature dicts as loaded from a features JSON file."""
+        scalar = [type(f["x"]) is not list for f in features]
+        lengths = [1 if s else len(f["x"]) for f, s in zip(features, scalar)]
+        offsets = np.zeros(len(features) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        xs = np.empty(offsets[-1], dtype=np.int32)
+        ys = np.empty(offsets[-1], dtype=np.int32)
+        for f, start, end in zip(features, offsets[:-1], offsets[1:]):
+            xs[start:end] = f["x"]
+            ys[start:end] = f["y"]
+
+        columns = {}
+        for key in dict.fromkeys(key for f in features for key in f if key not in ("x", "y")):
+            values = [f.get(key, _ABSENT) for f in features]
+            present = np.array([v is not _ABSENT for v in values], dtype=bool)
+            given = [v for v in values if v is not _ABSENT]
+            if all(type(v) is bool for v in given):
+                values = np.array([v is True for v in values], dtype=bool)
+            elif all(type(v) is int for v in given):
+                values = np.array([v if v is not _ABSENT else 0 for v in values], dtype=np.int64)
+            else:
+                values = np.array([v if v is not _ABSENT else None for v in values] + [None], dtype=object)[:-1]
+            columns[key] = (values, None if present.all() else present)
+        return FeatureStore(xs, ys, offsets, scalar, columns)
+
+
+def _read_store(mm, start, spec):
+    scalar = None
+    columns = {}
+    for key, column in spec["columns"].items():
+        values = _array(mm, start, column["array"])
+        present = None
+        if column["kind"] == "bool":
+            values = values.astype(bool)
+        elif column["kind"] == "int":
+            values = values.astype(np.int64)
+        elif column["kind"] == "enum":
+            if column.get("optional", False):
+                present = values != 0
+            values = np.array([None] + column["values"] + [None], dtype=object)[:-1][values]
+        if key == "_scalar":
+            scalar = values
+        else:
+            columns[key] = (values, present)
+    return FeatureStore(_array(mm, start, spec["x"]), _array(mm, start, spec["y"]), _array(mm, start, spec["offsets"]), scalar, columns)
+
+
+def _read_stores(mm, start, spec):
+    res = {}
+    for key, entry in spec.items():
+        if "features" in entry:
+            res[key] = _read_store(mm, start, entry["features"])
+        elif "group" in entry:
+            res[key] = _read_stores(mm, start, entry["group"])
+        else:
+            res[key] = entry["value"]
+    return res
+
+
+def _to_stores(data):
+    res = {}
+    for key, value in data.items():
+        if isinstance(value, list):
+            res[key] = FeatureStore.from_features(value)
+        elif isinstance(value, dict):
+            res[key] = _to_stores(value)
+        else:
+            res[key] = value
+    return res
+
+
+def _select_window(data, window):
+    for key, value in data.items():
+        if isinstance(value, FeatureStore):
+            data[key] = value.in_window(window)
+        elif isinstance(value, dict):
+            _select_window(value, window)
+
+
+def _read_header(file):
+    if file.read(len(MAGIC)) != MAGIC:
+        raise ValueError(f"{file.name} is not a binary features file")
+    header_length = int.from_bytes(file.read(4), "little")
+    header = json.loads(file.read(header_length))
+    if header["version"] > VERSION:
+        raise ValueError(f"{file.name} has unsupported features file version {header['version']}")
+    return header, len(MAGIC) + 4 + header_length
+
+
+def load_feature_stores(file, window=None):
+    """
+    Loads a features file (opened in binary mode) in either format, which is detected by its first bytes. Every list
+    of features is a FeatureStore. Binary files are not converted at all, their arrays are memory-mapped. With a window
+    (min_x, min_y, max_x, max_y), only the features whose bounding box intersects it are kept.
+    """
+    is_binary = file.read(len(MAGIC)) == MAGIC
+    file.seek(0)
+    if is_binary:
+        header, start = _read_header(file)
+        data = _read_stores(np.memmap(file, dtype=np.uint8, mode="r"), start, header["data"])
+    else:
+        data = _to_stores(json.load(file))
+    if window is not None:
+        _select_window(data, window)
+    return data
@@ -0,0 +1,402 @@
+"""
+Reading and writing map.dat, the file read by the world2minetest mod. All numbers are little endian.
+
+Version 1:
+    version (1), minimum compatible version (1), layer count (1), height at spawn (1), offset x (2), offset z (2),
+    width (2), height (2), length (4) + zlib compressed map array (rows of width * layer count bytes),
+    length (4) + zlib compressed changed mapblocks (int16 pairs of block x and z, see --incr of generate_map.py)
+
+Version 2 splits the map into square regions, each compressed on its own, so the mod only reads the header when it
+starts and decompresses a region when it generates the nodes inside of it. Regions are aligned to the mapchunks of
+Minetest (80x80 nodes starting at -32 by default), hence with the default region size every mapchunk is one region.
+Version 3 adds the changed mapblocks merged into rectangles (the fields marked with 3 are missing in version 2).
+    version (1), minimum compatible version (1), layer count (1), height at spawn (1), offset x (2), offset z (2),
+    width (2), height (2), region size (2), pad x (2), pad z (2), regions along x (2), regions along z (2),
+    length of the changed mapblocks (4), 3: length of the changed rectangles (4),
+    index: (regions along x * regions along z + 1) offsets (4) of the regions, relative to the start of the regions,
+    zlib compressed changed mapblocks,
+    3: zlib compressed changed rectangles (int16 x0, z0, x1, z1 of the mapblocks of every rectangle, inclusive),
+    regions row by row, each a zlib compressed array of region size rows of region size * layer count bytes,
+    optionally the hashes of the mapblocks: first block x (2, signed), first block z (2, signed), blocks along x (2),
+    blocks along z (2), a 64 bit hash of every block row by row,
+    optionally the origin of the map: EPSG:25832 x and y of the first column and row (4 each, signed) and the height
+    subtracted from the heightmap (2, signed), which --splice of generate_map.py needs.
+Region (rx, rz) starts at column rx * region size - pad x and row rz * region size - pad z of the map, parts outside
+of the map are zero. A region of length 0 is all zero. The hash of a mapblock covers the map array inside of it,
+where parts outside of the map are zero, and is used to find the changed mapblocks for --incr.
+"""
+import os
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from _tiles import read_compressed_rows
+from _util import to_bytes, from_bytes
+
+
+VERSION = 3
+
+REGION_SIZE = 80
+COMPRESSION_LEVEL = 9
+# mapblocks are 16x16 columns of nodes, starting at world coordinate 0
+BLOCK_SIZE = 16
+# block_hashes() reads this many bytes of the map at once
+_HASH_BAND_BYTES = 1 << 24
+# splice_map() copies unchanged regions this many bytes at once
+_COPY_CHUNK_SIZE = 1 << 24
+# world coordinate where mapchunks start
+MAPCHUNK_START = -32
+
+
+def region_grid(size, offset, region_size):
+    """Returns (pad, count) of the regions along an axis of the map with size pixels, offset is the pixel at 0."""
+    # pixel offset + MAPCHUNK_START starts a region
+    pad = -(offset + MAPCHUNK_START) % region_size
+    return pad, -(-(size + pad) // region_size)
+
+
+def block_grid(size, offset):
+    """Returns (first block, pad, count) of the mapblocks along an axis of the map with size pixels, offset is the pixel at 0."""
+    pad = -offset % BLOCK_SIZE
+    return -offset // BLOCK_SIZE, pad, -(-(size + pad) // BLOCK_SIZE)
+
+
+def _hash_keys(count):
+    # fixed keys, the hashes of map.dat files have to stay comparable
+    return np.random.default_rng(0x77326d74).integers(1, 2**63, size=(3, count), dtype=np.uint64) | np.uint64(1)
+
+
+def _hash_blocks(blocks):
+    """Returns a 64 bit hash of every row of the uint8 array blocks, whose length is a multiple of 8."""
+    words = np.ascontiguousarray(blocks).view("<u8")
+    keys = _hash_keys(words.shape[1])
+    mixed = (words ^ keys[0]) * keys[1]
+    mixed ^= mixed >> np.uint64(31)
+    mixed *= keys[2]
+    mixed ^= mixed >> np.uint64(29)
+    return mixed.sum(axis=1, dtype=np.uint64)
+
+
+def block_hashes(raster, offset_x, offset_z):
+    """Returns the hashes (blocks along z, blocks along x) of all mapblocks of the map raster, see block_grid()."""
+    height, width, layer_count = raster.shape
+    _, pad_x, count_x = block_grid(width, offset_x)
+    _, pad_z, count_z = block_grid(height, offset_z)
+    hashes = np.zeros((count_z, count_x), dtype=np.uint64)
+    band_blocks = max(_HASH_BAND_BYTES // (count_x * BLOCK_SIZE * BLOCK_SIZE * layer_count), 1)
+    for bz in range(0, count_z, band_blocks):
+        count = min(band_blocks, count_z - bz)
+        band = np.zeros((count * BLOCK_SIZE, count_x * BLOCK_SIZE, layer_count), dtype=np.uint8)
+        y0, y1 = max(bz * BLOCK_SIZE - pad_z, 0), min((bz + count) * BLOCK_SIZE - pad_z, height)
+        with raster.tile((0, y0, width, y1), writable=False) as rows:
+            band[y0 - (bz * BLOCK_SIZE - pad_z):y1 - (bz * BLOCK_SIZE - pad_z), pad_x:pad_x + width] = rows
+        hashes[bz:bz + count] = _hash_aligned(band)
+    return hashes
+
+
+def _hash_aligned(band):
+    """Returns the hashes of the mapblocks of an array (rows, columns, layer count) starting at a mapblock corner."""
+    count_z, count_x = band.shape[0] // BLOCK_SIZE, band.shape[1] // BLOCK_SIZE
+    blocks = band.reshape(count_z, BLOCK_SIZE, count_x, BLOCK_SIZE, band.shape[2]).transpose(0, 2, 1, 3, 4)
+    return _hash_blocks(blocks.reshape(count_z * count_x, -1)).reshape(count_z, count_x)
+
+
+def diff_block_hashes(first_x, first_z, hashes, old_first_x, old_first_z, old_hashes):
+    """
+    Returns the (block_x, block_z) of all mapblocks whose hash differs from the old hashes or which the old map
+    doesn't have, sorted by x and then z.
+    """
+    bz, bx = np.indices(hashes.shape)
+    old_x, old_z = bx + first_x - old_first_x, bz + first_z - old_first_z
+    known = (old_x >= 0) & (old_x < old_hashes.shape[1]) & (old_z >= 0) & (old_z < old_hashes.shape[0])
+    changed = ~known
+    changed[known] = hashes[known] != old_hashes[old_z[known], old_x[known]]
+    block_x, block_z = bx[changed] + first_x, bz[changed] + first_z
+    order = np.lexsort((block_z, block_x))
+    return np.stack((block_x[order], block_z[order]), axis=1)
+
+
+def block_rectangles(blocks):
+    """
+    Merges mapblocks (block_x, block_z) into rectangles (x0, z0, x1, z1), inclusive, which cover exactly these
+    blocks: runs of blocks along x are merged with the same runs in the following rows.
+    """
+    if len(blocks) == 0:
+        return np.zeros((0, 4), dtype=np.int64)
+    blocks = np.asarray(blocks, dtype=np.int64)
+    first_x, first_z = blocks.min(axis=0)
+    grid = np.zeros((blocks[:, 1].max() - first_z + 1, blocks[:, 0].max() - first_x + 3), dtype=np.int8)
+    grid[blocks[:, 1] - first_z, blocks[:, 0] - first_x + 1] = 1
+    edges = np.diff(grid, axis=1)
+    z, x0 = np.nonzero(edges == 1)
+    _, x1 = np.nonzero(edges == -1)
+    x1 -= 1
+    # rows of the same run follow each other after sorting by run and row
+    order = np.lexsort((z, x1, x0))
+    z, x0, x1 = z[order], x0[order], x1[order]
+    new = np.ones(len(z), dtype=bool)
+    new[1:] = (x0[1:] != x0[:-1]) | (x1[1:] != x1[:-1]) | (z[1:] != z[:-1] + 1)
+    starts = np.flatnonzero(new)
+    ends = np.append(starts[1:], len(z)) - 1
+    return np.stack((x0[starts] + first_x, z[starts] + first_z, x1[starts] + first_x, z[ends] + first_z), axis=1)
+
+
+def read_header(f):
+    """Reads the header of a map.dat file. Returns a dict with the fields of the header of either version."""
+    header = {"version": from_bytes(f.read(1)), "min_version": from_bytes(f.read(1))}
+    if header["min_version"] > VERSION:
+        raise ValueError(f"map.dat has newer version {header['version']}")
+    for key, length in (("layer_count", 1), ("spawn_height", 1), ("offset_x", 2), ("offset_z", 2), ("width", 2), ("height", 2)):
+        header[key] = from_bytes(f.read(length))
+    if header["version"] == 1:
+        header["map_length"] = from_bytes(f.read(4))
+        header["map_start"] = f.tell()
+        f.seek(header["map_length"], 1)
+        header["incr_length"] = from_bytes(f.read(4))
+        header["incr_start"] = f.tell()
+    else:
+        for key in ("region_size", "pad_x", "pad_z", "regions_x", "regions_z"):
+            header[key] = from_bytes(f.read(2))
+        header["incr_length"] = from_bytes(f.read(4))
+        header["rects_length"] = from_bytes(f.read(4)) if header["version"] >= 3 else 0
+        count = header["regions_x"] * header["regions_z"] + 1
+        header["index"] = np.frombuffer(f.read(4 * count), dtype="<u4").astype(np.int64)
+        header["incr_start"] = f.tell()
+        header["rects_start"] = header["incr_start"] + header["incr_length"]
+        header["regions_start"] = header["rects_start"] + header["rects_length"]
+        header["hashes_start"] = header["regions_start"] + int(header["index"][-1])
+    return header
+
+
+def read_window(f, header, window):
+    """
+    Returns the map array inside window (x0, y0, x1, y1) of a version 2 or newer map.dat file, decompressing only
+    the regions overlapping it. Parts outside of the map are zero.
+    """
+    x0, y0, x1, y1 = window
+    size, pad_x, pad_z = header["region_size"], header["pad_x"], header["pad_z"]
+    result = np.zeros((y1 - y0, x1 - x0, header["layer_count"]), dtype=np.uint8)
+    # the window clipped to the map
+    cx0, cy0, cx1, cy1 = max(x0, 0), max(y0, 0), min(x1, header["width"]), min(y1, header["height"])
+    if cx0 >= cx1 or cy0 >= cy1:
+        return result
+    for rz in range((cy0 + pad_z) // size, (cy1 - 1 + pad_z) // size + 1):
+        for rx in range((cx0 + pad_x) // size, (cx1 - 1 + pad_x) // size + 1):
+            rx0, rz0 = rx * size - pad_x, rz * size - pad_z
+            ox0, oy0, ox1, oy1 = max(cx0, rx0), max(cy0, rz0), min(cx1, rx0 + size), min(cy1, rz0 + size)
+            result[oy0-y0:oy1-y0, ox0-x0:ox1-x0] = read_region(f, header, rx, rz)[oy0-rz0:oy1-rz0, ox0-rx0:ox1-rx0]
+    return result
+
+
+def read_region(f, header, rx, rz):
+    """Returns the array (region size, region size, layer count) of region (rx, rz) of a version 2 map.dat file."""
+    size = header["region_size"]
+    i = rz * header["regions_x"] + rx
+    start, end = header["index"][i:i+2]
+    if start == end:
+        return np.zeros((size, size, header["layer_count"]), dtype=np.uint8)
+    f.seek(header["regions_start"] + start)
+    return np.frombuffer(zlib.decompress(f.read(end - start)), dtype=np.uint8).reshape(size, size, -1)
+
+
+def read_rows(f, header):
+    """Yields (y0, rows) of the map array of a map.dat file, a band of rows (count, width, layer count) at once."""
+    width, height, layer_count = header["width"], header["height"], header["layer_count"]
+    if header["version"] == 1:
+        f.seek(header["map_start"])
+        for y0, rows in read_compressed_rows(f.read(header["map_length"]), width * layer_count, height):
+            yield y0, rows.reshape(len(rows), width, layer_count)
+        return
+    size, pad_x, pad_z = header["region_size"], header["pad_x"], header["pad_z"]
+    for rz in range(header["regions_z"]):
+        band = np.concatenate([read_region(f, header, rx, rz) for rx in range(header["regions_x"])], axis=1)
+        y0, y1 = max(rz * size - pad_z, 0), min((rz + 1) * size - pad_z, height)
+        yield y0, band[y0 - (rz * size - pad_z):y1 - (rz * size - pad_z), pad_x:pad_x + width]
+
+
+def read_changed_blocks(f, header):
+    """Returns the changed mapblocks (block_x, block_z) stored in a map.dat file."""
+    f.seek(header["incr_start"])
+    data = f.read(header["incr_length"])
+    return np.frombuffer(zlib.decompress(data), dtype="<i2").reshape(-1, 2) if data else np.zeros((0, 2), dtype="<i2")
+
+
+def read_changed_rectangles(f, header):
+    """Returns the changed rectangles (x0, z0, x1, z1) of mapblocks stored in a map.dat file, see block_rectangles()."""
+    if not header.get("rects_length"):
+        return np.zeros((0, 4), dtype="<i2")
+    f.seek(header["rects_start"])
+    return np.frombuffer(zlib.decompress(f.read(header["rects_length"])), dtype="<i2").reshape(-1, 4)
+
+
+def read_block_hashes(f, header):
+    """Returns (first block x, first block z, hashes) of the mapblocks stored in a map.dat file, or None if it has none."""
+    if "hashes_start" not in header:
+        return None
+    f.seek(header["hashes_start"])
+    grid = f.read(8)
+    if len(grid) < 8:
+        return None
+    first_x, first_z = np.frombuffer(grid[:4], dtype="<i2").tolist()
+    count_x, count_z = np.frombuffer(grid[4:], dtype="<u2").tolist()
+    hashes = np.frombuffer(f.read(8 * count_x * count_z), dtype="<u8").reshape(count_z, count_x)
+    return first_x, first_z, hashes.astype(np.uint64)
+
+
+def read_origin(f, header):
+    """Returns (EPSG:25832 x, y of the first column and row, subtracted height) of a map.dat file, or None if it has none."""
+    if read_block_hashes(f, header) is None:
+        return None
+    origin = f.read(10)
+    if len(origin) < 10:
+        return None
+    return tuple(np.frombuffer(origin[:8], dtype="<i4").tolist()) + (int(np.frombuffer(origin[8:], dtype="<i2")[0]),)
+
+
+def _compress_region(region, level):
+    return zlib.compress(region.tobytes(), level) if region.any() else b""
+
+
+def _write_head(f, layer_count, spawn_height, grid, changed_blocks):
+    """Writes everything up to the regions, grid are the 2 byte fields from offset x on. Returns the position of the index."""
+    f.write(to_bytes(VERSION, 1))
+    f.write(to_bytes(VERSION, 1))  # minimum compatible version
+    f.write(to_bytes(layer_count, 1))
+    f.write(to_bytes(spawn_height, 1))
+    for value in grid:
+        f.write(to_bytes(value, 2))
+    if changed_blocks is not None and len(changed_blocks):
+        rects = zlib.compress(block_rectangles(changed_blocks).astype("<i2").tobytes(), 9)
+        changed_blocks = zlib.compress(np.asarray(changed_blocks).astype("<i2").tobytes(), 9)
+    else:
+        changed_blocks = rects = b""
+    f.write(to_bytes(len(changed_blocks), 4))
+    f.write(to_bytes(len(rects), 4))
+    # the index is written once all regions are compressed
+    index_pos = f.tell()
+    f.write(bytes(4 * (grid[-1] * grid[-2] + 1)))
+    f.write(changed_blocks)
+    f.write(rects)
+    return index_pos
+
+
+def _write_tail(f, index_pos, offsets, first_x, first_z, hashes, origin):
+    """Writes the hashes and the origin after the regions and the index of the regions."""
+    if offsets[-1] >= 2**32:
+        raise ValueError("map is too large for map.dat")
+    f.write(np.array([first_x, first_z], dtype="<i2").tobytes() + np.array(hashes.shape[::-1], dtype="<u2").tobytes())
+    f.write(hashes.astype("<u8").tobytes())
+    f.write(np.array(origin[:2], dtype="<i4").tobytes() + np.array(origin[2:], dtype="<i2").tobytes())
+    end = f.tell()
+    f.seek(index_pos)
+    f.write(np.array(offsets, dtype="<u4").tobytes())
+    f.seek(end)
+
+
+def write_map(f, raster, offset_x, offset_z, spawn_height, changed_blocks, hashes, origin, region_size=REGION_SIZE, level=COMPRESSION_LEVEL, threads=1):
+    """
+    Writes the map raster (height, width, layer count) as map.dat into the file f. changed_blocks is None or an array
+    of the changed mapblocks (block_x, block_z), an empty one is stored like None. hashes are those of block_hashes(),
+    origin is (x, y, subtracted height), see read_origin(). The regions of every row are compressed by a pool of
+    threads, zlib releases the GIL while compressing.
+    """
+    height, width, layer_count = raster.shape
+    pad_x, regions_x = region_grid(width, offset_x, region_size)
+    pad_z, regions_z = region_grid(height, offset_z, region_size)
+    index_pos = _write_head(f, layer_count, spawn_height, (offset_x, offset_z, width, height, region_size, pad_x, pad_z, regions_x, regions_z), changed_blocks)
+
+    offsets = [0]
+    executor = ThreadPoolExecutor(threads) if threads > 1 else None
+    for rz in range(regions_z):
+        band = np.zeros((region_size, regions_x * region_size, layer_count), dtype=np.uint8)
+        y0, y1 = max(rz * region_size - pad_z, 0), min((rz + 1) * region_size - pad_z, height)
+        with raster.tile((0, y0, width, y1), writable=False) as rows:
+            band[y0 - (rz * region_size - pad_z):y1 - (rz * region_size - pad_z), pad_x:pad_x + width] = rows
+        regions = [band[:, rx * region_size:(rx + 1) * region_size] for rx in range(regions_x)]
+        levels = [level] * regions_x
+        for data in (executor.map if executor is not None else map)(_compress_region, regions, levels):
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    if executor is not None:
+        executor.shutdown()
+    _write_tail(f, index_pos, offsets, block_grid(width, offset_x)[0], block_grid(height, offset_z)[0], hashes, origin)
+
+
+def splice_map(path, x, y, patch, origin, level=COMPRESSION_LEVEL):
+    """
+    Replaces the map array of the version 2 or newer map.dat at path with patch (rows, columns, layer count), whose
+    upper left corner is at column x and row y. Only the regions overlapping the patch are decompressed and compressed
+    again, all others are copied. Returns the mapblocks (block_x, block_z) which changed, sorted by x and then z;
+    they are stored as incremental data of the new file. The file has to contain the hashes of its mapblocks, which
+    are updated, and as many layers as the patch.
+    """
+    with open(path, "rb") as f:
+        header = read_header(f)
+        if header["version"] < 2:
+            raise ValueError(f"{path} has version {header['version']}, regions can only be replaced from version 2 on")
+        if header["layer_count"] != patch.shape[2]:
+            raise ValueError(f"{path} has {header['layer_count']} layers, the patch has {patch.shape[2]}")
+        hashes = read_block_hashes(f, header)
+        if hashes is None:
+            raise ValueError(f"{path} has no mapblock hashes, they can't be updated without reading the whole map")
+        x0, y0, x1, y1 = x, y, x + patch.shape[1], y + patch.shape[0]
+        if x0 < 0 or y0 < 0 or x1 > header["width"] or y1 > header["height"]:
+            raise ValueError(f"the window ({x0}, {y0}) - ({x1}, {y1}) is not inside the map of {path}")
+        offset_x, offset_z = header["offset_x"], header["offset_z"]
+
+        # the mapblocks overlapping the patch, before and after
+        first_x, pad_x, _ = block_grid(header["width"], offset_x)
+        first_z, pad_z, _ = block_grid(header["height"], offset_z)
+        bx0, bz0 = (x0 + pad_x) // BLOCK_SIZE, (y0 + pad_z) // BLOCK_SIZE
+        bx1, bz1 = -(-(x1 + pad_x) // BLOCK_SIZE), -(-(y1 + pad_z) // BLOCK_SIZE)
+        blocks_window = (bx0 * BLOCK_SIZE - pad_x, bz0 * BLOCK_SIZE - pad_z, bx1 * BLOCK_SIZE - pad_x, bz1 * BLOCK_SIZE - pad_z)
+        old = read_window(f, header, blocks_window)
+        new = old.copy()
+        new[y0 - blocks_window[1]:y1 - blocks_window[1], x0 - blocks_window[0]:x1 - blocks_window[0]] = patch
+        old_hashes, new_hashes = _hash_aligned(old), _hash_aligned(new)
+        hashes = hashes[2].copy()
+        hashes[bz0:bz1, bx0:bx1] = new_hashes
+        changed = diff_block_hashes(first_x + bx0, first_z + bz0, new_hashes, first_x + bx0, first_z + bz0, old_hashes)
+
+        # the regions overlapping the patch
+        size = header["region_size"]
+        replaced = {}
+        for rz in range((y0 + header["pad_z"]) // size, (y1 - 1 + header["pad_z"]) // size + 1):
+            for rx in range((x0 + header["pad_x"]) // size, (x1 - 1 + header["pad_x"]) // size + 1):
+                rx0, rz0 = rx * size - header["pad_x"], rz * size - header["pad_z"]
+                region = read_region(f, header, rx, rz).copy()
+                ox0, oy0, ox1, oy1 = max(x0, rx0), max(y0, rz0), min(x1, rx0 + size), min(y1, rz0 + size)
+                region[oy0-rz0:oy1-rz0, ox0-rx0:ox1-rx0] = patch[oy0-y0:oy1-y0, ox0-x0:ox1-x0]
+                replaced[rz * header["regions_x"] + rx] = _compress_region(region, level)
+
+        # the new file is written next to the old one and replaces it when complete
+        grid = [header[key] for key in ("offset_x", "offset_z", "width", "height", "region_size", "pad_x", "pad_z", "regions_x", "regions_z")]
+        tmp_path = path + ".splice"
+        with open(tmp_path, "wb") as out:
+            index_pos = _write_head(out, header["layer_count"], header["spawn_height"], grid, changed)
+            offsets = [0]
+            index = header["index"]
+            i = 0
+            while i < len(index) - 1:
+                if i in replaced:
+                    data = replaced[i]
+                    out.write(data)
+                    offsets.append(offsets[-1] + len(data))
+                    i += 1
+                    continue
+                # copy the following unchanged regions at once
+                j = i
+                while j < len(index) - 1 and j not in replaced:
+                    j += 1
+                f.seek(header["regions_start"] + index[i])
+                remaining = index[j] - index[i]
+                while remaining > 0:
+                    chunk = f.read(min(remaining, _COPY_CHUNK_SIZE))
+                    out.write(chunk)
+                    remaining -= len(chunk)
+                offsets.extend((offsets[-1] + index[i+1:j+1] - index[i]).tolist())
+                i = j
+            _write_tail(out, index_pos, offsets, first_x, first_z, hashes, origin)
+    os.replace(tmp_path, path)
+    return changed
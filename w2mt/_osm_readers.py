@@ -0,0 +1,412 @@
+"""
+Readers of the OSM input of parse_features_osm.py, which all yield elements like those of Overpass osm.json files:
+an incremental parser of osm.json files too large to load at once, OSM XML (.osm) and OSM PBF (.osm.pbf).
+
+The PBF decoder is a minimal one (cf. https://wiki.openstreetmap.org/wiki/PBF_Format) without any protobuf dependency.
+The file is a sequence of blobs, each preceded by its length and a BlobHeader. Blobs are decompressed and decoded
+independently, hence this work is spread over a process pool block by block, while the results are yielded in file order.
+"""
+import json
+import lzma
+import zlib
+
+
+JSON_CHUNK_SIZE = 1 << 20
+JSON_WHITESPACE = " \t\n\r"
+JSON_DELIMITERS = JSON_WHITESPACE + ",:]}"
+
+
+class OverpassJSONStream:
+    """
+    Incremental reader for Overpass osm.json files.
+
+    Reads the file in chunks and decodes the entries of the top level "elements" array one by one,
+    hence the whole document is never held in memory. All other top level entries (version, osm3s, ...)
+    are decoded while searching for "elements" and stored in `header`.
+    """
+
+    def __init__(self, file, chunk_size=JSON_CHUNK_SIZE):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+        self.header = {}
+        self._find_elements()
+
+    def _fill(self):
+        # drop everything already decoded and append the next chunk
+        chunk = self.file.read(self.chunk_size)
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        if not chunk:
+            self.eof = True
+        return bool(chunk)
+
+    def _next_char(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in JSON_WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._fill():
+                raise ValueError("unexpected end of JSON data")
+
+    def _expect(self, char):
+        if self._next_char() != char:
+            raise ValueError(f"expected '{char}' at offset {self.pos}, found '{self.buf[self.pos]}'")
+        self.pos += 1
+
+    def _decode(self):
+        self._next_char()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if not self._fill():
+                    raise
+                continue
+            # a number at the end of the buffer (e.g. "0." of "0.6") might continue in the next chunk
+            if not self.eof and (end == len(self.buf) or self.buf[end] not in JSON_DELIMITERS):
+                self._fill()
+                continue
+            self.pos = end
+            return value
+
+    def _find_elements(self):
+        self._expect("{")
+        while True:
+            key = self._decode()
+            self._expect(":")
+            if key == "elements":
+                self._expect("[")
+                return
+            self.header[key] = self._decode()
+            if self._next_char() != ",":
+                raise ValueError("no 'elements' found in JSON data")
+            self.pos += 1
+
+    def __iter__(self):
+        if self._next_char() == "]":
+            self.pos += 1
+            return
+        while True:
+            yield self._decode()
+            char = self._next_char()
+            self.pos += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(f"expected ',' or ']' after element, found '{char}'")
+
+
+##### OSM XML: ############
+
+def read_osm_xml(file):
+    """
+    Yields the nodes, ways and relations of an .osm XML file as dicts in the same format as Overpass JSON elements.
+    The file is parsed incrementally and every element is released after it has been yielded. Raises ValueError
+    if the file is not valid OSM XML.
+    """
+    import xml.etree.ElementTree as ET
+
+    try:
+        context = ET.iterparse(file, events=("start", "end"))
+        _, root = next(context)
+        for event, elem in context:
+            if event != "end" or elem.tag not in ("node", "way", "relation"):
+                continue
+            try:
+                e = {"type": elem.tag, "id": int(elem.get("id"))}
+                if elem.tag == "node":
+                    e["lat"] = float(elem.get("lat"))
+                    e["lon"] = float(elem.get("lon"))
+                elif elem.tag == "way":
+                    e["nodes"] = [int(nd.get("ref")) for nd in elem.iter("nd")]
+                else:
+                    e["members"] = [{"type": m.get("type"), "ref": int(m.get("ref")), "role": m.get("role", "")} for m in elem.iter("member")]
+            except (TypeError, ValueError) as err:
+                raise ValueError(f"invalid {elem.tag} {elem.get('id')} in OSM XML: {err}") from err
+            tags = {tag.get("k"): tag.get("v") for tag in elem.iter("tag")}
+            if tags:
+                e["tags"] = tags
+            yield e
+            root.clear()
+    except ET.ParseError as err:
+        raise ValueError(f"invalid OSM XML: {err}") from err
+
+
+##### OSM PBF: ############
+
+PBF_SUPPORTED_FEATURES = {"OsmSchema-V0.6", "DenseNodes"}
+PBF_MEMBER_TYPES = ("node", "way", "relation")
+
+
+def _varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7f) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _zigzag(n):
+    return (n >> 1) ^ -(n & 1)
+
+
+def _int64(n):
+    return n - (1 << 64) if n >= (1 << 63) else n
+
+
+def _fields(buf):
+    """Yields (field number, value) of all fields of a protobuf message. Length delimited values are bytes."""
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        key, pos = _varint(buf, pos)
+        wire_type = key & 7
+        if wire_type == 0:
+            value, pos = _varint(buf, pos)
+        elif wire_type == 2:
+            length, pos = _varint(buf, pos)
+            value = buf[pos:pos+length]
+            pos += length
+            if pos > end:
+                raise ValueError("truncated protobuf message")
+        elif wire_type == 1:
+            value = buf[pos:pos+8]
+            pos += 8
+        elif wire_type == 5:
+            value = buf[pos:pos+4]
+            pos += 4
+        else:
+            raise ValueError(f"unsupported protobuf wire type {wire_type}")
+        yield key >> 3, value
+
+
+def _packed(buf):
+    values = []
+    pos = 0
+    end = len(buf)
+    while pos < end:
+        value, pos = _varint(buf, pos)
+        values.append(value)
+    return values
+
+
+def _delta_decode(values):
+    res = []
+    last = 0
+    for v in values:
+        last += _zigzag(v)
+        res.append(last)
+    return res
+
+
+def _tags(keys, vals, strings):
+    return {strings[k]: strings[v] for k, v in zip(keys, vals)}
+
+
+def _decode_blob(blob):
+    for field, value in _fields(blob):
+        if field == 1:
+            return value
+        elif field == 3:
+            return zlib.decompress(value)
+        elif field == 4:
+            return lzma.decompress(value)
+    raise ValueError("unsupported PBF blob compression")
+
+
+def _decode_dense_nodes(dense, strings, granularity, lat_offset, lon_offset):
+    ids = lats = lons = keys_vals = []
+    for field, value in _fields(dense):
+        if field == 1:
+            ids = _delta_decode(_packed(value))
+        elif field == 8:
+            lats = _delta_decode(_packed(value))
+        elif field == 9:
+            lons = _delta_decode(_packed(value))
+        elif field == 10:
+            keys_vals = _packed(value)
+    elements = []
+    kv = 0
+    for id_, lat, lon in zip(ids, lats, lons):
+        # integer division by 1e9 is correctly rounded, i.e. equals parsing the decimal representation
+        e = {"type": "node", "id": id_, "lat": (lat_offset + granularity * lat) / 1e9, "lon": (lon_offset + granularity * lon) / 1e9}
+        if keys_vals:
+            tags = {}
+            while keys_vals[kv] != 0:
+                tags[strings[keys_vals[kv]]] = strings[keys_vals[kv+1]]
+                kv += 2
+            kv += 1
+            if tags:
+                e["tags"] = tags
+        elements.append(e)
+    return elements
+
+
+def _decode_node(data, strings, granularity, lat_offset, lon_offset):
+    keys = vals = []
+    for field, value in _fields(data):
+        if field == 1:
+            id_ = _zigzag(value)
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 8:
+            lat = _zigzag(value)
+        elif field == 9:
+            lon = _zigzag(value)
+    e = {"type": "node", "id": id_, "lat": (lat_offset + granularity * lat) / 1e9, "lon": (lon_offset + granularity * lon) / 1e9}
+    if keys:
+        e["tags"] = _tags(keys, vals, strings)
+    return e
+
+
+def _decode_way(data, strings):
+    keys = vals = refs = []
+    for field, value in _fields(data):
+        if field == 1:
+            id_ = _int64(value)
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 8:
+            refs = _delta_decode(_packed(value))
+    e = {"type": "way", "id": id_, "nodes": refs}
+    if keys:
+        e["tags"] = _tags(keys, vals, strings)
+    return e
+
+
+def _decode_relation(data, strings):
+    keys = vals = roles = memids = types = []
+    for field, value in _fields(data):
+        if field == 1:
+            id_ = _int64(value)
+        elif field == 2:
+            keys = _packed(value)
+        elif field == 3:
+            vals = _packed(value)
+        elif field == 8:
+            roles = _packed(value)
+        elif field == 9:
+            memids = _delta_decode(_packed(value))
+        elif field == 10:
+            types = _packed(value)
+    members = [{"type": PBF_MEMBER_TYPES[t], "ref": ref, "role": strings[role]} for role, ref, t in zip(roles, memids, types)]
+    e = {"type": "relation", "id": id_, "members": members}
+    if keys:
+        e["tags"] = _tags(keys, vals, strings)
+    return e
+
+
+def decode_pbf_block(blob_type, blob):
+    """Decompresses and decodes one PBF blob. Returns the list of its elements."""
+    data = _decode_blob(blob)
+    if blob_type == "OSMHeader":
+        for field, value in _fields(data):
+            if field == 4 and value.decode("utf-8") not in PBF_SUPPORTED_FEATURES:
+                raise ValueError(f"PBF file requires unsupported feature {value.decode('utf-8')}")
+        return []
+    if blob_type != "OSMData":
+        return []  # unknown blob types are to be skipped according to the specification
+
+    strings = []
+    groups = []
+    granularity = 100
+    lat_offset = lon_offset = 0
+    for field, value in _fields(data):
+        if field == 1:
+            strings = [s.decode("utf-8") for f, s in _fields(value) if f == 1]
+        elif field == 2:
+            groups.append(value)
+        elif field == 17:
+            granularity = value
+        elif field == 19:
+            lat_offset = _int64(value)
+        elif field == 20:
+            lon_offset = _int64(value)
+
+    elements = []
+    for group in groups:
+        for field, value in _fields(group):
+            if field == 1:
+                elements.append(_decode_node(value, strings, granularity, lat_offset, lon_offset))
+            elif field == 2:
+                elements.extend(_decode_dense_nodes(value, strings, granularity, lat_offset, lon_offset))
+            elif field == 3:
+                elements.append(_decode_way(value, strings))
+            elif field == 4:
+                elements.append(_decode_relation(value, strings))
+    return elements
+
+
+def _decode_pbf_block_at(offset, blob_type, blob):
+    """decode_pbf_block(), raising ValueError with the position of the blob in the file for any invalid data."""
+    try:
+        return decode_pbf_block(blob_type, blob)
+    except (IndexError, ValueError, UnicodeDecodeError, zlib.error, lzma.LZMAError) as e:
+        raise ValueError(f"invalid PBF blob at byte {offset}: {e}") from e
+
+
+def _read_pbf_blobs(file):
+    """Yields (offset, type, blob) of all blobs of a PBF file. Raises ValueError if the file is truncated."""
+    offset = 0
+    while True:
+        length = file.read(4)
+        if not length:
+            return
+        header_length = int.from_bytes(length, "big")
+        header = file.read(header_length)
+        if len(length) < 4 or len(header) < header_length:
+            raise ValueError(f"PBF file is truncated, blob header at byte {offset}")
+        blob_type = None
+        datasize = 0
+        try:
+            for field, value in _fields(header):
+                if field == 1:
+                    blob_type = value.decode("utf-8")
+                elif field == 3:
+                    datasize = value
+        except (IndexError, ValueError) as e:
+            raise ValueError(f"invalid PBF blob header at byte {offset}: {e}") from e
+        blob = file.read(datasize)
+        if len(blob) < datasize:
+            raise ValueError(f"PBF file is truncated, blob at byte {offset}")
+        yield offset, blob_type, blob
+        offset += 4 + header_length + datasize
+
+
+def read_osm_pbf(file, workers=1):
+    """
+    Yields the nodes, ways and relations of an .osm.pbf file (opened in binary mode) as dicts in the same format
+    as Overpass JSON elements. With workers > 1, blobs are decompressed and decoded in a process pool. Raises
+    ValueError if the file is truncated or contains invalid data.
+    """
+    blobs = _read_pbf_blobs(file)
+    if workers <= 1:
+        for offset, blob_type, blob in blobs:
+            yield from _decode_pbf_block_at(offset, blob_type, blob)
+        return
+
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+
+    with ProcessPoolExecutor(workers) as executor:
+        # only keep a few blobs per worker in flight, so memory does not grow with the file size
+        pending = deque()
+        for offset, blob_type, blob in blobs:
+            pending.append(executor.submit(_decode_pbf_block_at, offset, blob_type, blob))
+            if len(pending) >= 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
@@ -0,0 +1,84 @@
+"""
+Content addressed cache for the features files generated by parse_features_osm.py.
+
+Entries are keyed by a hash of the input file, the classification rules (rules.json) and the parser itself,
+hence changing any of them results in a new entry instead of stale features. Entries are evicted least
+recently used first as soon as the cache grows beyond its size limit.
+"""
+import hashlib
+import os
+import shutil
+
+
+# the parser version is the content of its sources, so every change of the code invalidates the cache
+PARSER_FILES = ("parse_features_osm.py", "_osm_readers.py", "_features.py", "_util.py", "rules.json")
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "world2minetest", "features")
+DEFAULT_CACHE_SIZE_MB = 2048
+
+_HASH_CHUNK_SIZE = 1 << 20
+
+
+def _hash_file(h, path):
+    with open(path, "rb") as f:
+        while chunk := f.read(_HASH_CHUNK_SIZE):
+            h.update(chunk)
+
+
+def cache_key(input_path, *options):
+    """Returns the key for parsing input_path with the current rules and parser, and the given options (e.g. output format)."""
+    h = hashlib.sha256()
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    for name in PARSER_FILES:
+        h.update(name.encode("utf-8") + b"\0")
+        _hash_file(h, os.path.join(base_dir, name))
+    for option in options:
+        h.update(str(option).encode("utf-8") + b"\0")
+    h.update(b"input\0")
+    _hash_file(h, input_path)
+    return h.hexdigest()
+
+
+class ParseCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE_MB * 1024 * 1024):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+
+    def _entry(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, output_path):
+        """Places the cached features for key at output_path. Returns False if there is no such entry."""
+        entry = self._entry(key)
+        if not os.path.exists(entry):
+            return False
+        # a copy and not a link, since the parser overwrites the output file in place
+        shutil.copyfile(entry, output_path)
+        os.utime(entry)  # mark as recently used
+        return True
+
+    def put(self, key, features_path):
+        """Stores a copy of features_path as entry for key and evicts old entries if the cache is too large."""
+        entry = self._entry(key)
+        tmp = f"{entry}.{os.getpid()}.tmp"
+        shutil.copyfile(features_path, tmp)
+        os.replace(tmp, entry)
+        self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp") or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        # the most recently used entry is kept, even if it exceeds the limit on its own
+        for _, size, path in entries[:-1]:
+            if total <= self.max_size:
+                break
+            os.remove(path)
+            total -= size
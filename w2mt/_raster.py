@@ -0,0 +1,307 @@
+"""
+Vectorized rasterization of features into the map array of generate_map.py.
+Coordinates are already shifted into the array, i.e. x is the column and y the row.
+"""
+import numpy as np
+
+
+def in_window(xx, yy, window):
+    """Returns which of the pixels (xx, yy) are inside window (x0, y0, x1, y1)."""
+    x0, y0, x1, y1 = window
+    return (x0 <= xx) & (xx < x1) & (y0 <= yy) & (yy < y1)
+
+
+def segment_pixels(x1, y1, x2, y2):
+    """
+    Returns (xx, yy, segment) of all pixels of the lines (x1, y1)-(x2, y2), segment is the index of the line the pixel
+    belongs to. The pixels of every line are the same as those of skimage.draw.line (Bresenham), but all lines are
+    computed at once: along the major axis, step i of a line with deltas (d_major, d_minor) is at minor offset
+    floor((2*d_minor*i + d_major) / (2*d_major)).
+    """
+    dx = np.abs(x2 - x1)
+    dy = np.abs(y2 - y1)
+    steep = dy > dx
+    d_major = np.where(steep, dy, dx)
+    d_minor = np.where(steep, dx, dy)
+
+    counts = d_major + 1
+    segment = np.repeat(np.arange(len(x1)), counts)
+    starts = np.cumsum(counts) - counts
+    i = np.arange(counts.sum()) - np.repeat(starts, counts)
+    d_major_ = d_major[segment]
+    minor = (2 * d_minor[segment] * i + d_major_) // np.maximum(2 * d_major_, 1)
+
+    steep_ = steep[segment]
+    step_x = np.where(steep_, minor, i) * np.sign(x2 - x1)[segment]
+    step_y = np.where(steep_, i, minor) * np.sign(y2 - y1)[segment]
+    return x1[segment] + step_x, y1[segment] + step_y, segment
+
+
+def polyline_pixels(xs, ys):
+    """Returns (xx, yy, segment) of all pixels of the lines between consecutive points, see segment_pixels()."""
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    if len(xs) < 2:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    return segment_pixels(xs[:-1], ys[:-1], xs[1:], ys[1:])
+
+
+def polylines_pixels(polylines, window=None):
+    """
+    Returns (xx, yy, index) of the pixels of all polylines (a list of (xs, ys)), index is the position of the polyline
+    in the list. With a window (x0, y0, x1, y1), only the pixels x0 <= x < x1, y0 <= y < y1 are returned.
+    """
+    if not polylines:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    lengths = np.array([len(xs) for xs, _ in polylines])
+    xs = np.concatenate([np.asarray(xs, dtype=np.int64) for xs, _ in polylines])
+    ys = np.concatenate([np.asarray(ys, dtype=np.int64) for _, ys in polylines])
+    return joined_polylines_pixels(xs, ys, lengths, window)
+
+
+def joined_polylines_pixels(xs, ys, lengths, window=None):
+    """Like polylines_pixels(), for polylines given as concatenated coordinates and the number of points of every polyline."""
+    xx, yy, segment = polyline_pixels(xs, ys)
+    point_index = np.repeat(np.arange(len(lengths)), lengths)
+    # the line from the last point of a polyline to the first point of the next one belongs to neither
+    keep = point_index[segment] == point_index[segment + 1]
+    if window is not None:
+        keep &= in_window(xx, yy, window)
+    return xx[keep], yy[keep], point_index[segment[keep]]
+
+
+_BRUSHES = {
+    # a disc can't be two pixels wide, hence width 2 keeps its own footprint
+    2: (np.array([0, -1, 0]), np.array([1, 0, 0])),
+}
+
+
+def brush(width):
+    """Returns the (dx, dy) offsets of all pixels drawn around each pixel of a line of the given width."""
+    if width in _BRUSHES:
+        return _BRUSHES[width]
+    # disc of radius (width-1)/2 around the pixel: width 3 is a cross, 4 a 3x3 square, 5 and 6 round 5x5 shapes
+    r = (width - 1) // 2 + 1
+    dy, dx = np.mgrid[-r:r+1, -r:r+1]
+    inside = 4 * (dx*dx + dy*dy) <= (width - 1) ** 2
+    _BRUSHES[width] = (dx[inside], dy[inside])
+    return _BRUSHES[width]
+
+
+def thick_polyline(xs, ys, width, window):
+    """
+    Returns (xx, yy, segment) of all pixels of a polyline of the given width inside window (x0, y0, x1, y1).
+    Every pixel is contained once per segment, sorted by segment. Segments further away from the window than
+    the width aren't rasterized at all.
+    """
+    xs = np.asarray(xs, dtype=np.int64)
+    ys = np.asarray(ys, dtype=np.int64)
+    x0, y0, x1, y1 = window
+    r = width // 2 + 1
+    near = ((np.minimum(xs[:-1], xs[1:]) < x1 + r) & (np.maximum(xs[:-1], xs[1:]) >= x0 - r) &
+            (np.minimum(ys[:-1], ys[1:]) < y1 + r) & (np.maximum(ys[:-1], ys[1:]) >= y0 - r))
+    near = np.flatnonzero(near)
+    xx, yy, segment = segment_pixels(xs[near], ys[near], xs[near + 1], ys[near + 1])
+    segment = near[segment]
+    if width > 1:
+        dx, dy = brush(width)
+        xx = (xx[:, None] + dx).ravel()
+        yy = (yy[:, None] + dy).ravel()
+        segment = np.repeat(segment, len(dx))
+    inside = in_window(xx, yy, window)
+    xx, yy, segment = xx[inside], yy[inside], segment[inside]
+    if width == 1:
+        return xx, yy, segment
+    # unique pixels per segment
+    w, h = x1 - x0, y1 - y0
+    key = np.unique((segment * h + (yy - y0)) * w + (xx - x0))
+    segment, pixel = np.divmod(key, h * w)
+    yy, xx = np.divmod(pixel, w)
+    return xx + x0, yy + y0, segment
+
+
+def _crossing_spans(index, xi, yi, xj, yj, lower):
+    """
+    Crossings of the edges (xi, yi)-(xj, yj) with the columns between their ends, sorted and paired up per polygon
+    and column. Returns the spans (index, column, y_start, y_end) between the crossings of each pair.
+    Columns min(xi, xj) <= x < max(xi, xj) are crossed, or min < x <= max if lower.
+    """
+    counts = np.abs(xj - xi)
+    edge = np.repeat(np.arange(len(xi)), counts)
+    column = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + np.minimum(xi, xj)[edge] + lower
+    xi_, yi_ = xi[edge].astype(np.float64), yi[edge].astype(np.float64)
+    crossing = (yj[edge] - yi_) * (column - xi_) / (xj[edge] - xi_) + yi_
+
+    index = index[edge]
+    order = np.lexsort((crossing, column, index))
+    index, column, crossing = index[order][::2], column[order][::2], crossing[order]
+    if lower:
+        # pixels with an odd number of crossings below them: s_1 < y <= s_2, ...
+        y_start = np.floor(crossing[::2]).astype(np.int64) + 1
+        y_end = np.floor(crossing[1::2]).astype(np.int64) + 1
+    else:
+        # pixels with an odd number of crossings above them: t_1 <= y < t_2, ...
+        y_start = np.ceil(crossing[::2]).astype(np.int64)
+        y_end = np.ceil(crossing[1::2]).astype(np.int64)
+    return index, column, y_start, y_end
+
+
+def polygon_pixels(polygons, window=None):
+    """
+    Scan converts all polygons (a list of (xs, ys)) at once and returns (xx, yy, index, rank) of their pixels, index is
+    the position of the polygon in the list. Pixels are sorted by index, x and y, rank is the position of a pixel in
+    this order among all pixels of its polygon. With a window (x0, y0, x1, y1), only the pixels x0 <= x < x1,
+    y0 <= y < y1 are returned, with the same ranks as without.
+
+    The edges of all polygons form one table of (index, column, crossing) entries, which is sorted and paired up into
+    spans, hence the work grows with the length of the edges instead of the size of the bounding boxes. The pixels are
+    the same as those of skimage.draw.polygon(xs, ys), which uses the crossing test of O'Rourke: a pixel is drawn if it
+    is a vertex, or if the number of edge crossings above or the number of edge crossings below it is odd (the latter
+    only differs on the boundary).
+    """
+    if not polygons:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+    lengths = np.array([len(xs) for xs, _ in polygons])
+    xi = np.concatenate([np.asarray(xs, dtype=np.int64) for xs, _ in polygons])
+    yi = np.concatenate([np.asarray(ys, dtype=np.int64) for _, ys in polygons])
+    # every point i is connected to its predecessor j, the first point to the last one
+    starts = np.cumsum(lengths) - lengths
+    j = np.arange(len(xi)) - 1
+    j[starts] = starts + lengths - 1
+    xj, yj = xi[j], yi[j]
+    vertex_index = np.repeat(np.arange(len(polygons)), lengths)
+
+    spans = [_crossing_spans(vertex_index, xi, yi, xj, yj, lower) for lower in (0, 1)]
+    spans.append((vertex_index, xi, yi, yi + 1))
+    index, column, y_start, y_end = (np.concatenate(s) for s in zip(*spans))
+
+    # merge overlapping spans of the same polygon and column, so every pixel is drawn once
+    order = np.lexsort((y_start, column, index))
+    index, column, y_start, y_end = index[order], column[order], y_start[order], y_end[order]
+    group = np.concatenate(([0], np.cumsum((np.diff(index) != 0) | (np.diff(column) != 0))))
+    # keys of the spans of later groups are larger than those of earlier ones, also for rows outside of the map
+    y_min = int(min(y_start.min(), 0))
+    stride = int(max(y_end.max(), 0)) - y_min + 1
+    start_key = group * stride + y_start - y_min
+    end_key = np.maximum.accumulate(group * stride + y_end - y_min)
+    first = np.ones(len(index), dtype=bool)
+    first[1:] = start_key[1:] > end_key[:-1]
+    last = np.ones(len(index), dtype=bool)
+    last[:-1] = first[1:]
+    index, column, y_start = index[first], column[first], y_start[first]
+    y_end = end_key[last] - group[last] * stride + y_min
+
+    counts = np.maximum(y_end - y_start, 0)
+    offset = np.cumsum(counts) - counts
+    first = np.maximum.accumulate(np.where(np.diff(index, prepend=-1) != 0, np.arange(len(index)), 0))
+    rank_start = offset - offset[first]
+    if window is not None:
+        x0, y0, x1, y1 = window
+        inside = (x0 <= column) & (column < x1)
+        index, column, y_start, y_end, rank_start = index[inside], column[inside], y_start[inside], y_end[inside], rank_start[inside]
+        clipped_start = np.clip(y_start, y0, y1)
+        rank_start = rank_start + clipped_start - y_start
+        y_start, y_end = clipped_start, np.clip(y_end, y0, y1)
+        counts = np.maximum(y_end - y_start, 0)
+
+    span = np.repeat(np.arange(len(counts)), counts)
+    step = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return column[span], y_start[span] + step, index[span], rank_start[span] + step
+
+
+def top_index(shape, xx, yy, index):
+    """Returns an array of the given shape with the highest index drawn at every pixel, -1 where nothing was drawn."""
+    label = np.full(shape[0] * shape[1], -1, dtype=np.int32)
+    np.maximum.at(label, yy * shape[1] + xx, index)
+    return label.reshape(shape[:2])
+
+
+def overlap_sums(values, labels, xx, yy, count):
+    """
+    Adds up the values of every label 0..count-1 for features which are written one after the other in the order of
+    their labels, each replacing the values of its pixels by one value derived from their mean. A pixel which an
+    earlier label covers has the value written by the last such label instead of its value, hence only the other
+    pixels are added up. Returns (sums and counts of the labels as one array, keys label * count + earlier label of the
+    covered pixels, how often every key occurs). Those of several parts of the map are combined with
+    merge_overlap_sums(), see sequential_values().
+    """
+    order = np.lexsort((labels, xx, yy))
+    xx, yy, labels, values = xx[order], yy[order], labels[order], values[order]
+    first_of_pixel = np.ones(len(labels), dtype=bool)
+    first_of_pixel[1:] = (xx[1:] != xx[:-1]) | (yy[1:] != yy[:-1])
+    first_of_label = first_of_pixel.copy()
+    first_of_label[1:] |= labels[1:] != labels[:-1]
+    # a pixel contained several times in one label gets the value written before that label every time
+    label_start = np.maximum.accumulate(np.where(first_of_label, np.arange(len(labels)), 0))
+    covered = ~first_of_pixel[label_start]
+    earlier = labels[label_start[covered] - 1]
+    sums = np.stack((np.bincount(labels[~covered], weights=values[~covered], minlength=count), np.bincount(labels, minlength=count)))
+    keys, key_counts = np.unique(labels[covered].astype(np.int64) * count + earlier, return_counts=True)
+    return sums, keys, key_counts
+
+
+def merge_overlap_sums(sums, other):
+    return sums[0] + other[0], np.concatenate((sums[1], other[1])), np.concatenate((sums[2], other[2]))
+
+
+def sequential_values(sums, fn):
+    """
+    Returns the value every label writes, for the results of overlap_sums(): fn(labels, means) returns the values of
+    the labels from their means. This is the same as writing the labels one by one, but labels are computed level by
+    level, where a label is one level above the highest earlier label it depends on.
+    """
+    (totals, counts), keys, key_counts = sums
+    count = len(counts)
+    keys, inverse = np.unique(keys, return_inverse=True)
+    key_counts = np.bincount(inverse.ravel(), weights=key_counts, minlength=len(keys))
+    labels, earlier = np.divmod(keys, count)
+    levels = np.zeros(count, dtype=np.int64)
+    while True:
+        raised = levels.copy()
+        np.maximum.at(raised, labels, levels[earlier] + 1)
+        if (raised == levels).all():
+            break
+        levels = raised
+
+    label_order = np.argsort(levels, kind="stable")
+    key_order = np.argsort(levels[labels], kind="stable")
+    level_range = np.arange(levels.max() + 2 if count else 1)
+    label_starts = np.searchsorted(levels[label_order], level_range)
+    key_starts = np.searchsorted(levels[labels[key_order]], level_range)
+    totals = totals.copy()
+    values = np.zeros(count)
+    for level in range(len(level_range) - 1):
+        selected_keys = key_order[key_starts[level]:key_starts[level + 1]]
+        np.add.at(totals, labels[selected_keys], key_counts[selected_keys] * values[earlier[selected_keys]])
+        selected = label_order[label_starts[level]:label_starts[level + 1]]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            values[selected] = fn(selected, totals[selected] / counts[selected])
+    return values
+
+
+def scatter_last(layer, xx, yy, values):
+    """layer[yy, xx] = values, where a pixel is contained several times the last value wins like with one assignment per feature."""
+    linear = yy * layer.shape[1] + xx
+    # np.unique returns the first occurrence, hence look at the pixels in reverse
+    _, last = np.unique(linear[::-1], return_index=True)
+    last = len(linear) - 1 - last
+    layer[yy[last], xx[last]] = values[last]
+
+
+def reduce_pixels(shape, xx, yy, values, ufunc):
+    """Reduces the values of every pixel with ufunc (e.g. np.maximum). Returns (x, y, reduced value) of all pixels contained."""
+    linear = yy * shape[1] + xx
+    order = np.argsort(linear, kind="stable")
+    linear, values = linear[order], values[order]
+    starts = np.flatnonzero(np.diff(linear, prepend=-1))
+    y, x = np.divmod(linear[starts], shape[1])
+    return x, y, ufunc.reduceat(values, starts)
+
+
+def scatter_max(layer, xx, yy, values):
+    """layer[yy, xx] = max(layer[yy, xx], values), taking the maximum of all values of a pixel contained several times."""
+    x, y, top = reduce_pixels(layer.shape, xx, yy, values, np.maximum)
+    layer[y, x] = np.maximum(layer[y, x], top)
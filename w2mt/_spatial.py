@@ -0,0 +1,61 @@
+"""
+Spatial index over the bounding boxes of features, used by generate_map.py to find the features inside a tile.
+Bounding boxes are (x_min, y_min, x_max, y_max) with inclusive maxima, windows (x0, y0, x1, y1) with exclusive ends.
+"""
+import numpy as np
+
+
+NODE_CAPACITY = 16
+
+
+def _intersect(bounds, window):
+    x0, y0, x1, y1 = window
+    return (bounds[:, 0] < x1) & (bounds[:, 2] >= x0) & (bounds[:, 1] < y1) & (bounds[:, 3] >= y0)
+
+
+def _str_order(bounds, capacity):
+    """Sort-Tile-Recursive order: sqrt(n/capacity) vertical slices by x center, every slice sorted by y center."""
+    count = len(bounds)
+    slices = int(np.ceil(np.sqrt(-(-count // capacity))))
+    slice_size = max(slices, 1) * capacity
+    by_x = np.argsort(bounds[:, 0] + bounds[:, 2], kind="stable")
+    slice_index = np.empty(count, dtype=np.int64)
+    slice_index[by_x] = np.arange(count) // slice_size
+    return np.lexsort((bounds[:, 1] + bounds[:, 3], slice_index))
+
+
+class STRtree:
+    """
+    Static R-tree packed with the Sort-Tile-Recursive algorithm. The boxes are sorted into slices by x and y and
+    grouped into nodes of NODE_CAPACITY entries, which are grouped the same way level by level up to the root.
+    Queries descend level by level, testing all candidate nodes of a level at once.
+    """
+    def __init__(self, bounds, capacity=NODE_CAPACITY):
+        bounds = np.asarray(bounds, dtype=np.int64).reshape(-1, 4)
+        self.order = _str_order(bounds, capacity)
+        self.leaves = bounds[self.order]
+        # from the lowest level up: (bounds of the nodes, start and end of their entries in the level below)
+        self.levels = []
+        entries = self.leaves
+        while len(entries) > capacity:
+            starts = np.arange(0, len(entries), capacity)
+            ends = np.minimum(starts + capacity, len(entries))
+            nodes = np.stack((np.minimum.reduceat(entries[:, 0], starts), np.minimum.reduceat(entries[:, 1], starts),
+                              np.maximum.reduceat(entries[:, 2], starts), np.maximum.reduceat(entries[:, 3], starts)), axis=1)
+            order = _str_order(nodes, capacity)
+            entries = nodes[order]
+            self.levels.append((entries, starts[order], ends[order]))
+
+    def query(self, window):
+        """Returns the positions of the boxes intersecting window (x0, y0, x1, y1), in ascending order."""
+        if self.levels:
+            candidates = np.flatnonzero(_intersect(self.levels[-1][0], window))
+            for level in range(len(self.levels) - 1, -1, -1):
+                _, starts, ends = self.levels[level]
+                counts = ends[candidates] - starts[candidates]
+                entries = np.repeat(starts[candidates] - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+                below = self.levels[level - 1][0] if level > 0 else self.leaves
+                candidates = entries[_intersect(below[entries], window)]
+        else:
+            candidates = np.flatnonzero(_intersect(self.leaves, window))
+        return np.sort(self.order[candidates])
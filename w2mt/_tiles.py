@@ -0,0 +1,131 @@
+"""
+Storage of the map arrays of generate_map.py, which are processed tile by tile.
+
+By default an array is held in memory and consists of a single tile. With a tile size, the array lives in a file
+instead, of which only the rows of the current tile are mapped (np.memmap) while it is processed, hence the memory
+needed is bounded by the tile size instead of the map size.
+"""
+import struct
+import zlib
+from contextlib import contextmanager
+
+import numpy as np
+
+
+# zlib.decompressobj output is limited to this many bytes at once while reading compressed arrays
+_READ_CHUNK_SIZE = 1 << 24
+
+
+class Raster:
+    def __init__(self, shape, path=None, tile_size=None, dtype=np.uint8):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.path = path
+        if path is None:
+            self.array = np.zeros(self.shape, dtype=self.dtype)
+            self.tile_size = tile_size or max(self.shape[0], self.shape[1], 1)
+        else:
+            self.array = None
+            self.tile_size = tile_size
+            with open(path, "wb") as f:
+                # sparse file, all zeros
+                f.truncate(self.shape[0] * self.row_bytes)
+
+    @property
+    def row_bytes(self):
+        return int(np.prod(self.shape[1:])) * self.dtype.itemsize
+
+    @property
+    def tile_counts(self):
+        """Returns the number of tiles along (x, y)."""
+        return -(-self.shape[1] // self.tile_size), -(-self.shape[0] // self.tile_size)
+
+    def windows(self):
+        """Returns the windows (x0, y0, x1, y1) of all tiles, row by row."""
+        t = self.tile_size
+        return [(x0, y0, min(x0+t, self.shape[1]), min(y0+t, self.shape[0]))
+                for y0 in range(0, self.shape[0], t) for x0 in range(0, self.shape[1], t)]
+
+    def tile_of(self, x, y):
+        """Returns the position in windows() of the tiles containing the pixels (x, y)."""
+        return (y // self.tile_size) * self.tile_counts[0] + x // self.tile_size
+
+    @contextmanager
+    def tile(self, window, writable=True):
+        """Yields the part of the array inside window (x0, y0, x1, y1). Changes are written back to the file when done."""
+        x0, y0, x1, y1 = window
+        if self.array is not None:
+            yield self.array[y0:y1, x0:x1]
+            return
+        rows = np.memmap(self.path, dtype=self.dtype, mode="r+" if writable else "r", offset=y0 * self.row_bytes, shape=(y1-y0,) + self.shape[1:])
+        yield rows[:, x0:x1]
+        if writable:
+            rows.flush()
+        # the rows are unmapped as soon as the caller drops the tile as well, so their pages don't count towards
+        # the memory of the process anymore
+        del rows
+
+    def bands(self, reverse=False):
+        """Yields (y0, rows) of full rows, tile_size rows at once from top to bottom (or bottom to top with the rows reversed)."""
+        starts = range(0, self.shape[0], self.tile_size)
+        for y0 in (reversed(starts) if reverse else starts):
+            y1 = min(y0 + self.tile_size, self.shape[0])
+            with self.tile((0, y0, self.shape[1], y1), writable=False) as rows:
+                yield y0, (rows[::-1] if reverse else rows)
+
+    def paste(self, x, y, rows):
+        """Writes the array rows into this array with its upper left corner at (x, y)."""
+        with self.tile((x, y, x + rows.shape[1], y + rows.shape[0])) as tile:
+            tile[...] = rows
+
+
+def read_compressed_rows(data, row_bytes, rows_count):
+    """Yields (y0, rows) of a zlib compressed array of rows_count rows with row_bytes each, a few MB at once."""
+    decompressor = zlib.decompressobj()
+    tail = data
+    band_rows = max(_READ_CHUNK_SIZE // max(row_bytes, 1), 1)
+    pending = b""
+    y0 = 0
+    while y0 < rows_count:
+        wanted = min(band_rows, rows_count - y0) * row_bytes
+        while len(pending) < wanted:
+            chunk = decompressor.decompress(tail, wanted - len(pending))
+            tail = decompressor.unconsumed_tail
+            if not chunk and not tail:
+                chunk = decompressor.flush()
+            if not chunk:
+                raise ValueError("compressed array is too short")
+            pending += chunk
+        band = np.frombuffer(pending[:wanted], dtype=np.uint8).reshape(-1, row_bytes)
+        pending = pending[wanted:]
+        yield y0, band
+        y0 += len(band)
+
+
+def _png_chunk(f, kind, data):
+    f.write(struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data)))
+
+
+def write_png(path, width, height, bands):
+    """
+    Writes an 8 bit png of the given size from bands of rows (top to bottom), which is streamed into the
+    compressor band by band. Rows of shape (width,) are grayscale, rows of shape (width, 4) RGBA.
+    """
+    compressor = zlib.compressobj(6)
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        header_written = False
+        for rows in bands:
+            rows = rows.reshape(len(rows), width, -1)
+            if not header_written:
+                color_type = {1: 0, 4: 6}[rows.shape[2]]
+                _png_chunk(f, b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0))
+                header_written = True
+            # every row starts with its filter type, 0 (none)
+            raw = np.zeros((len(rows), 1 + width * rows.shape[2]), dtype=np.uint8)
+            raw[:, 1:] = rows.reshape(len(rows), -1)
+            chunk = compressor.compress(raw.tobytes())
+            if chunk:
+                _png_chunk(f, b"IDAT", chunk)
+        _png_chunk(f, b"IDAT", compressor.flush())
+        _png_chunk(f, b"IEND", b"")
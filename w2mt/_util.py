@@ -1,3 +1,6 @@
+import json
+import os
+
 import numpy as np
 
 
@@ -19,46 +22,13 @@ def from_bytes(b):
 
 
 
-SURFACES = {
-    # key: id, RGB Color for Minimap
-    "default": [0, [255,239,213, 255]],
-
-    "paving_stones": [1,[132,132,132, 255]],
-    "fine_gravel": [2,[139,134,130, 255]],
-    "concrete": [3,[183,183,183, 255]],
-    "asphalt": [4, [40,40,40, 255]],
-    "dirt": [5,[139,119,101, 255]],
-    
-    "rail": [9, [43,15,3, 255]], # dark brown
-    "highway": [10, [91,91,91, 255]],  # default
-    "footway": [11, [139,137,137, 255]],
-    "service": [12,[216,191,216, 255]],
-    "cycleway": [13, [142,142,142, 255]],
-    "pedestrian": [14,[255,181,197, 255]],
-    "residential": [15,[205,104,137, 255]],
-    "path": [16, [139,90,0, 255]],
-
-    "leisure": [20,[255,165,0, 255]],  # default
-    "park": [21, [46,139,87, 255]],
-    "playground": [22,[238,64,0, 255]],
-    "sports_centre": [23,[255,128,0, 255]],
-    "pitch": [24,[238,64,0, 255]],
-
-    "amenity": [30,[102,139,139, 255]] , # default
-    "school": [31,[125,38,205, 255]],
-    "parking": [32, [139,137,137, 255]],
+RULES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rules.json")
 
-    "landuse": [40,[139,76,57, 255]],  # default
-    "residential_landuse": [41,[94,38,18, 255]],
-    "village_green": [42, [0,238,118, 255]],
+with open(RULES_PATH, encoding="utf-8") as rules_file:
+    RULES = json.load(rules_file)
 
-    "natural": [50,[48,128,20, 255]],  # default
-    "water": [51, [99,184,255, 255]],
 
-    "building_ground": [60, [238,233,233, 255]],
-
-    "grass": [70, [0,205,102, 255]],
-}
+SURFACES = RULES["surfaces"]  # key: [id, RGB Color for Minimap]
 
 SURFACE_COLORS = {}
 
@@ -66,84 +36,116 @@ for s in SURFACES.values():
     SURFACE_COLORS[s[0]] = s[1]
 
 
-DECORATIONS = {
-    "none": 0,  # air
-
-    "natural": 10,  # default
-    "grass": 11,
-    "tree": 12,
-    "leaf_tree": 13,
-    "conifer": 14,
-    "bush": 15,
-
-    # amenity
-    "post_box": 21,
-    "recycling": 22,
-    "vending_machine": 23,
-    "bench": 24,
-    "telephone": 25,
-
-    "barrier": 30,  # default
-    "fence": 31,
-    "wall": 32,
-    "bollard": 33,
-    "gate": 34,
-    "hedge": 35
-}
+DECORATIONS = RULES["decorations"]
+
+
+
+##### CLASSIFICATION: ############
+
+_NO_MATCH = object()
+
+def _fill(template, value):
+    if template == "$value":
+        return value
+    if isinstance(template, list):
+        return tuple(_fill(t, value) for t in template)
+    return template
+
+
+class Classifier:
+    """
+    Compiled form of a classifier from rules.json.
+
+    The rules are compiled once into one dispatch table per tag key (keyed by tag value) and into a generated
+    function that checks the rule keys in order. Classifying an element then only needs one dict lookup per
+    rule key, instead of long if/elif chains with list membership tests.
+    """
+
+    def __init__(self, spec, name="classifier"):
+        self.keys = []
+        self.tables = []
+        namespace = {"NO_MATCH": _NO_MATCH, "fallback": _fill(spec.get("fallback"), None)}
+        lines = [f"def {name}(tags):"]
+        for i, rule in enumerate(spec["rules"]):
+            key = rule["key"]
+            table = {}
+            for names, known in (("surfaces", SURFACES), ("decorations", DECORATIONS)):
+                if names in rule:
+                    for known_name in known:
+                        table[known_name] = _fill(rule[names], known_name)
+            # single values take precedence over surface and decoration names
+            for value, result in rule.get("values", {}).items():
+                table[value] = _fill(result, value)
+            self.keys.append(key)
+            self.tables.append(table)
+            namespace[f"table_{i}"] = table
+
+            lines.append(f"    value = tags.get({key!r})")
+            lines.append(f"    if value is not None:")
+            indent = "        "
+            if "unless" in rule:
+                condition = " or ".join(f"tags.get({k!r}) == {v!r}" for k, v in rule["unless"].items())
+                lines.append(f"        if not ({condition}):")
+                indent += "    "
+            if table:
+                lines.append(f"{indent}result = table_{i}.get(value, NO_MATCH)")
+                lines.append(f"{indent}if result is not NO_MATCH:")
+                lines.append(f"{indent}    return result")
+            elif "unless" in rule:
+                lines.append(f"{indent}pass")
+            if "default" in rule:
+                namespace[f"default_{i}"] = _fill(rule["default"], None)
+                lines.append(f"        return default_{i}")
+        lines.append("    return fallback")
+        self.source = "\n".join(lines)
+        exec(self.source, namespace)
+        self.classify = namespace[name]
+
+    def __call__(self, tags):
+        return self.classify(tags)
+
+
+CLASSIFIERS = {name: Classifier(spec, name) for name, spec in RULES["classifiers"].items()}
+
+classify_way = CLASSIFIERS["way_type"].classify
+classify_area_surface = CLASSIFIERS["area_surface"].classify
+classify_building_height = CLASSIFIERS["building_height"].classify
+classify_highway_surface = CLASSIFIERS["highway_surface"].classify
+classify_node_decoration = CLASSIFIERS["node_decoration"].classify
+classify_barrier_decoration = CLASSIFIERS["barrier_decoration"].classify
+
+# nodes with any of these tags are decorations
+decoration_node_keys = tuple(CLASSIFIERS["node_decoration"].keys)
 
 
 
 ##### RELATIONS: ############
 
 """
-The following dictionary declares which elements (parts of relations) are recognized as areas.
-Keys are the tag names from OSM, values are sets of accepted tag values. If any value is ok, the 
+The following dictionaries (from rules.json) declare which relations are recognized as areas or buildings.
+Keys are the tag names from OSM, values are sets of accepted tag values. If any value is ok, the
 set of values is left empty.
 """
 
-tag_dict_area = {
-    "natural": { "water", },
-    "landuse": { "forest", "meadow", },
-    "surface": { "grass", },
-    "leisure": { "park", },
-    "place": { "islet", },
-}
+tag_dict_area = {key: set(values) for key, values in RULES["relation_areas"].items()}
+tag_dict_building = {key: set(values) for key, values in RULES["relation_buildings"].items()}
 
-area_tags = tag_dict_area.keys()
 
-def is_area_relation(relation):
-    try:
-        tags = relation["tags"]
-    except:
-        return False
+def _relation_classifier(tag_dict, name):
+    # any accepted tag makes the relation match, an empty set of values accepts any value
+    rules = [{"key": key, "values": {value: True for value in values}} if values else {"key": key, "default": True}
+             for key, values in tag_dict.items()]
+    return Classifier({"rules": rules, "fallback": False}, name).classify
 
-    for tag_name, tag_value in tags.items():
-        if tag_name in area_tags:
-            values = tag_dict_area.get(tag_name)
-            # empty set means any tag value is accepted.
-            if values == {} or tag_value in values: 
-                return True
-    return False
+_is_area_tags = _relation_classifier(tag_dict_area, "is_area_tags")
+_is_building_tags = _relation_classifier(tag_dict_building, "is_building_tags")
 
 
-tag_dict_building = {
-    "building": { }, # any building will be accepted
-    "railway": { "platform", },
-}
+def is_area_relation(relation):
+    tags = relation.get("tags")
+    return bool(tags) and _is_area_tags(tags)
 
-building_tags = tag_dict_building.keys()
 
 def is_building_relation(relation):
-    try:
-        tags = relation["tags"]
-    except:
-        return False
-        
-    for tag_name, tag_value in tags.items():
-        if tag_name in building_tags:
-            values = tag_dict_building.get(tag_name)
-            # empty set means any tag value is accepted.
-            if values == {} or tag_value in values:
-                return True
-    return False
-
+    tags = relation.get("tags")
+    return bool(tags) and _is_building_tags(tags)
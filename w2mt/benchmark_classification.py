@@ -0,0 +1,83 @@
+"""
+Micro-benchmark of the tag classification (see rules.json): classifies all tagged elements of an Overpass
+osm.json file by way type, area surface, building height and relation type and prints elements per second.
+
+With --baseline, the if/elif classification from before rules.json is measured instead, for comparison. It is
+imported from a checkout of that version, e.g. `git worktree add ../w2mt-baseline 3e56574` and
+`--baseline ../w2mt-baseline/w2mt`.
+"""
+import argparse
+import json
+import sys
+import time
+
+
+def baseline_classifiers(path):
+    """
+    Returns the classifiers of the w2mt directory path from before rules.json in the order of current_classifiers(),
+    and whether the surface classifier takes the element instead of its tags.
+    """
+    sys.path.insert(0, path)
+    import parse_features_osm
+    from _util import is_area_relation, is_building_relation
+
+    def classify_way(tags):
+        # the dispatch of ways in main() of parse_features_osm.py
+        if "area" in tags:
+            return "areas"
+        elif "highway" in tags:
+            return "highways"
+        elif "railway" in tags:
+            if tags["railway"] in {"rail", "light_rail", "subway", "tram"}:
+                if "tunnel" in tags and tags["tunnel"] == "yes":
+                    return None
+                return "railways"
+            return None
+        elif "waterway" in tags:
+            if tags["waterway"] in {"ditch", "drain", "stream"}:
+                return "waterways"
+            return None
+        elif "building" in tags or "building:part" in tags:
+            return "buildings"
+        elif "barrier" in tags:
+            return "barriers"
+        return "areas"
+
+    # get_surface() takes the element instead of its tags
+    return (classify_way, parse_features_osm.get_surface, parse_features_osm.building_height, is_area_relation,
+            is_building_relation), True
+
+
+def current_classifiers():
+    """Returns the classifiers compiled from rules.json, see baseline_classifiers()."""
+    from _util import (classify_area_surface, classify_building_height, classify_way, is_area_relation,
+                       is_building_relation)
+    return (classify_way, classify_area_surface, classify_building_height, is_area_relation, is_building_relation), False
+
+
+parser = argparse.ArgumentParser(description="Measure the classification speed of OSM elements")
+parser.add_argument("file", type=argparse.FileType("r", encoding="utf-8"), help="Overpass JSON file with OSM data")
+parser.add_argument("--repeat", "-r", type=int, help="Number of passes over all elements. Defaults to 10.", default=10)
+parser.add_argument("--baseline", type=str, help="w2mt directory of a checkout from before rules.json. Measures its if/elif classification instead.", default=None)
+
+args = parser.parse_args()
+
+if args.baseline is not None:
+    (classify_way, classify_area_surface, classify_building_height, is_area_relation, is_building_relation), by_element = baseline_classifiers(args.baseline)
+else:
+    (classify_way, classify_area_surface, classify_building_height, is_area_relation, is_building_relation), by_element = current_classifiers()
+
+elements = [e for e in json.load(args.file)["elements"] if e.get("tags")]
+
+start = time.perf_counter()
+for _ in range(args.repeat):
+    for e in elements:
+        tags = e["tags"]
+        classify_way(tags)
+        classify_area_surface(e if by_element else tags)
+        classify_building_height(tags)
+        is_area_relation(e)
+        is_building_relation(e)
+duration = time.perf_counter() - start
+
+print(f"{len(elements)} tagged elements, {args.repeat} passes: {len(elements) * args.repeat / duration:,.0f} elements/s")
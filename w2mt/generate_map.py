@@ -1,92 +1,489 @@
 import argparse
-import json
-import random
-import zlib
+import hashlib
+import tempfile
 import os
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
-import skimage.draw
-from tqdm import trange
 
-from _util import to_bytes, from_bytes, SURFACES, DECORATIONS, SURFACE_COLORS
+from _features import FeatureStore, load_feature_stores
+from _mapfile import COMPRESSION_LEVEL, REGION_SIZE, block_grid, block_hashes, diff_block_hashes, read_block_hashes, read_header, read_origin, read_rows, splice_map, write_map
+from _raster import in_window, joined_polylines_pixels, merge_overlap_sums, overlap_sums, polygon_pixels, reduce_pixels, scatter_last, scatter_max, sequential_values, thick_polyline, top_index
+from _spatial import STRtree
+from _tiles import Raster, read_compressed_rows, write_png
+from _util import from_bytes, SURFACES, DECORATIONS, SURFACE_COLORS
 
 
-def fit_array(a1, a1_min_x, a1_min_y, a2_min_x, a2_min_y, a2_size_x, a2_size_y):
-    # fit array a1 into boundaries of a2
-    offset_x = 0
-    if a2_min_x < a1_min_x:
-        offset_x = a1_min_x-a2_min_x
-    elif a2_min_x > a1_min_x:
-        a1 = a1[:, (a2_min_x-a1_min_x):]
+LAYER_COUNT = 4
+FLAT_HEIGHT = 50
+# surfaces of the areas which are flattened to their mean height
+FLAT_SURFACES = ["water", "pitch", "playground", "sports_centre", "parking"]
+# tile size if --workers is used without --tile-size
+DEFAULT_WORKER_TILE_SIZE = 512
+# share of the pixels of parks which get grass
+GRASS_DENSITY = 0.025
 
-    offset_y = 0
-    if a2_min_y < a1_min_y:
-        offset_y = a1_min_y-a2_min_y
-    elif min_y > a1_min_y:
-        a1 = a1[(a2_min_y-a1_min_y):, :]
+# number of processes of run_pass() and their pool, see start_workers()
+workers = 1
+pool = None
+# the features of all stages by name, every worker process gets them once when it is started
+shared = {}
 
-    if a1.shape[1]+offset_x > a2_size_x:
-        a1 = a1[:, :a2_size_x-offset_x]
-
-    if a1.shape[0]+offset_y > a2_size_y:
-        a1 = a1[:a2_size_y-offset_y, :]
-    return a1, offset_x, offset_y
-
-def restrict_x_y(x, y):
-    x = x-min_x
-    y = y-min_y
-
-    if x < 0:
-        x = 0
-    elif a.shape[1] - 1 < x:
-        x = a.shape[1] - 1 
-    if y < 0:
-        y = 0
-    elif a.shape[0] - 1 < y:
-        y = a.shape[0] - 1 
-
-    return x, y
 
 # FEATURES
-def shift_coords(x_coords, y_coords):
-    if type(x_coords) is list:
-        x_res = []
-        y_res = []
-        for x, y in zip(x_coords, y_coords):
-            x, y = restrict_x_y(x,y)
-            x_res.append(x)
-            y_res.append(y)
-        return x_res, y_res
-    x, y = x_coords, y_coords
-    return restrict_x_y(x,y)
-
-
-
-# unsued can be removed
-def get_building_height(building):
-    height = building.get("height")
-
-    if height is not None:
-        return building.get("height")
+def spatial_index(store, margins=0):
+    """Returns an STRtree over the bounding boxes of the features of a store, grown by margins (one per feature or for all)."""
+    bounds = store.bounds()
+    # features without coordinates keep their empty box, which intersects nothing
+    filled = store.lengths > 0
+    margins = np.broadcast_to(np.asarray(margins, dtype=np.int64), len(store))[filled, None]
+    bounds[filled] += margins * np.array([-1, -1, 1, 1])
+    return STRtree(bounds)
+
+
+def surface_ids(names):
+    """Returns the ids of an array of surface names, looking up every distinct name once."""
+    unique, inverse = np.unique(names.astype(str), return_inverse=True)
+    return np.array([SURFACES[name][0] for name in unique], dtype=np.uint8)[inverse.ravel()]
+
+
+def close_outlines(store):
+    """Returns a store of the outlines, where every outline of more than 2 points which isn't closed gets its first point appended."""
+    starts, ends = store.offsets[:-1], store.offsets[1:]
+    close = store.lengths > 2
+    close[close] = (store.x[starts[close]] != store.x[ends[close] - 1]) | (store.y[starts[close]] != store.y[ends[close] - 1])
+    x = np.insert(store.x, ends[close], store.x[starts[close]])
+    y = np.insert(store.y, ends[close], store.y[starts[close]])
+    return FeatureStore(x, y, store.offsets + np.concatenate(([0], np.cumsum(close))))
+
+
+def feature_key(feature_id, x, y):
+    """
+    Returns a 64 bit number identifying a feature independent of the map bounds: a hash of its id, or of its first
+    point (x, y) in EPSG:25832 coordinates if it has none.
+    """
+    key = str(feature_id) if feature_id is not None else f"{x},{y}"
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+class Shared:
+    """Argument of run_pass() standing for shared[name], of which only the name is sent to the worker processes."""
+    def __init__(self, name):
+        self.name = name
+
+
+def init_worker(data):
+    # initializer of worker processes
+    shared.update(data)
+
+
+def start_workers(data):
+    """
+    Starts the pool of worker processes used by run_pass() for memory-mapped rasters. data (the features of all stages
+    by name, see Shared) is sent to every worker once instead of with every pass.
+    """
+    global pool
+    shared.update(data)
+    if workers > 1:
+        pool = ProcessPoolExecutor(workers, initializer=init_worker, initargs=(data,))
+
+
+def stop_workers():
+    global pool
+    if pool is not None:
+        pool.shutdown()
+        pool = None
+
+
+def run_tile(raster, fn, args, writable, window):
+    args = [shared[arg.name] if isinstance(arg, Shared) else arg for arg in args]
+    with raster.tile(window, writable) as tile:
+        return fn(tile, window, *args)
+
+
+def run_pass(raster, fn, *args, reduce=np.add, writable=True):
+    """
+    Calls fn(tile, window, *args) for every tile of raster. Returns the results of all tiles combined with reduce, or
+    None if fn returns nothing. Stages that need values of whole features (e.g. mean heights) consist of two passes:
+    one which adds up the values of every tile, and one which applies the result.
+
+    With worker processes, the tiles of a memory-mapped raster are processed in parallel. Every tile only depends on
+    the features and the results of earlier passes, hence the map is the same as with one process.
+    """
+    windows = raster.windows()
+    tasks = ((raster, fn, args, writable, window) for window in windows)
+    if pool is not None and raster.array is None and len(windows) > 1:
+        # the arguments are pickled once per chunk of tiles
+        chunk_size = max(len(windows) // (4 * workers), 1)
+        partials = pool.map(run_tile, *zip(*tasks), chunksize=chunk_size)
     else:
-        height = building.get("levels")
-        if height is not None:
-            height *= 3
-            return height
-
-    if height is not None and building.get("is_part"):
-        # only overwrite height if it is likely from the same building
-        levels = building.get("levels")
-        if levels is None:
-            return 1
+        partials = (run_tile(*task) for task in tasks)
+    result = None
+    for partial in partials:
+        if partial is not None:
+            result = partial if result is None else reduce(result, partial)
+    return result
+
+
+def read_heightmap(file, new_raster, min_x, min_y, size):
+    """
+    Reads a heightmap file generated by parse_heightmap_xyz.py into a raster of the map of the given size, whose upper
+    left corner is at (min_x, min_y). Returns the raster, the window (x0, y0, x1, y1) covered by the heightmap, and its
+    smallest height inside the map.
+    """
+    heightmap_min_x = from_bytes(file.read(4))
+    heightmap_min_y = from_bytes(file.read(4))
+    heightmap_size_x = from_bytes(file.read(2))
+    heightmap_size_y = from_bytes(file.read(2))
+    heightmap = new_raster("heightmap", (size[1], size[0]))
+    shift_x, shift_y = heightmap_min_x - min_x, heightmap_min_y - min_y
+    x0, x1 = max(shift_x, 0), min(shift_x + heightmap_size_x, size[0])
+    min_height = None
+    for y0, rows in read_compressed_rows(file.read(), heightmap_size_x, heightmap_size_y):
+        r0, r1 = max(-(y0 + shift_y), 0), min(len(rows), size[1] - (y0 + shift_y))
+        if r0 < r1 and x0 < x1:
+            rows = rows[r0:r1, x0-shift_x:x1-shift_x]
+            heightmap.paste(x0, y0 + shift_y + r0, rows)
+            min_height = min(min_height, int(rows.min())) if min_height is not None else int(rows.min())
+    window = (x0, max(shift_y, 0), x1, min(shift_y + heightmap_size_y, size[1]))
+    return heightmap, window, min_height or 0
+
+
+def read_map_raster(f, header, new_raster, name):
+    """Reads the map array of an opened map.dat file into a new raster."""
+    raster = new_raster(name, (header["height"], header["width"], LAYER_COUNT))
+    for y0, rows in read_rows(f, header):
+        block = np.zeros(rows.shape[:2] + (LAYER_COUNT,), dtype=np.uint8)
+        block[:, :, :header["layer_count"]] = rows[:, :, :LAYER_COUNT]
+        raster.paste(0, y0, block)
+    return raster
+
+
+def read_old_hashes(path, new_raster):
+    """
+    Returns (first block x, first block z, hashes) of the mapblocks of an existing map.dat. Files without hashes
+    (version 1 or older version 2 files) are read and hashed.
+    """
+    with open(path, "rb") as f:
+        header = read_header(f)
+        hashes = read_block_hashes(f, header)
+        if hashes is not None:
+            return hashes
+        print(f"{path} has no mapblock hashes, reading the whole map")
+        old_map = read_map_raster(f, header, new_raster, "old_map")
+    return (block_grid(header["width"], header["offset_x"])[0], block_grid(header["height"], header["offset_z"])[0],
+            block_hashes(old_map, header["offset_x"], header["offset_z"]))
+
+
+def splice_window(window, bounds, map_window):
+    """
+    Returns the part of the map to generate for splicing window (min_x, min_y, max_x, max_y) into the map covering
+    map_window. The heights of flat areas, lowered ways and building outlines are means over all their pixels, which
+    depend on the features drawn there before, hence the part grows until it contains every such feature (bounds,
+    inclusive) intersecting it. Then the window gets the same heights as when generating the whole map.
+    """
+    bounds = np.asarray(bounds, dtype=np.int64).reshape(-1, 4)
+    while True:
+        x0, y0, x1, y1 = window
+        touching = bounds[(bounds[:, 0] <= x1) & (bounds[:, 2] >= x0) & (bounds[:, 1] <= y1) & (bounds[:, 3] >= y0)]
+        grown = (max(int(touching[:, 0].min(initial=x0)), map_window[0]), max(int(touching[:, 1].min(initial=y0)), map_window[1]),
+                 min(int(touching[:, 2].max(initial=x1)), map_window[2]), min(int(touching[:, 3].max(initial=y1)), map_window[3]))
+        if grown == tuple(window):
+            return grown
+        window = grown
+
+
+def splice(args, new_raster, a, min_x, min_y, window, origin):
+    """
+    Replaces the part of the map.dat at args.output covered by window (x0, y0, x1, y1) of the map raster a, whose
+    upper left corner is at (min_x, min_y), and stores the changed mapblocks as incremental data. Returns them.
+    """
+    x, y = min_x + window[0] - origin[0], min_y + window[1] - origin[1]
+    size = window[2] - window[0], window[3] - window[1]
+    with a.tile(window, writable=False) as patch:
+        patch = np.array(patch)
+    with open(args.output, "rb") as f:
+        header = read_header(f)
+        # regions can only be replaced in version 2 files with hashes and the same layers, others are written again
+        if header["version"] < 2:
+            reason = "has version 1"
+        elif header["layer_count"] != LAYER_COUNT:
+            reason = f"has {header['layer_count']} layers"
+        elif read_block_hashes(f, header) is None:
+            reason = "has no mapblock hashes"
         else:
-            return min(1, levels * 3)
-   
-import imageio
+            reason = None
+        if reason is None:
+            target = None
+        else:
+            print(f"{args.output} {reason}, writing the whole map again")
+            target = read_map_raster(f, header, new_raster, "target")
+    if target is None:
+        return splice_map(args.output, x, y, patch, origin, args.compression_level)
+    if x < 0 or y < 0 or x + size[0] > header["width"] or y + size[1] > header["height"]:
+        raise ValueError(f"the window ({x}, {y}) - ({x + size[0]}, {y + size[1]}) is not inside the map of {args.output}")
+    offset_x, offset_z = header["offset_x"], header["offset_z"]
+    first_x, first_z = block_grid(header["width"], offset_x)[0], block_grid(header["height"], offset_z)[0]
+    old_hashes = block_hashes(target, offset_x, offset_z)
+    target.paste(x, y, patch)
+    hashes = block_hashes(target, offset_x, offset_z)
+    changed = diff_block_hashes(first_x, first_z, hashes, first_x, first_z, old_hashes)
+    with open(args.output + ".splice", "wb") as f:
+        write_map(f, target, offset_x, offset_z, header["spawn_height"], changed, hashes, origin, args.region_size, args.compression_level, max(args.compression_threads, 1))
+    os.replace(args.output + ".splice", args.output)
+    return changed
+
+
+# STAGES: every stage is one or two passes over all tiles, see run_pass()
+def draw_heightmap(tile, window, heightmap, heightmap_window, heightmap_sub):
+    if heightmap is None:
+        tile[:, :, 0] = FLAT_HEIGHT  # everywhere the same height
+        return
+    x0, y0, x1, y1 = window
+    hx0, hy0, hx1, hy1 = max(x0, heightmap_window[0]), max(y0, heightmap_window[1]), min(x1, heightmap_window[2]), min(y1, heightmap_window[3])
+    if hx0 < hx1 and hy0 < hy1:
+        with heightmap.tile((hx0, hy0, hx1, hy1), writable=False) as heights:
+            tile[hy0-y0:hy1-y0, hx0-x0:hx1-x0, 0] = heights - heightmap_sub
+
+
+def scatter_grass(index, rank, areas):
+    """
+    Returns which of the pixels (index, rank) of the parks get grass. Every park draws the decisions for all its pixels
+    in the tile with one call of a generator seeded by the world seed and the park's key, one number per pixel in the
+    order of polygon_pixels(). Neither depends on the tile, hence the grass is the same with any tiles or workers.
+    """
+    grass = np.zeros(len(index), dtype=bool)
+    order = np.argsort(index, kind="stable")
+    parks, starts = np.unique(index[order], return_index=True)
+    for park, pixels in zip(parks, np.split(order, starts[1:])):
+        generator = np.random.default_rng([areas["seed"], int(areas["keys"][park])])
+        grass[pixels] = generator.random(int(rank[pixels].max()) + 1)[rank[pixels]] < GRASS_DENSITY
+    return grass
+
+
+def area_pixels(areas, window, selected):
+    """Returns (xx, yy, index, rank) of the pixels of the areas selected inside window, relative to the window."""
+    xx, yy, index, rank = polygon_pixels([areas["store"].coords(i) for i in selected], window)
+    return xx - window[0], yy - window[1], selected[index], rank
+
+
+def draw_areas(tile, window, areas):
+    """
+    Draws the surfaces of all areas at once, later areas (by level, then by input order) overwrite earlier ones.
+    Returns the overlap_sums() of the heights of the flat areas.
+    """
+    xx, yy, index, rank = area_pixels(areas, window, areas["index"].query(window))
+    label = top_index(tile.shape, xx, yy, index)
+    covered = label >= 0
+    tile[covered, 1] = areas["surfaces"][label[covered]]
+
+    # add a bit of random grass to parks, see scatter_grass().
+    # Other areas remove grass of earlier parks, hence a pixel keeps grass if a park after the last other area placed it.
+    park = areas["park"][index]
+    grass = park.copy()
+    grass[park] = scatter_grass(index[park], rank[park], areas)
+    grass_label = top_index(tile.shape, xx[grass], yy[grass], index[grass])
+    other_label = top_index(tile.shape, xx[~park], yy[~park], index[~park])
+    tile[grass_label > other_label, 2] = DECORATIONS["grass"]
+    tile[(other_label >= 0) & (other_label > grass_label), 2] = 0  # if areas overlap, this removes any previously generated grass
+
+    flat = areas["flat"][index]
+    return overlap_sums(tile[yy[flat], xx[flat], 0], index[flat], xx[flat], yy[flat], len(areas["store"]))
+
+
+def flatten_areas(tile, window, areas, ground):
+    """Every flat area gets the mean height of its pixels (including those of earlier flat areas), later areas overwrite earlier ones."""
+    selected = areas["index"].query(window)
+    xx, yy, index, _ = area_pixels(areas, window, selected[areas["flat"][selected]])
+    heights = ground[index]
+    assert ((0 <= heights) & (heights <= 255)).all()
+    scatter_last(tile[:, :, 0], xx, yy, heights.astype(np.uint8))
+
+
+def way_widths(ways, widths, default_width):
+    """Returns the width of every way of a store, looked up by its type in widths."""
+    types, inverse = np.unique(ways.column("type").astype(str), return_inverse=True)
+    return np.array([widths.get(t, default_width) for t in types], dtype=np.int64)[inverse.ravel()]
+
+
+def prepare_ways(ways, widths, default_width):
+    """
+    Returns the columns of a store of shifted ways needed for drawing them. Every segment of a lowered way (layer < 0)
+    gets a label for its mean height, starting at labels[i] for way i.
+    """
+    layers = ways.column("layer", 0).astype(np.int64)
+    depths = np.where(layers < 0, -layers*3, 0)
+    widths = way_widths(ways, widths, default_width)
+    segments = np.where(depths != 0, np.maximum(ways.lengths - 1, 0), 0)
+    return {
+        "store": ways,
+        "surfaces": surface_ids(ways.column("surface")),
+        "layers": layers,
+        "widths": widths,
+        "depths": depths,
+        "labels": np.cumsum(segments) - segments,
+        "label_count": int(segments.sum()),
+        "label_depths": np.repeat(depths, segments),
+        "index": spatial_index(ways, widths // 2 + 1),
+    }
 
-def main():
-    print("generate_map.py: in main()")
 
+def way_pixels(ways, window, i):
+    xx, yy, segments = thick_polyline(*ways["store"].coords(i), ways["widths"][i], window)
+    return xx - window[0], yy - window[1], segments
+
+
+def draw_ways(tile, window, ways, clear_above):
+    """
+    Draws the surfaces of the ways. With clear_above, ways on the ground remove anything above their surface.
+    Returns the overlap_sums() of the heights below the segments of the lowered ways.
+    """
+    lowered = []
+    for i in ways["index"].query(window):
+        xx, yy, segments = way_pixels(ways, window, i)
+        if ways["depths"][i] != 0:
+            lowered.append((tile[yy, xx, 0], segments + ways["labels"][i], xx, yy))
+        tile[yy, xx, 1] = ways["surfaces"][i]
+        if clear_above and ways["layers"][i] >= 0:
+            # remove anything above the surface (buildings, randomly added grass)
+            tile[yy, xx, 2] = 0
+            tile[yy, xx, 3] = 0
+    if not lowered:
+        return None
+    return overlap_sums(*(np.concatenate(c) for c in zip(*lowered)), ways["label_count"])
+
+
+def lower_ways(tile, window, ways, heights):
+    """
+    Lowers the ground below ways with a negative layer (tunnels etc.). Every segment gets the mean height of its
+    pixels (including those of earlier segments) minus the depth, later segments overwrite earlier ones.
+    """
+    lowered = []
+    for i in ways["index"].query(window):
+        if ways["depths"][i] != 0:
+            xx, yy, segments = way_pixels(ways, window, i)
+            lowered.append((xx, yy, heights[segments + ways["labels"][i]].astype(np.uint8)))
+    if lowered:
+        xx, yy, z = (np.concatenate(c) for c in zip(*lowered))
+        scatter_last(tile[:, :, 0], xx, yy, z)
+
+
+def outline_pixels(buildings, window):
+    selected = buildings["index"].query(window)
+    outlines = buildings["store"].select(selected)
+    xx, yy, index = joined_polylines_pixels(outlines.x, outlines.y, outlines.lengths, window)
+    return xx - window[0], yy - window[1], selected[index]
+
+
+def outline_sums(tile, window, buildings):
+    xx, yy, index = outline_pixels(buildings, window)
+    return overlap_sums(tile[yy, xx, 0], index, xx, yy, len(buildings["store"]))
+
+
+def draw_outlines(tile, window, buildings, ground):
+    """Draws the outlines of the buildings from --features, every building is put on the mean height of its outline."""
+    xx, yy, index = outline_pixels(buildings, window)
+    ground_z = ground[index].astype(np.int64)
+    assert ((0 <= ground_z) & (ground_z <= 255)).all()
+    scatter_last(tile[:, :, 0], xx, yy, ground_z.astype(np.uint8))
+    scatter_last(tile[:, :, 2], xx, yy, np.minimum(127 + ground_z + 1, 255).astype(np.uint8))
+    scatter_max(tile[:, :, 3], xx, yy, np.minimum(ground_z + buildings["heights"][index], 255))
+
+
+def draw_buildings_file(tile, window, buildings, heightmap, heightmap_window, flat):
+    """Draws the points of the buildings of a buildings_cityjson.dat file inside the tile."""
+    x0, y0 = window[:2]
+    tile_index = (y0 // buildings["tile_size"]) * buildings["tile_columns"] + x0 // buildings["tile_size"]
+    start, end = buildings["tile_starts"][tile_index:tile_index+2]
+    x, y, z = buildings["x"][start:end] - x0, buildings["y"][start:end] - y0, buildings["z"][start:end].copy()
+    surfaces = buildings["surfaces"][start:end]
+    if flat:
+        on_heightmap = in_window(x + x0, y + y0, heightmap_window)
+        with heightmap.tile(window, writable=False) as heights:
+            z[on_heightmap] -= heights[y[on_heightmap], x[on_heightmap]]
+        z += FLAT_HEIGHT
+
+    is_ground = surfaces == buildings["ground"]
+    if not flat:
+        assert ((0 <= z[is_ground]) & (z[is_ground] <= 255)).all()
+        scatter_last(tile[:, :, 0], x[is_ground], y[is_ground], z[is_ground].astype(np.uint8))
+    tile[y[is_ground], x[is_ground], 1] = SURFACES["building_ground"][0]
+
+    # walls and roofs: the building reaches from the lowest to the highest point of all its surfaces at a pixel
+    above = ~is_ground & (z > 0)
+    x, y, z, surfaces = x[above], y[above], z[above], surfaces[above]
+    bottom_x, bottom_y, bottom = reduce_pixels(tile.shape, x, y, np.minimum(127 + z, 255), np.minimum)
+    current = tile[bottom_y, bottom_x, 2]
+    tile[bottom_y, bottom_x, 2] = np.where(current >= 128, np.minimum(current, bottom), bottom)
+    if len(buildings["roof_summand"]):
+        scatter_max(tile[:, :, 3], x, y, np.minimum(buildings["roof_summand"][surfaces] + z, 255))
+
+
+def draw_decorations(tile, window, decorations):
+    """
+    Draws all decorations inside the tile at once: the points and the pixels of the lines (e.g. barriers, rasterized
+    as one batch of polylines) are written with one assignment, where later decorations overwrite earlier ones.
+    Trees and bushes get dirt below every point.
+    """
+    x0, y0 = window[:2]
+    store = decorations["store"]
+    selected = decorations["index"].query(window)
+    points = selected[store.scalar[selected]]
+    line_features = selected[~store.scalar[selected]]
+    point_x, point_y = store.x[store.offsets[points]], store.y[store.offsets[points]]
+    lines = store.select(line_features)
+    line_xx, line_yy, line_index = joined_polylines_pixels(lines.x, lines.y, lines.lengths, window)
+    index = np.concatenate((points, line_features[line_index]))
+    order = np.argsort(index, kind="stable")
+    xx, yy = np.concatenate((point_x, line_xx))[order], np.concatenate((point_y, line_yy))[order]
+    scatter_last(tile[:, :, 2], xx - x0, yy - y0, decorations["ids"][index[order]])
+
+    # place dirt below trees, of lines only at the vertices inside the tile
+    dirt = decorations["dirt"][points]
+    vertex_dirt = np.repeat(decorations["dirt"][line_features], lines.lengths) & in_window(lines.x, lines.y, window)
+    xx, yy = np.concatenate((point_x[dirt], lines.x[vertex_dirt])), np.concatenate((point_y[dirt], lines.y[vertex_dirt]))
+    tile[yy - y0, xx - x0, 1] = SURFACES["dirt"][0]
+
+
+def surface_stats(tile, window):
+    """Returns the number of pixels of every surface id and the maximum of the layers 0-2."""
+    return np.bincount(tile[:, :, 1].ravel(), minlength=256), tile[:, :, :3].max(axis=(0, 1)).astype(np.int64)
+
+
+def merge_stats(stats, other):
+    return stats[0] + other[0], np.maximum(stats[1], other[1])
+
+
+def read_buildings_file(file):
+    """
+    Reads a buildings_cityjson.dat file generated by parse_cityjson.py. Returns the (x, y, z) of all points as int64
+    array in file order, the surface of every point as index into the returned list of surface names, and that list.
+    """
+    data = file.read()
+    buildings_count = from_bytes(data[:4])
+    assert data[4] == 0
+    pos = 5
+    surface_names = []
+    blocks = []
+    block_surfaces = []
+    for _ in range(buildings_count):
+        # surfaces of a building follow each other until a 0 byte (or the end of the file)
+        while pos < len(data) and data[pos] != 0:
+            name_end = pos + 1 + data[pos]
+            surface_name = data[pos+1:name_end].decode("utf-8")
+            pos_count = from_bytes(data[name_end:name_end+4])
+            blocks.append(np.frombuffer(data, dtype="<u4", count=pos_count*3, offset=name_end+4).reshape(-1, 3))
+            if surface_name not in surface_names:
+                surface_names.append(surface_name)
+            block_surfaces.append(surface_names.index(surface_name))
+            pos = name_end + 4 + pos_count*12
+        pos += 1
+    points = np.concatenate(blocks).astype(np.int64) if blocks else np.zeros((0, 3), dtype=np.int64)
+    surfaces = np.repeat(block_surfaces, [len(b) for b in blocks]).astype(np.int64)
+    return points, surfaces, surface_names
+
+
+def main():
     HIGHWAY_WIDTHS = {
         "footway": 3,
         "service": 4,
@@ -104,12 +501,15 @@ def main():
         "stream": 2,
     }
 
+    RAILWAY_WIDTH = 1
+
     parser = argparse.ArgumentParser(description="Generate a map.dat file that can be read by world2minetest Mod")
     parser.add_argument("--heightmap", type=argparse.FileType("rb"), help="Heightmap file generated by parse_heightmap_xyz.py", default=None)
-    parser.add_argument("--features", action="append", type=argparse.FileType("r"), help="features.json files generated by parse_features_osm.py or parse_features_dxf.py. Features of the same type in files specified earlier will be overridden.", default=None)
+    parser.add_argument("--features", action="append", type=argparse.FileType("rb"), help="features.json (or binary features .bin) files generated by parse_features_osm.py or parse_features_dxf.py. Features of the same type in files specified earlier will be overridden.", default=None)
     parser.add_argument("--buildings", type=argparse.FileType("rb"), help="buildings_cityjson.dat file generated by parse_cityjson.py. If this argument is used, buildings stored in a --features file will be ignored.", default=None)
     parser.add_argument("--buildings-base-height", type=int, help="Subtracted from the height of every building. Defaults to 0.", default=0)
     parser.add_argument("--incr", action="store_true", help="Add incremental map information to map.dat. Load new map data using the '/w2mt:incr' command. Use with caution and make a backup beforehand.")
+    parser.add_argument("--splice", action="store_true", help="Generate only the area given by --minx, --maxx, --miny and --maxy and replace it in the existing --output map.dat, with incremental map information of the changed mapblocks (see --incr). Flat areas, lowered ways and building outlines crossing its border are generated completely, hence the area is the same as when generating the whole map. Files written before this option existed also need the --offsetx and --offsetz they were generated with.")
     parser.add_argument("--offsetx", type=int, help="EPSG:25832 x coordinate that will be x=0 in Minetest", default=None)
     parser.add_argument("--offsetz", type=int, help="EPSG:25832 y coordinate that will be z=0 in Minetest (y is z in Minetest)", default=None)
     parser.add_argument("--minx", type=int, help="Minimum EPSG:25832 x coordinate", default=None)
@@ -119,90 +519,132 @@ def main():
     parser.add_argument("--noheightreduction", action="store_true", help="Do not subtract the smallest height from every heightmap value")
     parser.add_argument("--flat", action="store_true", help="If a --heightmap is specified, make the world flat, but subtract the heightmap value from each building coordinate")
     parser.add_argument("--minimap", action="store_true", help="Create a minimap.png visualization of the world's surface in colors.")
+    parser.add_argument("--region-size", type=int, help=f"map.dat is split into regions of this many blocks squared, which are compressed separately and loaded by the mod when needed. Defaults to {REGION_SIZE}, the size of a mapchunk.", default=REGION_SIZE)
+    parser.add_argument("--compression-level", type=int, choices=range(10), metavar="{0-9}", help=f"zlib compression level of map.dat, lower is faster but larger (see DetailedGuide.md). Defaults to {COMPRESSION_LEVEL}.", default=COMPRESSION_LEVEL)
+    parser.add_argument("--compression-threads", type=int, help="Number of threads compressing map.dat. Defaults to the number of CPUs.", default=os.cpu_count() or 1)
+    parser.add_argument("--tile-size", type=int, help="Generate the map in tiles of this many blocks squared. The map is kept in memory-mapped temporary files instead of in memory, hence memory usage is bounded by the tile size instead of the map size. Use for maps larger than the available memory.", default=None)
+    parser.add_argument("--workers", type=int, help=f"Number of processes generating tiles in parallel. Implies tiled generation, with tiles of {DEFAULT_WORKER_TILE_SIZE} blocks squared unless --tile-size is given. The map is the same as with one process. Defaults to 1.", default=1)
+    parser.add_argument("--tile-dir", type=str, help="Directory for the temporary files of --tile-size. Defaults to the directory of the output file.", default=None)
+    parser.add_argument("--seed", type=int, help="World seed for the random grass in parks. Together with the id of a park, it determines where grass is placed. Defaults to 0.", default=0)
     parser.add_argument("--verbose", "-v", action="store_true", help="More debug info")
     parser.add_argument("--output", "-o", type=ascii, help="output path for map.dat file which is part of the w2mt mod", default="world2minetest/map.dat")
 
     args = parser.parse_args()
     args.output = args.output.strip("'")
 
-    global min_x, max_x, min_y, max_y
+    global workers
     min_x = args.minx
     max_x = args.maxx
     min_y = args.miny
     max_y = args.maxy
 
+    if args.splice:
+        if None in (min_x, max_x, min_y, max_y):
+            raise argparse.ArgumentTypeError("--splice requires --minx, --maxx, --miny and --maxy.")
+        if args.incr:
+            raise argparse.ArgumentTypeError("--splice always adds incremental map information, --incr can't be used with it.")
+        with open(args.output, "rb") as f:
+            splice_header = read_header(f)
+            splice_origin = read_origin(f, splice_header)
+        if splice_origin is None:
+            # the origin is derived from the offsets the map was generated with, its height reduction is unknown
+            if args.offsetx is None or args.offsetz is None:
+                raise argparse.ArgumentTypeError(f"{args.output} doesn't contain its position, --splice requires the --offsetx and --offsetz it was generated with.")
+            if args.heightmap is not None and not (args.flat or args.noheightreduction):
+                raise argparse.ArgumentTypeError(f"{args.output} doesn't contain the height subtracted from its heightmap, use --noheightreduction if it was generated with it.")
+            splice_origin = (args.offsetx - splice_header["offset_x"], args.offsetz - splice_header["offset_z"], 0)
+        map_window = (splice_origin[0], splice_origin[1], splice_origin[0] + splice_header["width"] - 1, splice_origin[1] + splice_header["height"] - 1)
+        splice_bounds = (min_x, min_y, max_x, max_y)
+        if not (map_window[0] <= min_x <= max_x <= map_window[2] and map_window[1] <= min_y <= max_y <= map_window[3]):
+            raise argparse.ArgumentTypeError(f"--splice area {splice_bounds} is not inside the map of {args.output} {map_window}.")
+
     if (args.heightmap is None or args.flat) and args.features is None:
         raise argparse.ArgumentTypeError("at least one of --heightmap (without --flat) or --features is required.")
+    if args.seed < 0:
+        raise argparse.ArgumentTypeError("--seed must not be negative.")
+    if not 1 <= args.region_size <= 2**15:
+        raise argparse.ArgumentTypeError("--region-size must be between 1 and 32768.")
+    if args.tile_size is not None and args.tile_size < 1:
+        raise argparse.ArgumentTypeError("--tile-size must be positive.")
+    workers = max(args.workers, 1)
+    if workers > 1 and args.tile_size is None:
+        # the worker processes share the map through memory-mapped files
+        args.tile_size = DEFAULT_WORKER_TILE_SIZE
+
+    if args.tile_size is not None:
+        tile_dir = tempfile.TemporaryDirectory(prefix="w2mt_tiles_", dir=args.tile_dir or os.path.dirname(os.path.abspath(args.output)))
+        print(f"Generating the map in tiles of {args.tile_size}x{args.tile_size} blocks in {tile_dir.name} with {workers} process(es)")
+    else:
+        tile_dir = None
+
+    def new_raster(name, shape):
+        path = os.path.join(tile_dir.name, f"{name}.raw") if tile_dir is not None else None
+        return Raster(shape, path, args.tile_size)
 
     if args.heightmap is not None:
         heightmap_min_x = from_bytes(args.heightmap.read(4))
         heightmap_min_y = from_bytes(args.heightmap.read(4))
         heightmap_size_x = from_bytes(args.heightmap.read(2))
         heightmap_size_y = from_bytes(args.heightmap.read(2))
+        args.heightmap.seek(0)
 
         min_x = min_x if min_x is not None else heightmap_min_x
         max_x = max_x if max_x is not None else (heightmap_min_x+heightmap_size_x-1)
         min_y = min_y if min_y is not None else heightmap_min_y
         max_y = max_y if max_y is not None else (heightmap_min_y+heightmap_size_y-1)
 
-        heightmap = np.frombuffer(zlib.decompress(args.heightmap.read()), dtype=np.uint8).reshape((heightmap_size_y, heightmap_size_x))
-        size = (max_x-min_x+1, max_y-min_y+1)
-        heightmap, h_offset_x, h_offset_y = fit_array(heightmap, heightmap_min_x, heightmap_min_y, min_x, min_y, size[0], size[1])
-    else:
-        heightmap = None
-
 
+    # every features file is loaded into one FeatureStore per feature class, see _features.py
     features = {
-        "areas": [],
-        "highways": [],
-        "railways": [],
-        "waterways": [],
-        "buildings": [],
+        "highways": FeatureStore.concat([]),
+        "railways": FeatureStore.concat([]),
+        "waterways": FeatureStore.concat([]),
+        "buildings": FeatureStore.concat([]),
         "decorations": {}
     }
-
-    areas_outer = []
-    areas_inner = []
-    areas_low = []
-    areas_medium = []
-    areas_high = []
+    area_levels = {"outer": [], "inner": [], "low": [], "medium": [], "high": []}
 
     for file in args.features or []:
-        data = json.load(file)
+        # once the bounds of the map are known, only features inside of them are loaded. --splice loads those of the
+        # whole map, see splice_window()
+        if args.splice:
+            window = map_window
+        else:
+            window = (min_x, min_y, max_x, max_y) if None not in (min_x, min_y, max_x, max_y) else None
+        data = load_feature_stores(file, window)
         min_x = min_x if min_x is not None else data["min_x"]
         max_x = max_x if max_x is not None else data["max_x"]
         min_y = min_y if min_y is not None else data["min_y"]
         max_y = max_y if max_y is not None else data["max_y"]
         print(f'minX: {min_x}, maxX: {max_x}, minY: {min_y}, maxY: {max_y}')
-        for feature in features.keys():
-            if feature in ["highways", "railways", "waterways", "buildings"]:
-                print(f'Found feature: {feature}')
-                if feature in data and data[feature]:
-                    features[feature] = data[feature]
-                    print(f'Saved feature[feature]: {feature}')
-
-            elif feature in ["decorations"]:
-                if "decorations" in data and data["decorations"]:
-                    for key, value in data["decorations"].items():
-                        if value:
-                            features["decorations"][key] = value
-            elif feature in ["areas"]:
-                if "outer" in data["areas"] and data["areas"]["outer"]:
-                    areas_outer.extend(data["areas"]["outer"])
-                    print(f"We got #{len(areas_outer)} outer areas.")
-                if "inner" in data["areas"] and data["areas"]["inner"]:
-                    areas_inner.extend(data["areas"]["inner"])
-                    print(f"We got #{len(areas_inner)} inner areas.")
-                if "low" in data["areas"] and data["areas"]["low"]:
-                    areas_low.extend(data["areas"]["low"])
-                    print(f"We got #{len(areas_low)} low areas.")
-                if "medium" in data["areas"] and data["areas"]["medium"]:
-                    areas_medium.extend(data["areas"]["medium"])
-                    print(f"We got #{len(areas_medium)} medium areas.")
-                if "high" in data["areas"] and data["areas"]["high"]:
-                    areas_high.extend(data["areas"]["high"])
-                    print(f"We got #{len(areas_high)} high areas.")
-
+        for feature in ["highways", "railways", "waterways", "buildings"]:
+            if feature in data and len(data[feature]):
+                features[feature] = data[feature]
+                if args.verbose:
+                    print(f"Using {len(data[feature])} {feature}")
+        for key, value in data.get("decorations", {}).items():
+            if len(value):
+                features["decorations"][key] = value
+        for level, stores in area_levels.items():
+            if level in data["areas"] and len(data["areas"][level]):
+                stores.append(data["areas"][level])
+                print(f"We got #{sum(len(store) for store in stores)} {level} areas.")
+
+    way_kinds = (("waterways", WATERWAY_WIDTHS, 1), ("highways", HIGHWAY_WIDTHS, 3), ("railways", {}, RAILWAY_WIDTH))
+    if args.splice:
+        # the flat areas, lowered ways and building outlines crossing the border are generated completely
+        store = FeatureStore.concat(store for stores in area_levels.values() for store in stores)
+        flat = np.isin(store.column("surface").astype(str), FLAT_SURFACES) & (store.lengths >= 3)
+        bounds = [store.bounds()[flat]]
+        for name, widths, default_width in way_kinds:
+            store = features[name]
+            lowered = (store.column("layer", 0).astype(np.int64) < 0) & (store.lengths > 0)
+            margins = way_widths(store, widths, default_width)[lowered, None] // 2 + 1
+            bounds.append(store.bounds()[lowered] + margins * np.array([-1, -1, 1, 1]))
+        if not args.buildings:
+            bounds.append(features["buildings"].bounds()[features["buildings"].lengths >= 2])
+        min_x, min_y, max_x, max_y = splice_window(splice_bounds, np.concatenate(bounds), map_window)
+        print(f"generating {min_x},{min_y} to {max_x},{max_y} for the features crossing the border")
 
     size = (max_x-min_x+1, max_y-min_y+1)
 
@@ -210,14 +652,18 @@ def main():
     if min_x > max_x or min_y > max_y:
         raise ValueError("map size is invalid")
 
-    if args.offsetx and args.offsetz:
+    if args.offsetx and args.offsetz and not args.splice:
         if not (min_x <= args.offsetx <= max_x and min_y <= args.offsetz <= max_y):
             raise ValueError(f"offset ({args.offsetx}, {args.offsetz}) is located outside of map. Details: x: {min_x} - {max_x}; y: {min_y} - {max_y}")
 
+    if args.heightmap is not None:
+        heightmap, heightmap_window, heightmap_min = read_heightmap(args.heightmap, new_raster, min_x, min_y, size)
+    else:
+        heightmap = None
+        heightmap_window = None
+
 
-    LAYER_COUNT = 4
-    global a
-    a = np.zeros((size[1], size[0], LAYER_COUNT), dtype=np.uint8)
+    a = new_raster("map", (size[1], size[0], LAYER_COUNT))
     # bytes (one for every layer):
     # byte 0: y0: heightmap; floor goes up to this block.
     # byte 1: surface type (block to place at y=y0; below is always stone)
@@ -226,411 +672,187 @@ def main():
     # byte 3: y2: maximum y coordinate of a building. If y2>=128, the topmost block (at y=y2) is part of a roof and the maximum y coordinate is y2-127.
 
 
-    # HEIGHTMAP
     if heightmap is not None and not args.flat:
-        print("HEIGHTMAP used ...")
-        if not args.noheightreduction:
-            heightmap_sub = heightmap.min()
+        if args.splice:
+            # the heights have to match those of the map the area is spliced into
+            heightmap_sub = splice_origin[2]
+        elif not args.noheightreduction:
+            heightmap_sub = heightmap_min
         else:
             heightmap_sub = 0
-        a[h_offset_y:h_offset_y+heightmap.shape[0]+1, h_offset_x:h_offset_x+heightmap.shape[1]+1, 0] = heightmap - heightmap_sub
     else:
         heightmap_sub = 0
-        FLAT_HEIGHT = 50
-        a[:, :, 0] = FLAT_HEIGHT  # everywhere the same height
-
-
-    for area_level in (areas_outer, areas_inner, areas_low, areas_medium, areas_high):
-        for area in area_level:
-            x, y = shift_coords(area["x"], area["y"])
-            if len(x) < 3:
-                if args.verbose: print("Too few coordinates, ignoring area:", x, y, area)
-                continue
-            surface = area["surface"]
-            xx, yy = skimage.draw.polygon(x, y)
-            a[yy, xx, 1] = SURFACES[surface][0]
-            # print(f'SETTING SURFACE to {SURFACES[surface][0]} on {yy} x {xx}')
-            if surface in ("water", "pitch", "playground", "sports_centre", "parking"):
-                assert 0 <= int(round(a[yy, xx, 0].mean())) <= 255
-                a[yy, xx, 0] = int(round(a[yy, xx, 0].mean()))  # flatten area
-            if surface in ("park", "village_green"):
-                # add a bit of random grass
-                random.seed(0)
-                for x, y in zip(xx, yy):
-                    if random.random() < 0.025:
-                        a[y, x, 2] = DECORATIONS["grass"]
-            else:
-                a[yy, xx, 2] = 0  # if areas overlap, this removes any previously generated grass
-
-            # TODO remove all existing wholes in this area!!!
-
-
-    for waterway in features["waterways"]:
-        #print(f'Processing waterway id: {waterway["osm_id"]}')
-        x_coords, y_coords = shift_coords(waterway["x"], waterway["y"])
-        #print(f'x_coords: {x_coords}')
-        surface = waterway["surface"]
-        surface_id = SURFACES[surface][0]
-        #print(f'surface: {surface} -> surface-id: {surface_id}')
-        layer = waterway.get("layer", 0)
-        #print(f'layer: {layer}')
-        width = WATERWAY_WIDTHS.get(waterway["type"], 1)
-        #print(f'width: {width}')
-        height = -layer*3 if layer < 0 else 0
-        #print(f'height: {height}')
-        for i in range(0, len(x_coords)-1):
-            x1, y1 = x_coords[i], y_coords[i]
-            x2, y2 = x_coords[i+1], y_coords[i+1]
-            xx, yy = skimage.draw.line(x1, y1, x2, y2)
-            if width != 1:
-                # very naive implementation for widths, improvement needed
-                positions = set()
-                if width == 2:
-                    for x, y in zip(xx, yy):
-                        positions.update((
-                                        (x, y+1),
-                            (x-1, y),   (x, y  )
-                        ))
-                elif width == 3:
-                    for x, y in zip(xx, yy):
-                        positions.update((
-                                        (x, y+1),
-                            (x-1, y),   (x, y  ),   (x+1, y),
-                                        (x, y-1)
-                        ))
-                elif width == 4:
-                    for x, y in zip(xx, yy):
-                        positions.update((
-                            (x-1, y+1), (x  , y+1), (x+1, y+1),
-                            (x-1, y  ), (x  , y  ), (x+1, y  ),
-                            (x-1, y-1), (x  , y-1), (x+1, y-1)
-                        ))
-                elif width == 5:
-                    for x, y in zip(xx, yy):
-                        positions.update((
-                                                    (x  , y+2),
-                                        (x-1, y+1), (x  , y+1), (x+1, y+1),
-                            (x-2, y  ), (x-1, y  ), (x  , y  ), (x+1, y  ), (x+2, y),
-                                        (x-1, y-1), (x  , y-1), (x+1, y-1),
-                                                    (x  , y-2)
-                        ))
-                elif width == 6:
-                    for x, y in zip(xx, yy):
-                        positions.update((
-                                        (x-1, y+1), (x  , y+2), (x+1, y+2),
-                            (x-2, y+1), (x-1, y+1), (x  , y+1), (x+1, y+1), (x+2, y+1),
-                            (x-2, y  ), (x-1, y  ), (x  , y  ), (x+1, y  ), (x+2, y  ),
-                            (x-2, y-1), (x-1, y-1), (x  , y-1), (x+1, y-1), (x+2, y-1),
-                                        (x-1, y-2), (x  , y-2), (x+1, y-2),
-                        ))
-                xx = []
-                yy = []
-                for x, y in positions:
-                    if 0 <= x < size[0] and 0 <= y < size[1]:
-                        xx.append(x)
-                        yy.append(y)
-            if height != 0 and len(yy) > 0:
-                # assert 0 <= a[yy, xx, 0].mean() - height <= 255
-                a[yy, xx, 0] = a[yy, xx, 0].mean() - height
-            a[yy, xx, 1] = surface_id
-            #print(f'SETTING SURFACE to {surface_id} on {yy} x {xx}')
-
-
-    for highway in features["highways"]:
-        x_coords, y_coords = shift_coords(highway["x"], highway["y"])
-        surface = highway["surface"]
-        surface_id = SURFACES[surface][0]
-        layer = highway.get("layer", 0)
-        width = HIGHWAY_WIDTHS.get(highway["type"], 3)
-        height = -layer*3 if layer < 0 else 0
-        for i in range(0, len(x_coords)-1):
-            x1, y1 = x_coords[i], y_coords[i]
-            x2, y2 = x_coords[i+1], y_coords[i+1]
-            xx, yy = skimage.draw.line(x1, y1, x2, y2)
-            if width != 1:
-                # very naive implementation for widths, improvement needed
-                positions = set()
-                if width == 2:
-                    for x, y in zip(xx, yy):
-                        positions.update((
-                                        (x, y+1),
-                            (x-1, y),   (x, y  )
-                        ))
-                elif width == 3:
-                    for x, y in zip(xx, yy):
-                        positions.update((
-                                        (x, y+1),
-                            (x-1, y),   (x, y  ),   (x+1, y),
-                                        (x, y-1)
-                        ))
-                elif width == 4:
-                    for x, y in zip(xx, yy):
-                        positions.update((
-                            (x-1, y+1), (x  , y+1), (x+1, y+1),
-                            (x-1, y  ), (x  , y  ), (x+1, y  ),
-                            (x-1, y-1), (x  , y-1), (x+1, y-1)
-                        ))
-                elif width == 5:
-                    for x, y in zip(xx, yy):
-                        positions.update((
-                                                    (x  , y+2),
-                                        (x-1, y+1), (x  , y+1), (x+1, y+1),
-                            (x-2, y  ), (x-1, y  ), (x  , y  ), (x+1, y  ), (x+2, y),
-                                        (x-1, y-1), (x  , y-1), (x+1, y-1),
-                                                    (x  , y-2)
-                        ))
-                elif width == 6:
-                    for x, y in zip(xx, yy):
-                        positions.update((
-                                        (x-1, y+1), (x  , y+2), (x+1, y+2),
-                            (x-2, y+1), (x-1, y+1), (x  , y+1), (x+1, y+1), (x+2, y+1),
-                            (x-2, y  ), (x-1, y  ), (x  , y  ), (x+1, y  ), (x+2, y  ),
-                            (x-2, y-1), (x-1, y-1), (x  , y-1), (x+1, y-1), (x+2, y-1),
-                                        (x-1, y-2), (x  , y-2), (x+1, y-2),
-                        ))
-                xx = []
-                yy = []
-                for x, y in positions:
-                    if 0 <= x < size[0] and 0 <= y < size[1]:
-                        xx.append(x)
-                        yy.append(y)
-            if height != 0:
-                mean = a[yy, xx, 0].mean()
-                try:
-                    assert 0 <= mean - height <= 255
-                except:
-                    a[yy, xx, 0] = 0
-                a[yy, xx, 0] = mean - height
-            a[yy, xx, 1] = surface_id
-            #print(f'SETTING SURFACE to {surface_id} on {yy} x {xx}')
-            if layer >= 0:
-                # remove anything above the surface (buildings, randomly added grass)
-                a[yy, xx, 2] = 0
-                a[yy, xx, 3] = 0
-
-
-    for railway in features["railways"]:
-        x_coords, y_coords = shift_coords(railway["x"], railway["y"])
-        surface = railway["surface"]
-        surface_id = SURFACES[surface][0]
-        layer = railway.get("layer", 0)
-        height = -layer*3 if layer < 0 else 0
-        for i in range(0, len(x_coords)-1):
-            x1, y1 = x_coords[i], y_coords[i]
-            x2, y2 = x_coords[i+1], y_coords[i+1]
-            xx, yy = skimage.draw.line(x1, y1, x2, y2)
-            positions = set()
-            for x, y in zip(xx, yy):
-                positions.update((
-                                (x, y+1),
-                    (x-1, y),   (x, y  )
-                ))
-            if height != 0:
-                mean = a[yy, xx, 0].mean()
-                try:
-                    assert 0 <= mean - height <= 255
-                except:
-                    a[yy, xx, 0] = 0
-                a[yy, xx, 0] = mean - height
-            a[yy, xx, 1] = surface_id
-            if layer >= 0:
-                # remove anything above the surface (buildings, randomly added grass)
-                a[yy, xx, 2] = 0
-                a[yy, xx, 3] = 0
+
+
+    # FEATURES: the input of all stages is prepared first and sent to the worker processes once, see start_workers()
+    # all areas are burned at once, later areas (by level, then by input order) overwrite earlier ones
+    store = FeatureStore.concat(store for stores in area_levels.values() for store in stores).shift(-min_x, -min_y)
+    too_few = store.lengths < 3
+    if args.verbose:
+        for i in np.flatnonzero(too_few):
+            print("Too few coordinates, ignoring area:", *store.coords(i), store.column("surface")[i])
+    store = store.select(np.flatnonzero(~too_few))
+    surfaces = store.column("surface").astype(str)
+    areas = {
+        "store": store,
+        "surfaces": surface_ids(surfaces),
+        "flat": np.isin(surfaces, FLAT_SURFACES),
+        "park": np.isin(surfaces, ["park", "village_green"]),
+        "index": spatial_index(store),
+        "seed": args.seed,
+    }
+    # only parks draw random numbers, see scatter_grass()
+    areas["keys"] = np.zeros(len(store), dtype=np.uint64)
+    ids = store.column("osm_id")
+    for i in np.flatnonzero(areas["park"]):
+        areas["keys"][i] = feature_key(ids[i], int(store.x[store.offsets[i]]) + min_x, int(store.y[store.offsets[i]]) + min_y)
+
+    ways = {name: prepare_ways(features[name].shift(-min_x, -min_y), widths, default_width) for name, widths, default_width in way_kinds}
 
     if args.buildings:
         print("Reading buildings file")
-        count_points_in_area = 0
-        count_points_out_of_area = 0
-        buildings_file = args.buildings
-        buildings_count = from_bytes(buildings_file.read(4))
-        assert from_bytes(buildings_file.read(1)) == 0
-        for _ in trange(buildings_count):
-            new_building = {}
-            surface_name_len_bytes = buildings_file.read(1)
-            while (surface_name_len := from_bytes(surface_name_len_bytes)) != 0:
-                surface_name = buildings_file.read(surface_name_len).decode("utf-8")
-                roof_summand = 127 if surface_name == "roof" else 0
-                is_ground = surface_name == "ground"
-                pos_count = from_bytes(buildings_file.read(4))
-                for _ in range(pos_count):
-                    x = from_bytes(buildings_file.read(4))
-                    y = from_bytes(buildings_file.read(4))
-                    z = from_bytes(buildings_file.read(4))
-                    if min_x <= x <= max_x and min_y <= y <= max_y:
-                        count_points_in_area += 1
-                        x = x-min_x
-                        y = y-min_y
-                        z -= heightmap_sub
-                        z -= args.buildings_base_height
-                        if args.flat:
-                            if h_offset_x <= x < h_offset_x+heightmap.shape[1] and h_offset_y <= y < h_offset_y+heightmap.shape[0]:
-                                z -= heightmap[y-h_offset_y, x-h_offset_x]
-                            z += FLAT_HEIGHT
-                        if is_ground:
-                            if not args.flat:
-                                assert 0 <= z <= 255
-                                a[y, x, 0] = z
-                            a[y, x, 1] = SURFACES["building_ground"][0]
-                            # print(f'SETTING SURFACE to {SURFACES["building_ground"][0]} on {yy} x {xx}')
-                        else:
-                            if z > 0:
-                                if a[y, x, 2] >= 128:
-                                    a[y, x, 2] = min(a[y, x, 2], 127 + z)
-                                else:
-                                    a[y, x, 2] = 127 + z
-                                a[y, x, 3] = max(a[y, x, 3], roof_summand + z)
-                    else:
-                        count_points_out_of_area += 1
-                surface_name_len_bytes = buildings_file.read(1)
+        points, surfaces, surface_names = read_buildings_file(args.buildings)
+        x, y, z = points[:, 0], points[:, 1], points[:, 2]
+        inside = (min_x <= x) & (x <= max_x) & (min_y <= y) & (y <= max_y)
+        count_points_in_area = int(inside.sum())
+        count_points_out_of_area = len(points) - count_points_in_area
+        x, y, z, surfaces = x[inside] - min_x, y[inside] - min_y, z[inside], surfaces[inside]
+        z = z - heightmap_sub - args.buildings_base_height
+        # group the points by tile, keeping the file order within every tile
+        tiles = a.tile_of(x, y)
+        order = np.argsort(tiles, kind="stable")
+        buildings = {
+            "x": x[order], "y": y[order], "z": z[order], "surfaces": surfaces[order],
+            "tile_starts": np.searchsorted(tiles[order], np.arange(len(a.windows()) + 1)),
+            "tile_size": a.tile_size,
+            "tile_columns": a.tile_counts[0],
+            "ground": surface_names.index("ground") if "ground" in surface_names else -1,
+            "roof_summand": np.array([127 if name == "roof" else 0 for name in surface_names], dtype=np.int64),
+        }
         if count_points_out_of_area > 0:
             print(f"Warning: {count_points_out_of_area}/{count_points_in_area+count_points_out_of_area} building points were outside the area and skipped")
     else:
-        for building in features["buildings"]:
-            built_msg_format = "BUILDING drawn with coords {}, {} and height {}"
-            x_coords, y_coords = shift_coords(building["x"], building["y"])
-            if len(x_coords) < 2:
-                print("Too few coordinates, ignoring building:", x_coords, y_coords, building)
-                continue
-            elif len(x_coords) == 2:
-                xx, yy = skimage.draw.line(x_coords[0], y_coords[0], x_coords[1], y_coords[1])
-            else:
-                xx, yy = skimage.draw.polygon_perimeter(x_coords, y_coords)
-            ground_z = int(round(a[yy, xx, 0].mean()))
-            assert 0 <= ground_z <= 255
-            a[yy, xx, 0] = ground_z
-            a[yy, xx, 2] = 127 + ground_z + 1
-            a[yy, xx, 3] = np.maximum(a[yy, xx, 3], ground_z + (building["height"] or 1))
-
-
-
-    for deco, decorations in features["decorations"].items():
-        id_ = DECORATIONS[deco]
-        for decoration in decorations:
-            x, y = shift_coords(decoration["x"], decoration["y"])
-            if not x: # test if x is either None or []
-                if args.verbose: print("Out of bounds, ignoring decoration:", x, y, decoration)
-                continue
-            if type(x) is list:
-                for i in range(0, len(x)-1):
-                    x1, y1 = x[i], y[i]
-                    x2, y2 = x[i+1], y[i+1]
-                    xx, yy = skimage.draw.line(x1, y1, x2, y2)
-                    a[yy, xx, 2] = id_
-            else:
-                a[y, x, 2] = id_
-            if deco in ("tree", "leaf_tree", "conifer", "bush"):
-                # place dirt below tree
-                a[y, x, 1] = SURFACES["dirt"][0]
-                #print(f'SETTING SURFACE to {SURFACES["dirt"][0]} on {yy} x {xx}')
+        # all outlines are drawn at once, every building is put on the mean height of its outline
+        store = features["buildings"].shift(-min_x, -min_y)
+        too_few = store.lengths < 2
+        for i in np.flatnonzero(too_few):
+            print("Too few coordinates, ignoring building:", *store.coords(i))
+        store = store.select(np.flatnonzero(~too_few))
+        buildings = {
+            "store": close_outlines(store),
+            "heights": np.array([height or 1 for height in store.column("height").tolist()], dtype=np.int64),
+        }
+        buildings["index"] = spatial_index(buildings["store"])
+
+    store = FeatureStore.concat(features["decorations"].values()).shift(-min_x, -min_y)
+    kinds = list(features["decorations"])
+    kind = np.repeat(np.arange(len(kinds)), [len(items) for items in features["decorations"].values()])
+    empty = store.lengths == 0
+    if args.verbose:
+        for i in np.flatnonzero(empty):
+            print("No coordinates, ignoring decoration:", kinds[kind[i]])
+    store, kind = store.select(np.flatnonzero(~empty)), kind[~empty]
+    decorations = {
+        "store": store,
+        "ids": np.array([DECORATIONS[deco] for deco in kinds], dtype=np.uint8)[kind],
+        "dirt": np.isin(np.array(kinds + [""])[kind], ["tree", "leaf_tree", "conifer", "bush"]),
+        "index": spatial_index(store),
+    }
+    del features, area_levels, store
+    start_workers({"areas": areas, **ways, "buildings": buildings, "decorations": decorations})
+
+
+    # HEIGHTMAP
+    if heightmap is not None and not args.flat:
+        print("HEIGHTMAP used ...")
+        run_pass(a, draw_heightmap, heightmap, heightmap_window, heightmap_sub)
+    else:
+        run_pass(a, draw_heightmap, None, None, 0)
+
+
+    # AREAS
+    # flatten areas: every area gets the mean height of its pixels, computed for all areas at once
+    flat_sums = run_pass(a, draw_areas, Shared("areas"), reduce=merge_overlap_sums)
+    if areas["flat"].any():
+        run_pass(a, flatten_areas, Shared("areas"), sequential_values(flat_sums, lambda _, means: np.rint(means)))
+
+    # TODO remove all existing wholes in this area!!!
+
+
+    for name, clear_above in (("waterways", False), ("highways", True), ("railways", True)):
+        lowered_sums = run_pass(a, draw_ways, Shared(name), clear_above, reduce=merge_overlap_sums)
+        if lowered_sums is not None:
+            depths = ways[name]["label_depths"]
+            heights = sequential_values(lowered_sums, lambda labels, means: (means - depths[labels]).astype(np.uint8))
+            run_pass(a, lower_ways, Shared(name), heights)
+
+    if args.buildings:
+        run_pass(a, draw_buildings_file, Shared("buildings"), heightmap, heightmap_window, args.flat)
+    elif len(buildings["store"]):
+        ground_sums = run_pass(a, outline_sums, Shared("buildings"), reduce=merge_overlap_sums, writable=False)
+        run_pass(a, draw_outlines, Shared("buildings"), sequential_values(ground_sums, lambda _, means: np.rint(means)))
+
+
+    run_pass(a, draw_decorations, Shared("decorations"))
+
+    if args.splice:
+        stop_workers()
+        x0, y0, x1, y1 = splice_bounds
+        changed = splice(args, new_raster, a, min_x, min_y, (x0 - min_x, y0 - min_y, x1 - min_x + 1, y1 - min_y + 1), splice_origin)
+        print(f"replaced {x1 - x0 + 1}x{y1 - y0 + 1} pixels in {args.output}, changed blocks:", [tuple(block) for block in changed[:10].tolist()], "..." if len(changed) > 10 else "")
+        if tile_dir is not None:
+            tile_dir.cleanup()
+        return
 
 
     offset_x = args.offsetx-min_x if args.offsetx is not None else round((max_x - min_x) / 2)
     offset_z = args.offsetz-min_y if args.offsetz is not None else round((max_y - min_y) / 2)
 
 
+    # the hash of every mapblock is stored in map.dat, --incr compares them with those of the existing map.dat
+    hashes = block_hashes(a, offset_x, offset_z)
     if args.incr:
-        with open("world2minetest/map.dat", "rb") as f:
-            version = from_bytes(f.read(1))
-            min_version = from_bytes(f.read(1))
-            if min_version > 1:
-                raise ValueError(f"Can't add incremental map info; map.dat has newer version {version}")
-            old_layer_count = from_bytes(f.read(1))
-            old_floor_height = from_bytes(f.read(1))
-            old_offset_x = from_bytes(f.read(2))
-            old_offset_z = from_bytes(f.read(2))
-            old_size_x = from_bytes(f.read(2))
-            old_size_y = from_bytes(f.read(2))
-            length_a = from_bytes(f.read(4))
-            old_a_ = np.frombuffer(zlib.decompress(f.read(length_a)), dtype=np.uint8).reshape((old_size_y, old_size_x, old_layer_count))
-
-        if old_layer_count != LAYER_COUNT:
-            old_a_wrong_shape = old_a_
-            old_a_ = np.zeros((old_size_y, old_size_x, LAYER_COUNT), dtype=np.uint8)
-            old_a_[:,:,:old_layer_count] = old_a_wrong_shape
-
-        old_a_, old_offset_x, old_offset_z = fit_array(old_a_, -old_offset_x, -old_offset_z, -offset_x, -offset_z, a.shape[1], a.shape[0])
-        old_a = np.zeros(a.shape, dtype=np.uint8)
-        old_a[old_offset_z:old_offset_z+old_a_.shape[0], old_offset_x:old_offset_x+old_a_.shape[1]] = old_a_
-
-        diff = a != old_a
-
-        changed_blocks = []
-
-        block_x_start = -offset_x//16
-        block_x_end = (-offset_x+a.shape[1])//16
-        block_z_start = -offset_z//16
-        block_z_end = (-offset_z+a.shape[0])//16
-        print(f"checking blocks from {block_x_start},{block_z_start} to {block_x_end},{block_z_end} for changes")
-        for block_x in range(block_x_start, block_x_end+1):
-            for block_z in range(block_z_start, block_z_end+1):
-                z1 = max(block_z*16+offset_z, 0)
-                z2 = min(z1+16, diff.shape[0])
-                x1 = max(block_x*16+offset_x, 0)
-                x2 = min(x1+16, diff.shape[1])
-                if diff[z1:z2, x1:x2].any():
-                    assert block_x < 2**15 and block_z < 2**15, (block_x, block_z)
-                    changed_blocks.append((block_x, block_z))
-        print("changed blocks:", changed_blocks[:10], "..." if len(changed_blocks) > 10 else "")
-        changed_blocks = zlib.compress(b"".join(to_bytes(x, 2) + to_bytes(z, 2) for x, z in changed_blocks), 9)
+        block_x_start, block_z_start = block_grid(size[0], offset_x)[0], block_grid(size[1], offset_z)[0]
+        print(f"checking blocks from {block_x_start},{block_z_start} to {block_x_start+hashes.shape[1]-1},{block_z_start+hashes.shape[0]-1} for changes")
+        incr_blocks = diff_block_hashes(block_x_start, block_z_start, hashes, *read_old_hashes("world2minetest/map.dat", new_raster))
+        assert (incr_blocks < 2**15).all(), incr_blocks
+        print("changed blocks:", [tuple(block) for block in incr_blocks[:10].tolist()], "..." if len(incr_blocks) > 10 else "")
     else:
-        changed_blocks = b""
+        incr_blocks = None
 
 
     # Print some analysis about all surfaces generated:
-    surfaceNr = {}
-    for i in range(len(a)):
-        for j in range(len(a[i])):
-            if a[i][j][1] != 0:
-                surfaceNr[str(a[i][j][1])] = surfaceNr.get(str(a[i][j][1]), 0)+ 1
+    surface_counts, layer_max = run_pass(a, surface_stats, reduce=merge_stats, writable=False)
+    stop_workers()
     inverseSurfaceMap = {v[0]: k for k, v in SURFACES.items()}
     print("Surface analysis in a:")
     for surf in inverseSurfaceMap:
-        nr = surfaceNr.get(str(surf), 0)
+        nr = surface_counts[surf] if surf != 0 else 0
         if nr > 0:
             print('{} ({}): {:>12}'.format(inverseSurfaceMap.get(surf), surf, nr))
 
-    print("DEBUG AREA:")
-    print(f"len(a): {len(a)}, len(a[0]): {len(a[0])})")
-
     with open(str(args.output), "wb") as f:
-        f.write(to_bytes(1, 1))  # version
-        f.write(to_bytes(1, 1))  # minimum compatible version
-        f.write(to_bytes(LAYER_COUNT, 1))
-        f.write(to_bytes(a[offset_z, offset_x, 0], 1))  # height at spawnpoint
-        f.write(to_bytes(offset_x, 2))
-        f.write(to_bytes(offset_z, 2))
-        f.write(to_bytes(a.shape[1], 2))
-        f.write(to_bytes(a.shape[0], 2))
-
-        a_uncompressed = a.tobytes()
-        a_unbyted = np.frombuffer(a_uncompressed, dtype = np.uint8)
-        a_compressed = zlib.compress(a_uncompressed, 9)
-
-        f.write(to_bytes(len(a_compressed), 4))
-        f.write(a_compressed)
-        f.write(to_bytes(len(changed_blocks), 4))
-        f.write(changed_blocks)
-
-        
-        for i in [0,1,2]:
-            layer = a[::-1,:,i]
-            name = ["map_height", "map_surface", "map_decorations"][i]
-            m = max(layer.max(), 1)
-
-            img_path = os.path.join(os.path.dirname(args.output), f"{name}.png")
-            imageio.imwrite(img_path, layer*int(255/m))
+        with a.tile((offset_x, offset_z, offset_x+1, offset_z+1), writable=False) as spawn:
+            spawn_height = spawn[0, 0, 0]
+        write_map(f, a, offset_x, offset_z, spawn_height, incr_blocks, hashes, (min_x, min_y, heightmap_sub), args.region_size, args.compression_level, max(args.compression_threads, 1))
+
+    for i in [0,1,2]:
+        name = ["map_height", "map_surface", "map_decorations"][i]
+        factor = int(255/max(layer_max[i], 1))
+        img_path = os.path.join(os.path.dirname(args.output), f"{name}.png")
+        write_png(img_path, size[0], size[1], (rows[:, :, i] * factor for _, rows in a.bands(reverse=True)))
 
     if args.minimap:
-        for i in range(a.shape[0]):
-            for j in range(a.shape[1]):
-                a[i][j] = SURFACE_COLORS[a[i][j][1]]
+        colors = np.zeros((256, 4), dtype=np.uint8)
+        for surface_id, color in SURFACE_COLORS.items():
+            colors[surface_id] = color
 
         img_path = os.path.join(os.path.dirname(args.output), f"minimap.png")
-        invertedArray = a[::-1,:,:]
-        imageio.imwrite(img_path, invertedArray)
+        write_png(img_path, size[0], size[1], (colors[rows[:, :, 1]] for _, rows in a.bands(reverse=True)))
+
+    if tile_dir is not None:
+        tile_dir.cleanup()
 
 
-print(f"generate_map.py Staring: __name__ == {__name__}")
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,16 +1,16 @@
 import argparse
-import json
 import os.path
 from collections import defaultdict
 
 import numpy as np
 import ezdxf
 
+from w2mt._features import write_features
 from w2mt._util import SURFACES, DECORATIONS
 
 parser = argparse.ArgumentParser(description="Parse SKH1000 .dxf files and generate JSON data containing features")
 parser.add_argument("files", metavar="file", type=str, nargs="+", help=".dxf files to process")
-parser.add_argument("--output", "-o", type=argparse.FileType("w"), help="Output file. Defaults to parsed_data/features_dxf.json", default="./parsed_data/features_dxf.json")
+parser.add_argument("--output", "-o", type=str, help="Output file. Defaults to parsed_data/features_dxf.json. Written in the compact binary format if it ends with .bin", default="./parsed_data/features_dxf.json")
 parser.add_argument("--query", "-q", action="append", nargs=2, metavar=("query", "decoration-name"), help="ezdxf query, followed by the decoration name id ('tree', 'bush', etc.)")
 
 args = parser.parse_args()
@@ -32,10 +32,10 @@ min_y = min(d["y"] for ds in decorations.values() for d in ds)
 max_x = max(d["x"] for ds in decorations.values() for d in ds)
 max_y = max(d["y"] for ds in decorations.values() for d in ds)
 
-json.dump({
+write_features({
     "min_x": min_x,
     "max_x": max_x,
     "min_y": min_y,
     "max_y": max_y,
     "decorations": decorations
-}, args.output, indent=2)
+}, args.output)
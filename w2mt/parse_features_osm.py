@@ -1,44 +1,146 @@
 import argparse
 import json
+from array import array
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
+import numpy as np
 from pyproj import CRS, Transformer
 
-from _util import SURFACES, DECORATIONS, is_area_relation, is_building_relation
+from _features import write_features
+from _osm_readers import OverpassJSONStream, read_osm_pbf, read_osm_xml
+from _util import (classify_area_surface, classify_barrier_decoration, classify_building_height, classify_highway_surface,
+                   classify_node_decoration, classify_way, decoration_node_keys, is_area_relation,
+                   is_building_relation)
 
 import sys
 
-# TODO OPTIMIZE: create (once) and use (often) hashmap! Check for doubles during creation. 
-# Maybe we can even optimize the osm.json data export by smarter use of the query language.
-def find_element(id):
-    for e in data["elements"]:
-        try:
-            if e["id"] == id:
-                return e
-        except:
-            continue
-    return f"no element with id {id} found"
+class ElementIndex:
+    """
+    Hashmap of all OSM elements keyed by (type, id), filled once while classifying the elements.
+
+    Overpass queries like `out body; >; out skel qt` return many elements twice (first with tags, then
+    again as skeleton). Only the first occurrence is kept, further ones are counted as duplicates.
+    Lookups of refs that are not contained in the data are counted as missing.
+
+    Nodes are not kept here (only their positions are needed, see NodeStore which also drops duplicate nodes),
+    so memory use does not grow with the raw node elements.
+    """
+
+    def __init__(self):
+        self.elements = {}
+        self.duplicates = 0
+        self.missing = 0
+
+    def add(self, e):
+        if e["type"] == "node":
+            return True
+        key = (e["type"], e["id"])
+        if key in self.elements:
+            self.duplicates += 1
+            return False
+        self.elements[key] = e
+        return True
+
+    def get(self, type_, id_):
+        e = self.elements.get((type_, id_))
+        if e is None:
+            self.missing += 1
+        return e
+
+
+class NodeStore:
+    """
+    Compact store of node block positions: a sorted int64 array of node ids and int32 arrays
+    of the x and y coordinates (16 bytes per node instead of more than 100 for a dict of tuples).
+    If a node id occurs more than once, the first occurrence is kept and the others are counted as duplicates.
+    """
+
+    def __init__(self, node_ids, xs, ys):
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        order = np.argsort(node_ids, kind="stable")
+        node_ids = node_ids[order]
+        first = np.ones(len(node_ids), dtype=bool)
+        first[1:] = node_ids[1:] != node_ids[:-1]
+        order = order[first]
+        self.duplicates = len(node_ids) - len(order)
+        self.ids = node_ids[first]
+        self.xs = np.asarray(xs, dtype=np.int32)[order]
+        self.ys = np.asarray(ys, dtype=np.int32)[order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, node_ids):
+        """
+        Looks up all given node ids at once. Returns x and y coordinate arrays and a mask
+        that is False for nodes not contained in the store (their coordinates are meaningless).
+        """
+        node_ids = np.asarray(node_ids, dtype=np.int64)
+        if len(self.ids) == 0:
+            empty = np.zeros(len(node_ids), dtype=np.int32)
+            return empty, empty, np.zeros(len(node_ids), dtype=bool)
+        idx = np.searchsorted(self.ids, node_ids)
+        idx[idx == len(self.ids)] = 0
+        found = self.ids[idx] == node_ids
+        return self.xs[idx], self.ys[idx], found
+
+    def share(self):
+        """Copies the store into a new shared memory block, see attach()."""
+        n = len(self.ids)
+        shm = shared_memory.SharedMemory(create=True, size=max(n * 16, 1))
+        np.ndarray(n, np.int64, shm.buf, 0)[:] = self.ids
+        np.ndarray(n, np.int32, shm.buf, n * 8)[:] = self.xs
+        np.ndarray(n, np.int32, shm.buf, n * 12)[:] = self.ys
+        return shm
+
+    @classmethod
+    def attach(cls, shm_name, count):
+        """Creates a store backed by the shared memory block created by share() of another process, without copying."""
+        store = cls.__new__(cls)
+        store.shm = shared_memory.SharedMemory(name=shm_name)
+        store.ids = np.ndarray(count, np.int64, store.shm.buf, 0)
+        store.xs = np.ndarray(count, np.int32, store.shm.buf, count * 8)
+        store.ys = np.ndarray(count, np.int32, store.shm.buf, count * 12)
+        store.duplicates = 0
+        return store
+
+    def get(self, node_id):
+        xs, ys, found = self.lookup([node_id])
+        if not found[0]:
+            return None
+        return int(xs[0]), int(ys[0])
 
 
 def print_element(msg, e):
     print(msg, f"{e.get('id', 0)} {e.get('type', 'undefined')}[{','.join(k+'='+v for k,v in e.get('tags', {}).items())}]")
 
 
-def get_nodepos(lat, lon):
-    x, y = transform_coords(lat, lon)
-    return int(round(x)), int(round(y))
+PROJECTION_BATCH_SIZE = 1_000_000
+
+def project_nodes(node_ids, lats, lons):
+    """
+    Transforms all collected node coordinates from WGS84 to EPSG:25832 in large batches
+    (instead of one pyproj call per node) and rounds them to block positions.
+    """
+    lats = np.frombuffer(lats, dtype=np.float64)
+    lons = np.frombuffer(lons, dtype=np.float64)
+    xs = np.empty(len(lats), dtype=np.int64)
+    ys = np.empty(len(lats), dtype=np.int64)
+    for start in range(0, len(lats), PROJECTION_BATCH_SIZE):
+        end = start + PROJECTION_BATCH_SIZE
+        x, y = transform_coords(lats[start:end], lons[start:end])
+        # np.rint rounds half to even, just like the builtin round()
+        xs[start:end] = np.rint(x)
+        ys[start:end] = np.rint(y)
+    return NodeStore(np.frombuffer(node_ids, dtype=np.int64), xs, ys)
 
 
 def node_ids_to_node_positions(node_ids):
-    x_coords = []
-    y_coords = []
-    for node_id in node_ids:
-        if node_id in node_id_to_blockpos:
-            x, y = node_id_to_blockpos[node_id]
-            x_coords.append(x)
-            y_coords.append(y)
-        # Ignore nodes that are not in the dictionary (maybe out of area but in way or relation)
-    return x_coords, y_coords
+    xs, ys, found = node_store.lookup(node_ids)
+    # Ignore nodes that are not in the store (maybe out of area but in way or relation)
+    return xs[found].tolist(), ys[found].tolist()
 
 
 def update_min_max(x_coords, y_coords):
@@ -49,62 +151,8 @@ def update_min_max(x_coords, y_coords):
     max_y = max(y_coords) if max_y is None else max(max_y, *y_coords)
 
 def get_surface(area):
-    tags = area["tags"]
-    # print_element("processing area:", area)
-    surface = None
-    res_area = None
-
-    # SURFACE tag given and usable, hence we use it:
-    if "surface" in tags and tags["surface"] in SURFACES:
-        if tags["surface"] in ["natural", "building_ground"] :
-            return tags["surface"], "low"   
-        elif tags["surface"] in ["residential_landuse", "landuse", "leisure", "sports_centre", "pitch", "amenity", "school"]:
-            return tags["surface"], "medium"
-        elif tags["surface"] in ["grass", "asphalt", "paving_stones", "fine_gravel", "concrete", "dirt", "highway", "footway", "cycleway", "pedestrian", "path", "park", "playground", "parking", "village_green", "water"]:
-            return tags["surface"], "high"
-        else:
-            return tags["surface"], "low"   
-
-    if "natural" in tags:
-        if tags["natural"] == "water":
-            return "water", "medium"
-        else:
-            return "natural", "low"
-    elif "amenity" in tags:
-        if tags["amenity"] in SURFACES:
-            return tags["amenity"], "medium"
-        elif tags["amenity"] == "grave_yard":
-            return "village_green", "medium"
-        else:
-            surface = "amenity" 
-            res_area = "medium"
-            # not returned yet: might be overriden by better match...
-    elif "leisure" in tags:
-        if tags["leisure"] in SURFACES:
-            return tags["leisure"], "medium"
-        elif tags["leisure"] == "swimming_pool":
-            return "water", "high"
-        else:
-            surface = "leisure"
-            res_area = "high"
-            # not returned yet: might be overriden by better match...
-    elif "landuse" in tags:
-        if tags["landuse"] == "residential":
-            return "residential_landuse", "low"  
-        elif tags["landuse"] == "reservoir":
-            return "water", "low"
-        elif tags["landuse"] == "grass" or tags["landuse"] == "meadow" or tags["landuse"] == "forest":
-            return "natural", "medium"
-        elif tags["landuse"] in SURFACES:
-            return tags["landuse"], "low"
-        else:
-            surface = "landuse"
-            res_area = "low"
-            # not returned yet: might be overriden by better match...
-    elif "place" in tags:
-        if tags["place"] == "islet":
-            return "default", "low"
-    return surface, "low"
+    # returns surface and area level, see "area_surface" in rules.json
+    return classify_area_surface(area["tags"])
 
 def building_height(tags):
     # is only called when there was no "height" tag.
@@ -122,26 +170,8 @@ def building_height(tags):
     if levels > 0:
         return 3 * levels
 
-    # we have no levels, since we guess height by type of building:
-
-    if "building" in tags:
-        if tags["building"] in ["yes", "bungalow", "toilets"]:
-            return 3
-        elif tags["building"] in ["school", "college", "train_station", "transportation", "barn"]:
-            return 6
-        elif tags["building"] in ["hospital", "university", "barn"]:
-            return 9
-        elif tags["building"] in ["church", "mosque", "synagogue", "temple", "government"]:
-            return 12
-        elif tags["building"] in ["cathedral"]:
-            return 15
-    if "tower:type" in tags:
-        if tags["tower:type"] in ["bell_tower"]:
-            return 27
-    if "railway" in tags:
-        if tags["railway"] in ["platform"]:
-            return 1
-    return 2
+    # we have no levels, since we guess height by type of building, see "building_height" in rules.json
+    return classify_building_height(tags)
 
 
 def rel_has_only_outer_ways(relation):
@@ -159,106 +189,330 @@ def rel_has_only_outer_ways(relation):
     return True
 
 
+def assemble_rings(ways):
+    """
+    Joins the given ways (lists of node ids) to closed rings, regardless of the order and direction of the ways.
+    A hashmap from end nodes to ways is built once, then each ring is chained by looking up its current end node,
+    hence this takes linear time in the number of ways.
+    Returns the closed rings (in the order of their first way) and the number of ways that are not part of a closed ring.
+    """
+    endpoints = defaultdict(list)
+    for i, nodes in enumerate(ways):
+        if nodes[0] != nodes[-1]:
+            endpoints[nodes[0]].append(i)
+            endpoints[nodes[-1]].append(i)
+
+    used = [False] * len(ways)
+    rings = []
+    unclosed = 0
+    for i, nodes in enumerate(ways):
+        if used[i]:
+            continue
+        used[i] = True
+        ring = list(nodes)
+        count = 1
+        while ring[-1] != ring[0]:
+            end = ring[-1]
+            for j in endpoints[end]:
+                if not used[j]:
+                    break
+            else:
+                break # no way left to continue this ring
+            used[j] = True
+            count += 1
+            if ways[j][0] == end:
+                ring.extend(ways[j][1:])
+            else:
+                ring.extend(ways[j][-2::-1])
+        if ring[0] == ring[-1]:
+            rings.append(ring)
+        else:
+            unclosed += count
+    return rings, unclosed
+
+
 def split_relation_in_areas_and_holes(relation, list_for_outer_areas, list_for_inner_areas, list_of_areas):
-    areaNr = 0
-    areaNodes = []
+    """
+    Assembles the member ways of a multipolygon relation to closed outer and inner rings.
+    Members without a role count as outer ways. Inner ways which are areas in their own right are left out,
+    they will be taken care of later.
+    """
+    only_outer_ways = rel_has_only_outer_ways(relation)
+    outer_ways = []
+    inner_ways = []
     for member in relation["members"]:
-        try:
-            role = member["role"]
-        except:
+        if member["type"] != "way" or "role" not in member:
             continue
-
-        if member["type"] == "way":
-            if rel_has_only_outer_ways(relation):
-                area_collection = list_of_areas
-            elif role == "inner":
-                if is_area_relation(member):
-                    continue # leave inner areas out when they are areas in their own right: they will be taken care of later
-                else:
-                    area_collection = list_for_inner_areas # an inner empty area
-            else: 
-                area_collection = list_for_outer_areas
-
-            way = find_element(member.get('ref'))
-            try:
-                myNodes = way['nodes'].copy()
-            except:
+        way = element_index.get("way", member.get('ref'))
+        if way is None or len(way.get("nodes", ())) < 2:
+            continue
+        if member["role"] == "inner":
+            if is_area_relation(way):
                 continue
+            inner_ways.append(way["nodes"])
+        else:
+            outer_ways.append(way["nodes"])
 
-            nodesCount = len(myNodes)
-            if len(areaNodes) == 0:
-#                print(f"xxx #0 Start ({nodesCount})")
-                areaNodes = myNodes
-            elif myNodes[-1] == areaNodes[0]: 
-                # new way should sit in front of collected area
-                myNodes.pop(-1)
-                myNodes.extend(areaNodes)
-                areaNodes = myNodes
-#               print(f"xxx #1 Prepend ({nodesCount} => {len(areaNodes)})")
-            elif areaNodes[0] == myNodes[0]: 
-                # new way has same head as collected area, hence we reverse it and prepend it
-                reverseNodes = myNodes[len(myNodes):0:-1] # gets all but the first in reverse order
-                reverseNodes.extend(areaNodes)
-                areaNodes = reverseNodes
-#                print(f"xxx #2 Prepend reversed ({nodesCount}) => {len(areaNodes)}")
-            elif areaNodes[-1] == myNodes[0]:
-                # new way joins after collected area
-                areaNodes.pop(-1)
-                areaNodes.extend(myNodes)
-#                print(f"xxx #3 Extend ({nodesCount}) => {len(areaNodes)}")
-            elif areaNodes[-1] == myNodes[-1]:
-                # new way has same tail as collected area, hence we reverse it and extend it at end
-                reverseNodes = myNodes[len(myNodes)-1::-1] # gets all but the last in reverse order
-                areaNodes.extend(reverseNodes)
-#                print(f"xxx #4 Extend reversed ({nodesCount}) => {len(areaNodes)}")
-            else:
-                print(f"WARNING: way {way['id']} does not fit in relation {relation['id']}, hence we ignore it.")
+    areaNr = 0
+    unclosed = 0
+    for role, ways in (("outer", outer_ways), ("inner", inner_ways)):
+        if only_outer_ways:
+            area_collection = list_of_areas
+        elif role == "inner":
+            area_collection = list_for_inner_areas # an inner empty area
+        else:
+            area_collection = list_for_outer_areas
+        if role == "outer":
+            areaTags = relation["tags"]
+        else:
+            areaTags = { "empty_area" : "yes", }
+
+        rings, role_unclosed = assemble_rings(ways)
+        unclosed += role_unclosed
+        for ring in rings:
+            area_collection.append({
+                "id": f"{relation['id']}.{role}#{areaNr}",
+                "nodes": ring,
+                "tags": areaTags,
+            })
+            areaNr += 1
+
+    if unclosed:
+        print(f"WARNING: {unclosed} ways of relation {relation['id']} do not form a closed ring, hence we ignore them.")
 
-            # check if area is complete, i.e. path of nodes is closed:
-            if role == "outer":
-                areaTags = relation["tags"]
-            else: 
-                areaTags = { "empty_area" : "yes", }
-            if areaNodes[0] == areaNodes[-1]:
-                area_collection.append({
-                    "id": f"{relation['id']}.{role}#{areaNr}",
-                    "nodes": areaNodes,
-                    "tags": areaTags,
-                })
-#                print(f"xxx Relation {relation['id']}.{role}#{areaNr} COMPLETE and added to our areas with #{len(areaNodes)} nodes")
-                areaNodes = []
-                areaNr += 1
-#            else:
-#                print(f"xxx Relation {relation['id']} has #{len(areaNodes)} nodes but is still incomplete, hence we keep collecting parts ...")
 
-    return
+############# PHASE 2: ##############
+"""
+Every element of phase 2 is turned into a feature using only its own tags and node positions,
+hence the elements can be processed in chunks by several processes (see --workers).
+All process_* functions return a tuple (key, feature) or None, if the element is ignored.
+The key is the area level for areas and the decoration name for decorations.
+"""
 
+def process_outer_area(area):
+    surface, level = get_surface(area)
+    level = "outer"
 
+    if surface is None:
+        print_element("Ignored, could not determine surface:", area)
+        return None
 
+    x_coords, y_coords = node_ids_to_node_positions(area["nodes"])
+    print(f"Added outer area to res_area #{area['id']} surface: {surface}, level: {level}")
+    return level, {"x": x_coords, "y": y_coords, "surface": surface, "osm_id": area["id"]} # TODO add holes (inner elements)
+
+
+def process_hole(hole):
+    surface = "default"
+    level = "inner"
+
+    try:
+        myNodes = hole["nodes"]
+    except:
+        return None
+
+    x_coords, y_coords = node_ids_to_node_positions(myNodes)
+    print(f"Added hole to res_area #{hole['id']} surface: {surface}, level: {level}")
+    return level, {"x": x_coords, "y": y_coords, "surface": surface, "osm_id": hole["id"]} # TODO add holes (inner elements)
+
+
+def process_area(area):
+    surface, level = get_surface(area)
+
+    if surface is None:
+        print_element("Ignored, could not determine surface: ", area)
+        return None
+
+    x_coords, y_coords = node_ids_to_node_positions(area["nodes"])
+    return level, {"x": x_coords, "y": y_coords, "surface": surface, "osm_id": area["id"]} # TODO add holes (inner elements)
+
+
+def process_building(building):
+    x_coords, y_coords = node_ids_to_node_positions(building["nodes"])
+    if len(x_coords) < 2:
+        print_element(f"Ignored, only {len(x_coords)} nodes:", building)
+        return None
+    tags = building["tags"]
+    material = None
+    if "building:material" in tags:
+        if tags["building:material"] == "brick":
+            material = "brick"
+        else:
+            print_element("Unrecognized building:material", building)
+    is_building_part = "building:part" in tags
+    b = {"x": x_coords, "y": y_coords, "is_part": is_building_part, "osm_id": building.get("id")}
+    try:
+        height = int(tags["building:height"].split(' m')[0])
+    except:
+        height = building_height(tags)
+    else:
+        height = min(height, 255)
+    finally:
+        b["height"] = height
+
+    if material is not None:
+        b["material"] = material
+    return None, b
+
+
+def process_barrier(barrier):
+    deco = classify_barrier_decoration(barrier["tags"])
+    if deco != barrier["tags"]["barrier"]:
+        print_element("Default barrier:", barrier)
+    x_coords, y_coords = node_ids_to_node_positions(barrier["nodes"])
+    return deco, {"x": x_coords, "y": y_coords}
+
+
+def process_waterway(waterway):
+    tags = waterway["tags"]
+
+    if "waterway" in tags:
+        surface = "water"
+
+    layer = tags.get("layer", 0)
+    try:
+        layer = int(layer)
+    except ValueError:
+        layer = 0
+
+    x_coords, y_coords = node_ids_to_node_positions(waterway["nodes"])
+    return None, {"x": x_coords, "y": y_coords, "surface": surface, "layer": layer, "osm_id": waterway["id"], "type": tags["waterway"]}
+
+
+def process_railway(railway):
+    tags = railway["tags"]
+
+    if "railway" in tags:
+        surface = "rail"
+
+    layer = tags.get("layer", 0)
+    try:
+        layer = int(layer)
+    except ValueError:
+        layer = 0
+
+    x_coords, y_coords = node_ids_to_node_positions(railway["nodes"])
+    return None, {"x": x_coords, "y": y_coords, "surface": surface, "layer": layer, "osm_id": railway["id"], "type": tags["railway"]}
+
+
+def process_highway(highway):
+    tags = highway["tags"]
+
+    surface = classify_highway_surface(tags)
+
+    layer = tags.get("layer", 0)
+    try:
+        layer = int(layer)
+    except ValueError:
+        layer = 0
+    if "tunnel" in tags and tags["tunnel"] != "building_passage":
+        if "layer" in tags:
+            try:
+                layer = int(tags["layer"])
+            except ValueError:
+                layer = -1
+            if layer > 0:
+                layer = 0
+        else:
+            layer = -1
+
+    x_coords, y_coords = node_ids_to_node_positions(highway["nodes"])
+    return None, {"x": x_coords, "y": y_coords, "surface": surface, "layer": layer, "osm_id": highway["id"], "type": tags["highway"]}
+
+
+def process_node(node):
+    deco = classify_node_decoration(node["tags"])
+    if deco is None:
+        print_element("Ignored, could not determine decoration type:", node)
+        return None
+    x, y = node_store.get(node["id"])
+    return deco, {"x": x, "y": y}
+
+
+PHASE_2 = {
+    "OUTER_AREAS": process_outer_area,
+    "INNER EMPTY AREAS": process_hole,
+    "AREAS": process_area,
+    "BUILDINGS": process_building,
+    "BARRIERS": process_barrier,
+    "WATERWAYS": process_waterway,
+    "RAILWAYS": process_railway,
+    "HIGHWAYS": process_highway,
+    "NODES": process_node,
+}
+
+PHASE_2_CHUNK_SIZE = 2000
+
+
+def attach_node_store(shm_name, count):
+    # initializer of worker processes
+    global node_store
+    node_store = NodeStore.attach(shm_name, count)
+
+
+def process_chunk(phase, elements):
+    process = PHASE_2[phase]
+    return [process(e) for e in elements]
+
+
+def process_elements(phase, elements, pool=None):
+    """
+    Yields the results of the phase's process function for all elements in order.
+    If a process pool is given, the elements are processed there in chunks.
+    """
+    if pool is None:
+        yield from map(PHASE_2[phase], elements)
+        return
+    chunks = [elements[i:i+PHASE_2_CHUNK_SIZE] for i in range(0, len(elements), PHASE_2_CHUNK_SIZE)]
+    for results in pool.map(process_chunk, [phase] * len(chunks), chunks):
+        yield from results
+
+
+def read_elements(path, stream=False, workers=1):
+    """
+    Yields the elements of an Overpass JSON, OSM XML or OSM PBF file. Exits with an error message if the file can't
+    be read, also if invalid data is found after the first elements have been yielded.
+    """
+    binary = path.endswith((".pbf", ".osm", ".xml"))
+    try:
+        with open(path, "rb") if binary else open(path, encoding="utf-8") as file:
+            if path.endswith(".pbf"):
+                elements = read_osm_pbf(file, workers)
+            elif binary:
+                elements = read_osm_xml(file)
+            elif stream:
+                elements = OverpassJSONStream(file)
+            else:
+                elements = json.load(file)["elements"]
+            yield from elements
+    except Exception as e:
+        print(f"❌ Fehler beim Laden der Datei {path}: {e}")
+        sys.exit(2)
 
 
 def main() :
     print("START: parse_features_osm.py")
 
     parser = argparse.ArgumentParser(description="Parse OSM data")
-    parser.add_argument("file", type=argparse.FileType("r", encoding="utf-8"), help="GeoJSON file with OSM data")
-    parser.add_argument("--output", "-o", type=argparse.FileType("w"), help="Output file. Defaults to parsed_data/features_osm.json", default="./parsed_data/features_osm.json")
+    parser.add_argument("file", type=str, help="File with OSM data: Overpass JSON (.json), OSM XML (.osm, .xml) or OSM PBF (.osm.pbf)")
+    parser.add_argument("--output", "-o", type=str, help="Output file. Defaults to parsed_data/features_osm.json. Written in the compact binary format if it ends with .bin", default="./parsed_data/features_osm.json")
+    parser.add_argument("--stream", action="store_true", help="Read the elements of the file one by one instead of loading the whole JSON document. Use for very large files. .osm and .osm.pbf files are always read this way.")
+    parser.add_argument("--workers", type=int, help="Number of processes used to decode .osm.pbf blocks and to build the features from the elements. Defaults to 1.", default=1)
 
     args = parser.parse_args()
 
     global transform_coords
     transform_coords = Transformer.from_crs(CRS.from_epsg(4326), CRS.from_epsg(25832)).transform
 
-    global node_id_to_blockpos
-    node_id_to_blockpos = {}
+    global node_store
+    node_ids = array("q")
+    node_lats = array("d")
+    node_lons = array("d")
 
-    global data
-    data = None
-    try:
-        data = json.load(args.file)
-    except Exception as e:
-        print(f"❌ Fehler beim Laden der Datei: {e}")
-        sys.exit(2)
+    global element_index
+    element_index = ElementIndex()
+
+    elements = read_elements(args.file, args.stream, args.workers)
 
     global min_x, max_x, min_y, max_y
     min_x = None
@@ -277,17 +531,30 @@ def main() :
     buildings = []
     barriers = []
     nodes = []
+    area_relations = []
+    building_relations = []
+    way_lists = {
+        "areas": areas,
+        "highways": highways,
+        "railways": railways,
+        "waterways": waterways,
+        "buildings": buildings,
+        "barriers": barriers,
+    }
 
     # sort elements by type (highway, building, area or node)
-    for e in data["elements"]:
+    for e in elements:
+        if "id" in e and not element_index.add(e):
+            continue # duplicate, e.g. skeleton output of `out body; >; out skel qt`
         t = e["type"]
         tags = e.get("tags")
         if tags and "boundary" in tags.keys():
             continue # ignore boundaries
         if t == "node":
-            blockpos = get_nodepos(e["lat"], e["lon"])
-            node_id_to_blockpos[e["id"]] = blockpos
-            if tags and ("natural" in tags or "amenity" in tags or "barrier" in tags):
+            node_ids.append(e["id"])
+            node_lats.append(e["lat"])
+            node_lons.append(e["lon"])
+            if tags and any(key in tags for key in decoration_node_keys):
                 nodes.append(e)
                 continue
         elif t == "relation" or t == "multipolygon":
@@ -298,47 +565,39 @@ def main() :
             if not members:
                 print_element(f"Ignored relation {e.get('id')}, missing members:", e)
                 continue
+            # relations are assembled after all elements are indexed, since their members may come later
             if is_area_relation(e):
-                print(f"Area from relation added. ID: {e.get('id')}")
-                split_relation_in_areas_and_holes(e, outer_areas, inner_empty_areas, areas)
+                area_relations.append(e)
                 continue
             elif is_building_relation(e):
-                print(f"Building from relation added. ID: {e.get('id')}")
-                split_relation_in_areas_and_holes(e, buildings, buildings, buildings)
+                building_relations.append(e)
                 continue
         elif t == "way":
             if not tags:
                 print_element("Ignored, missing tags:", e)
                 continue
-            elif "area" in tags:
-                areas.append(e)
-                continue
-            elif "highway" in tags:
-                highways.append(e)
-                continue
-            elif "railway" in tags:
-                if tags['railway'] in { "rail", "light_rail", "subway", "tram"}:
-                    if "tunnel" in tags and tags['tunnel'] == "yes":
-                        continue 
-                    railways.append(e)
-                continue
-            elif "waterway" in tags:
-                if tags['waterway'] in { "ditch", "drain", "stream"}:
-                    waterways.append(e)
-                continue
-            elif "building" in tags or "building:part" in tags:
-                buildings.append(e)
-                continue
-            elif "barrier" in tags:
-                barriers.append(e)
-                continue
-            else:
-                areas.append(e)
-                continue
+            way_type = classify_way(tags) # see "way_type" in rules.json
+            if way_type is not None:
+                way_lists[way_type].append(e)
+            continue
         else:
             print(f"Ignoring element {e.get('id')} with unknown type {t}")
             continue
 
+    print(f"Projecting {len(node_ids)} nodes ...")
+    node_store = project_nodes(node_ids, node_lats, node_lons)
+    del elements, node_ids, node_lats, node_lons
+
+    for relation in area_relations:
+        print(f"Area from relation added. ID: {relation.get('id')}")
+        split_relation_in_areas_and_holes(relation, outer_areas, inner_empty_areas, areas)
+    for relation in building_relations:
+        print(f"Building from relation added. ID: {relation.get('id')}")
+        split_relation_in_areas_and_holes(relation, buildings, buildings, buildings)
+    print(f"Indexed {len(node_store)} nodes and {len(element_index.elements)} other elements, "
+          f"skipped {node_store.duplicates + element_index.duplicates} duplicates, "
+          f"{element_index.missing} relation members not found.")
+
 
     res_areas = {
         "outer": [],
@@ -355,193 +614,52 @@ def main() :
 
     ############# PHASE 2: ##############
 
+    # phase, elements, function to add a result, whether it extends the map boundaries
+    phase_2 = (
+        ("OUTER_AREAS", outer_areas, lambda level, f: res_areas[level].append(f), True),
+        ("INNER EMPTY AREAS", inner_empty_areas, lambda level, f: res_areas[level].append(f), True),
+        ("AREAS", areas, lambda level, f: res_areas[level].append(f), True),
+        ("BUILDINGS", buildings, lambda _, f: res_buildings.append(f), False),
+        ("BARRIERS", barriers, lambda deco, f: res_decorations[deco].append(f), True),
+        ("WATERWAYS", waterways, lambda _, f: res_waterways.append(f), True),
+        ("RAILWAYS", railways, lambda _, f: res_railways.append(f), True),
+        ("HIGHWAYS", highways, lambda _, f: res_highways.append(f), True),
+        ("NODES", nodes, lambda deco, f: res_decorations[deco].append(f), True),
+    )
+
+    pool = None
+    if args.workers > 1:
+        shm = node_store.share()
+        pool = ProcessPoolExecutor(args.workers, initializer=attach_node_store, initargs=(shm.name, len(node_store)))
 
-    print("Processing OUTER_AREAS...")
-    for area in outer_areas:
-        surface, level = get_surface(area)
-        level = "outer"
-
-        if surface is None:
-            print_element("Ignored, could not determine surface:", area)
-            continue
-
-        x_coords, y_coords = node_ids_to_node_positions(area["nodes"])
-        update_min_max(x_coords, y_coords)
-        res_areas[level].append({"x": x_coords, "y": y_coords, "surface": surface, "osm_id": area["id"]}) # TODO add holes (inner elements)
-        print(f"Added outer area to res_area #{area['id']} surface: {surface}, level: {level}")
-
-    print("Processing INNER EMPTY AREAS ...")
-    for hole in inner_empty_areas:
-        surface = "default"
-        level = "inner"
-
-        try:
-            myNodes = hole["nodes"]
-        except:
-            continue
-
-        x_coords, y_coords = node_ids_to_node_positions(hole["nodes"])
-        update_min_max(x_coords, y_coords)
-        res_areas[level].append({"x": x_coords, "y": y_coords, "surface": surface, "osm_id": hole["id"]}) # TODO add holes (inner elements)
-        print(f"Added hole to res_area #{hole['id']} surface: {surface}, level: {level}, now we have {len(res_areas['inner'])} inner areas.")
-
-
-    print("Processing AREAS...")
-    for area in areas:
-        surface, level = get_surface(area)
-
-        if surface is None:
-            print_element("Ignored, could not determine surface: ", area)
-            continue
-
-        x_coords, y_coords = node_ids_to_node_positions(area["nodes"])
-        update_min_max(x_coords, y_coords)
-        res_areas[level].append({"x": x_coords, "y": y_coords, "surface": surface, "osm_id": area["id"]}) # TODO add holes (inner elements)
-
-    print("Processing BUILDINGS...")
-    for building in buildings:
-        x_coords, y_coords = node_ids_to_node_positions(building["nodes"])
-        if len(x_coords) < 2:
-            print_element(f"Ignored, only {len(x_coords)} nodes:", building)
-            continue
-        tags = building["tags"]
-        material = None
-        if "building:material" in tags:
-            if tags["building:material"] == "brick":
-                material = "brick"
-            else:
-                print_element("Unrecognized building:material", building)
-        is_building_part = "building:part" in tags
-        b = {"x": x_coords, "y": y_coords, "is_part": is_building_part, "osm_id": building.get("id")}
-        try:
-            height = int(tags["building:height"].split(' m')[0])
-        except:
-            height = building_height(tags)
-        else:
-            height = min(height, 255)
-        finally:
-            b["height"] = height
-        
-        if material is not None:
-            b["material"] = material
-        res_buildings.append(b)
-
-
-
-
-    print("Processing BARRIERS...")
-    for barrier in barriers:
-        if barrier["tags"]["barrier"] in DECORATIONS:
-            deco = barrier["tags"]["barrier"]
-        else:
-            deco = "barrier"
-            print_element("Default barrier:", barrier)
-        x_coords, y_coords = node_ids_to_node_positions(barrier["nodes"])
-        update_min_max(x_coords, y_coords)
-        res_decorations[deco].append({"x": x_coords, "y": y_coords})
-
-
-    print("Processing WATERWAYS...")
-    for waterway in waterways:
-        tags = waterway["tags"]
-
-        if "waterway" in tags:
-            surface = "water"
-
-        layer = tags.get("layer", 0)
-        try:
-            layer = int(layer)
-        except ValueError:
-            layer = 0
-
-        x_coords, y_coords = node_ids_to_node_positions(waterway["nodes"])
-        update_min_max(x_coords, y_coords)
-        res_waterways.append({"x": x_coords, "y": y_coords, "surface": surface, "layer": layer, "osm_id": waterway["id"], "type": tags["waterway"]})
-
-
-    print("Processing RAILWAYS...")
-    rnumber = 0
-    for railway in railways:
-        tags = railway["tags"]
-
-        if "railway" in tags:
-            surface = "rail"
-
-        layer = tags.get("layer", 0)
-        try:
-            layer = int(layer)
-        except ValueError:
-            layer = 0
-
-        x_coords, y_coords = node_ids_to_node_positions(railway["nodes"])
-        update_min_max(x_coords, y_coords)
-        res_railways.append({"x": x_coords, "y": y_coords, "surface": surface, "layer": layer, "osm_id": railway["id"], "type": tags["railway"]})
-        rnumber = rnumber + 1
-    print (f"Added {rnumber}RAILs")
-
-
-    print("Processing HIGHWAYS...")
-    for highway in highways:
-        tags = highway["tags"]
-
-        if tags["highway"] in SURFACES:
-            surface = tags["highway"]
-        elif "surface" in tags and tags["surface"] in SURFACES:
-            surface = tags["surface"]
-        else:
-            surface = "highway"
-
-        layer = tags.get("layer", 0)
-        try:
-            layer = int(layer)
-        except ValueError:
-            layer = 0
-        if "tunnel" in tags and tags["tunnel"] != "building_passage":
-            if "layer" in tags:
-                try:
-                    layer = int(tags["layer"])
-                except ValueError:
-                    layer = -1
-                if layer > 0:
-                    layer = 0
-            else:
-                layer = -1
-
-        x_coords, y_coords = node_ids_to_node_positions(highway["nodes"])
-        update_min_max(x_coords, y_coords)
-        res_highways.append({"x": x_coords, "y": y_coords, "surface": surface, "layer": layer, "osm_id": highway["id"], "type": tags["highway"]})
-
-    # NODES
-    for node in nodes:
-        tags = node["tags"]
-        id_ = None
-        height = 1
-        if "natural" in tags:
-            if tags["natural"] in DECORATIONS:
-                deco = tags["natural"]
-            else:
-                print_element("Unrecognized natural node:", node)
-                continue
-        elif "amenity" in tags and tags["amenity"] in DECORATIONS:
-            deco = tags["amenity"]
-        elif "barrier" in tags:
-            if tags["barrier"] in DECORATIONS:
-                deco = tags["barrier"]
-            else:
-                deco = "barrier"
-                print_element("Default barrier:", node)
-        else:
-            print_element("Ignored, could not determine decoration type:", node)
-            continue
-        x, y = get_nodepos(node["lat"], node["lon"])
-        update_min_max([x], [y])
-        res_decorations[deco].append({"x": x, "y": y})
+    try:
+        for phase, elements, add, extends_bounds in phase_2:
+            print(f"Processing {phase}...")
+            count = 0
+            # results are merged in input order, hence the output does not depend on the number of workers
+            for result in process_elements(phase, elements, pool):
+                if result is None:
+                    continue
+                key, feature = result
+                if extends_bounds:
+                    if type(feature["x"]) is list:
+                        update_min_max(feature["x"], feature["y"])
+                    else:
+                        update_min_max([feature["x"]], [feature["y"]])
+                add(key, feature)
+                count += 1
+            print(f"Added {count} {phase}")
+    finally:
+        if pool is not None:
+            pool.shutdown()
+            shm.close()
+            shm.unlink()
 
     size_x = max_x-min_x+1
     size_y = max_y-min_y+1
-    print(f"\nOutput dumped to: {args.output.name}\nfrom {min_x},{min_y} to {max_x},{max_y}: (size: {size_x},{size_y})")
+    print(f"\nOutput dumped to: {args.output}\nfrom {min_x},{min_y} to {max_x},{max_y}: (size: {size_x},{size_y})")
 
-    json.dump({
+    write_features({
         "min_x": min_x,
         "max_x": max_x,
         "min_y": min_y,
@@ -552,7 +670,7 @@ def main() :
         "highways": res_highways,
         "railways": res_railways,
         "waterways": res_waterways
-    }, args.output, indent=2)
+    }, args.output)
     print("END: parse_features_osm.py")
 
 
@@ -8,6 +8,8 @@ import sys
 import unicodedata
 from pyproj import CRS, Transformer
 
+from _parse_cache import DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE_MB, ParseCache, cache_key
+
 def get_args():
 	parser = argparse.ArgumentParser(description="Create a minetest world based on openstreetmap data.")
 	parser.add_argument('-p', '--project', help="Project name")
@@ -22,6 +24,9 @@ def get_args():
 	parser.add_argument('-a', '--area', type=ascii, help="Decimal coordinates of two opposite corners of desired area, separated by commas: 'lat_1, long_1, lat_2, long_2'")
 	parser.add_argument('-u', '--unrestricted', action='store_true', help="Unrestrcited area, i.e. all data reaching beyond area boundary is included and stretches the area")
 	parser.add_argument('-s', '--start', action='store_true', help="Starts the world after creating it in server mode.")
+	parser.add_argument('--cache_dir', default=DEFAULT_CACHE_DIR, help=f"Directory of the cache of parsed features (default: {DEFAULT_CACHE_DIR})")
+	parser.add_argument('--cache_size', type=int, default=DEFAULT_CACHE_SIZE_MB, help=f"Size limit of the cache of parsed features in MB, least recently used entries are evicted first (default: {DEFAULT_CACHE_SIZE_MB})")
+	parser.add_argument('--no_cache', action='store_true', help="Always parse the OSM data, even if the cache contains features of the same data.")
 	return parser.parse_args()
 
 # log to console and/or file, depending on verbose flag:
@@ -131,6 +136,15 @@ import subprocess
 def extract_features_from_osm_json():
 	log(f"Extracting features from {osm_path} to {feature_path} ...")
 
+	# unchanged OSM data, rules and parser result in the same features, so they are taken from the cache:
+	cache = None
+	if not args.no_cache:
+		cache = ParseCache(args.cache_dir, args.cache_size * 1024 * 1024)
+		key = cache_key(osm_path, os.path.splitext(feature_path)[1])
+		if cache.get(key, feature_path):
+			log(f"... done, reused cached features {key}")
+			return
+
 	# Baue das Kommando als Liste
 	cmd = [
 		"python3", "parse_features_osm.py",
@@ -143,6 +157,8 @@ def extract_features_from_osm_json():
 		with open(log_file, "a") as logf:
 			result = subprocess.run(cmd, stdout=logf, stderr=logf, check=True)
 		log("... done")
+		if cache is not None:
+			cache.put(key, feature_path)
 	except subprocess.CalledProcessError as e:
 		log(f"... error! Exit code: {e.returncode}")
 		log(f"❌ Fehler beim Ausführen von: {' '.join(cmd)}")